@@ -0,0 +1,978 @@
+#!/usr/bin/env python3
+"""控制端功能测试：在临时目录里用 Flask 测试客户端和软件帧缓冲驱动 led_web_test，
+检查参数校验以及各功能的核心行为，不需要矩阵硬件。
+
+    python3 led_app_test.py
+    python3 led_app_test.py ParamsValidationTest -v
+"""
+import contextlib, datetime, hashlib, io, json, os, socket, subprocess, sys, tempfile, threading, time, unittest, zlib
+from unittest import mock
+
+# 必须在导入 led_web_test 之前设置：软件帧缓冲、关闭上传后台转码；上传目录、缓存与数据库都放在临时目录
+os.environ['LED_BACKEND'] = 'framebuffer'
+os.environ['LED_TRANSCODE_ON_UPLOAD'] = '0'
+WORKDIR = tempfile.mkdtemp(prefix='led-test-')
+os.environ['LED_SHARED_FRAMES'] = os.path.join(WORKDIR, 'led-frames')
+os.chdir(WORKDIR)
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cv2
+import numpy as np
+import led_web_test as led
+import led_benchmark
+from led_benchmark import write_bdf
+from led_shared_frames import SharedFrameWriter
+
+FONT = 'test.bdf'
+os.makedirs('fonts')
+write_bdf(os.path.join('fonts', FONT))
+led.font_registry.folder = os.path.abspath('fonts')
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+class AppTestCase(unittest.TestCase):
+    """每个测试从空屏开始，测试客户端的会话里选好测试字体"""
+    def setUp(self):
+        led.controller.submit('stop', wait=True)
+        self.client = led.app.test_client()
+        with self.client.session_transaction() as session:
+            session['text_font'] = session['clock_font'] = FONT
+
+    def post(self, path, data):
+        # 直接发送 JSON 文本，NaN / Infinity 这类非严格 JSON 也能原样送到服务端
+        return self.client.post(path, data=json.dumps(data), content_type='application/json')
+
+class ParamsValidationTest(AppTestCase):
+    BAD_COLOR = [{'rgb': [float('nan'), 1, 1]}, {'rgb': [float('inf'), 1, 1]}, {'rgb': [-0.5, 1, 1]},
+                 {'rgb': [1, 1]}, {'rgb': 'abc'}, {'gamma': 'nan'}, {'gamma': float('inf')}, {'gamma': 0},
+                 {'brightness': float('nan')}, {'brightness': 'x'}]
+    BAD_CONTENT = [{'x': 1.5}, {'y': 'abc'}, {'x': None}, {'x': True}, {'speed': float('nan')},
+                   {'speed': 'inf'}, {'text': 5}, {'color': 3}]
+
+    def test_params_rejects_invalid_color(self):
+        before, state = dict(led.COLOR_CONFIG), led.color_lut.state
+        for data in self.BAD_COLOR:
+            with self.subTest(data=data):
+                self.assertEqual(self.post('/params', data).status_code, 400)
+        self.assertEqual(led.COLOR_CONFIG, before)
+        self.assertIs(led.color_lut.state, state)
+
+    def test_params_rejects_invalid_content(self):
+        for data in self.BAD_CONTENT:
+            with self.subTest(data=data):
+                self.assertEqual(self.post('/params', data).status_code, 400)
+
+    def test_batch_rejects_invalid_values(self):
+        before = dict(led.COLOR_CONFIG)
+        for data in self.BAD_COLOR:
+            with self.subTest(data=data):
+                response = self.post('/batch', {'color': data})
+                self.assertEqual(response.status_code, 400)
+        for data in self.BAD_CONTENT:
+            with self.subTest(data=data):
+                response = self.post('/batch', {'color': {'brightness': 10},
+                                                'content': dict({'type': 'text', 'text': 'hi'}, **data)})
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(led.COLOR_CONFIG, before)  # 整批拒绝，颜色也不生效
+
+    def test_text_and_clock_reject_invalid_position(self):
+        self.assertEqual(self.post('/text', {'text': 'hi', 'color': '#ffffff', 'speed': 'fast'}).status_code, 400)
+        self.assertEqual(self.post('/text', {'text': 'hi', 'color': '#ffffff', 'speed': 1, 'x': 0.5}).status_code, 400)
+        self.assertEqual(self.post('/clock', {'y': [1]}).status_code, 400)
+
+    def test_live_update_applies_valid_params(self):
+        self.assertEqual(self.post('/text', {'text': 'hi', 'color': '#ffffff', 'speed': 0}).status_code, 200)
+        led.controller.submit('params', {}, wait=True)
+        response = self.post('/params', {'x': 3, 'y': '2', 'text': 'new'})
+        self.assertEqual(response.json['applied'], ['text', 'x', 'y'])
+        led.controller.submit('params', {}, wait=True)
+        source = led.engine.content()
+        self.assertIsInstance(source, led.TextSource)
+        self.assertEqual((source.requested['text'], source.requested['x'], source.requested['y']), ('new', 3, 2))
+
+class PlaylistTest(AppTestCase):
+    def tearDown(self):
+        led.scheduler.stop()
+        for name in list(led.scheduler.playlists):
+            led.scheduler.delete(name)
+
+    def put(self, name, items, mode='loop'):
+        return self.client.put(f'/playlists/{name}', data=json.dumps({'items': items, 'mode': mode}),
+                               content_type='application/json')
+
+    def test_rejects_invalid_duration(self):
+        for duration in (float('nan'), float('inf'), 'nan', 0, -1, 'soon', True):
+            with self.subTest(duration=duration):
+                response = self.put('bad', [{'type': 'text', 'text': 'a', 'duration': duration}])
+                self.assertEqual(response.status_code, 400)
+        self.assertNotIn('bad', led.scheduler.playlists)
+
+    def test_saved_file_is_strict_json(self):
+        self.assertEqual(self.put('ok', [{'type': 'text', 'text': 'a', 'duration': 1.5}]).status_code, 200)
+        with open(led.scheduler.path) as f:
+            saved = json.load(f, parse_constant=lambda name: self.fail(f'{name} in playlist file'))
+        self.assertEqual(saved['playlists']['ok']['items'][0]['duration'], 1.5)
+
+    def test_rotation_in_order(self):
+        items = [{'type': 'text', 'text': text, 'font': FONT, 'speed': 0, 'duration': 0.2} for text in ('one', 'two', 'three')]
+        self.assertEqual(self.put('rotate', items).status_code, 200)
+        self.client.post('/playlists/rotate/play')
+        shown = []
+
+        def record():
+            source = led.engine.content()
+            text = getattr(source, 'requested', {}).get('text')
+            if text and (not shown or shown[-1] != text):
+                shown.append(text)
+            return len(shown) >= 4
+        self.assertTrue(wait_until(record))
+        self.assertEqual(shown[:4], ['one', 'two', 'three', 'one'])
+
+    def test_once_mode_stops_at_the_end(self):
+        items = [{'type': 'text', 'text': 'only', 'font': FONT, 'speed': 0, 'duration': 0.1}]
+        self.assertEqual(self.put('once', items, mode='once').status_code, 200)
+        self.client.post('/playlists/once/play')
+        self.assertTrue(wait_until(lambda: led.scheduler.active is None))
+        self.assertEqual(led.engine.content().requested['text'], 'only')
+
+    def test_next_item_is_prepared_ahead(self):
+        # 下一条在当前条目播放期间就已构造好，切换时不再创建内容源
+        created, init = {}, led.TextSource.__init__
+
+        def recording_init(source, text, *args, **kwargs):
+            created[text] = time.monotonic()
+            init(source, text, *args, **kwargs)
+        items = [{'type': 'text', 'text': text, 'font': FONT, 'speed': 0, 'duration': 0.5} for text in ('first', 'second')]
+        with mock.patch.object(led.TextSource, '__init__', recording_init):
+            self.assertEqual(self.put('preload', items).status_code, 200)
+            self.client.post('/playlists/preload/play')
+            self.assertTrue(wait_until(lambda: getattr(led.engine.content(), 'requested', {}).get('text') == 'second'))
+            switched = time.monotonic()
+        self.assertLess(created['second'], switched - 0.3)
+
+    def test_time_windows(self):
+        day = {'start': '08:00', 'end': '18:00'}
+        night = {'start': '22:00', 'end': '06:30'}  # 跨午夜
+
+        def at(hour, minute=0):
+            return datetime.datetime(2026, 1, 2, hour, minute)
+        self.assertTrue(led.item_active(day, at(8)))
+        self.assertFalse(led.item_active(day, at(18)))
+        self.assertTrue(led.item_active(night, at(23, 59)))
+        self.assertTrue(led.item_active(night, at(6, 29)))
+        self.assertFalse(led.item_active(night, at(12)))
+        playlist = {'mode': 'loop', 'items': [dict(day, type='clock'), dict(night, type='clock'), {'type': 'clock'}]}
+        self.assertEqual(led.scheduler._pick(playlist, 0, at(12)), 2)  # 跳过不在时段内的条目
+        self.assertEqual(led.scheduler._pick(playlist, 2, at(23)), 1)
+
+class FrameReceiverTest(unittest.TestCase):
+    def exchange(self, *messages):
+        # 通过本机 TCP 连接把消息交给 FrameReceiver.handle，返回显示过的帧
+        shown = []
+        receiver = led.FrameReceiver(0, present=lambda counter, frame: shown.append((counter, frame)))
+        with socket.create_server(('127.0.0.1', 0)) as server:
+            ours = socket.create_connection(server.getsockname())
+            theirs, _ = server.accept()
+        with ours, theirs:
+            ours.sendall(b''.join(messages))
+            ours.shutdown(socket.SHUT_WR)
+            receiver.handle(theirs)
+        return shown
+
+    def header(self, kind, counter, height, width, tile, payload=b''):
+        return led.NODE_HEADER.pack(led.NODE_MAGIC, kind, counter, height, width, tile, len(payload)) + payload
+
+    def test_round_trip(self):
+        frame = np.random.default_rng(0).integers(0, 256, (32, 64, 3), dtype=np.uint8)
+        payload = led.TileDelta(32, 64, 16).encode(frame)
+        shown = self.exchange(self.header(led.NODE_DATA, 7, 32, 64, 16, payload),
+                              self.header(led.NODE_PRESENT, 7, 32, 64, 16))
+        self.assertEqual(len(shown), 1)
+        np.testing.assert_array_equal(shown[0][1], frame)
+
+    def test_rejects_bad_headers(self):
+        height, width = led.panel_geometry()
+        for geometry in ((height, width, 0), (height + 1, width, 16), (60000, 60000, 16), (0, width, 16)):
+            with self.subTest(geometry=geometry):
+                with self.assertRaises(ValueError):
+                    self.exchange(self.header(led.NODE_DATA, 1, *geometry, b'\0' * 16))
+
+    def test_rejects_decompression_bomb(self):
+        bitmap = np.packbits(np.ones(8, dtype=bool)).tobytes()
+        payload = bitmap + zlib.compress(b'\0' * (64 << 20))
+        with self.assertRaises(ValueError):
+            self.exchange(self.header(led.NODE_DATA, 1, 32, 64, 16, payload))
+
+class VideoFallbackTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        # 模拟没有安装矩阵绑定：视频交给外部的 video-viewer
+        saved = led.engine.backend_error
+        led.engine.backend_error = 'Backend rgbmatrix unavailable: test'
+        self.addCleanup(setattr, led.engine, 'backend_error', saved)
+
+    def played(self):
+        led.controller.submit('params', {}, wait=True)
+        return led.controller.process_command()
+
+    def test_video_uses_video_viewer(self):
+        self.assertEqual(self.client.get('/video/clip.mp4').status_code, 200)
+        command = self.played()
+        self.assertEqual(command[:3], ['video-viewer', '--led-slowdown-gpio=2', '-f'])
+        self.assertEqual(command[-1], os.path.join(led.UPLOAD_FOLDER, 'clip.mp4'))
+
+    def test_videourl_uses_video_viewer(self):
+        self.assertEqual(self.client.get('/videourl/http://example.com/a.mp4').status_code, 200)
+        self.assertEqual(self.played()[-1], 'http://example.com/a.mp4')
+
+    def test_batch_video_uses_video_viewer(self):
+        response = self.post('/batch', {'content': {'type': 'videourl', 'url': 'rtsp://camera/live'}})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.played()[0], 'video-viewer')
+
+class ImageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='cache-', dir=WORKDIR)
+        self.images = []
+        for i, color in enumerate(((0, 0, 255), (0, 255, 0), (255, 0, 0))):
+            path = os.path.join(self.folder, f'{i}.png')
+            cv2.imwrite(path, np.full((40, 80, 3), color, dtype=np.uint8))
+            self.images.append(path)
+
+    def cache(self, **kwargs):
+        return led.ImageCache(os.path.join(self.folder, '.cache'), **kwargs)
+
+    def test_frames_are_panel_sized_and_read_only(self):
+        cache = self.cache()
+        frame = cache.get(self.images[0])
+        self.assertEqual(frame.shape, led.panel_geometry() + (3,))
+        self.assertFalse(frame.flags.writeable)
+        self.assertEqual(tuple(frame[0, 0]), (255, 0, 0))  # BGR 文件转成 RGB
+        self.assertIs(cache.get(self.images[0]), frame)
+        self.assertEqual((cache.misses, cache.hits, cache.disk_hits), (1, 1, 0))
+
+    def test_memory_lru_falls_back_to_disk(self):
+        frame_bytes = int(np.prod(led.panel_geometry())) * 3
+        cache = self.cache(max_bytes=2 * frame_bytes)
+        for path in self.images:
+            cache.get(path)
+        self.assertEqual(len(cache.entries), 2)  # 最久未用的第一张被挤出内存
+        self.assertEqual(cache.size, 2 * frame_bytes)
+        np.testing.assert_array_equal(cache.get(self.images[0])[0, 0], (255, 0, 0))
+        self.assertEqual((cache.misses, cache.disk_hits), (3, 1))
+        # 新的缓存实例（相当于重启）直接从磁盘读取，不再解码
+        fresh = self.cache()
+        fresh.get(self.images[1])
+        self.assertEqual((fresh.misses, fresh.disk_hits), (0, 1))
+
+    def test_disk_budget_and_invalidation(self):
+        frame_bytes = int(np.prod(led.panel_geometry())) * 3
+        cache = self.cache(max_disk_bytes=int(frame_bytes * 1.5))
+        for path in self.images:
+            cache.get(path)
+        self.assertEqual(len([name for name in os.listdir(cache.folder) if name.endswith('.npy')]), 1)
+        # 文件内容变化后键随之变化，重新解码
+        cv2.imwrite(self.images[2], np.zeros((40, 80, 3), dtype=np.uint8))
+        os.utime(self.images[2], ns=(0, 10 ** 9))
+        self.assertEqual(tuple(cache.get(self.images[2])[0, 0]), (0, 0, 0))
+        self.assertEqual(cache.misses, 4)
+
+class ColorLUTTest(unittest.TestCase):
+    def reference(self, frame, brightness, rgb, gamma, rgb_order):
+        # 逐像素的直接计算：先按原始通道校色，再换通道顺序
+        values = np.power(frame / 255.0, gamma) * (brightness / 100.0) * np.array(rgb) * 255.0
+        values = np.clip(np.rint(values), 0, 255).astype(np.uint8)
+        return values[..., list(led.RGB_ORDERS[rgb_order])]
+
+    def test_identity_returns_the_same_frame(self):
+        lut = led.ColorLUT()
+        lut.update(100, (1, 1, 1), 1.0, 'regular')
+        frame = np.zeros((4, 4, 3), dtype=np.uint8)
+        self.assertIs(lut.apply(frame), frame)
+        self.assertFalse(lut.update(100, [1.0, 1.0, 1.0], 1, 'regular'))  # 参数没变不重建
+
+    def test_matches_direct_computation(self):
+        frame = np.random.default_rng(0).integers(0, 256, (16, 32, 3), dtype=np.uint8)
+        lut = led.ColorLUT()
+        for params in ((50, (1, 1, 1), 1.0, 'regular'), (100, (1.0, 0.5, 0.25), 1.0, 'regular'),
+                       (100, (1, 1, 1), 2.2, 'regular'), (80, (1.0, 0.8, 0.6), 1.8, 'bgr'),
+                       (100, (1, 1, 1), 1.0, 'grb'), (100, (2.0, 1, 1), 1.0, 'brg')):
+            with self.subTest(params=params):
+                self.assertTrue(lut.update(*params))
+                np.testing.assert_array_equal(lut.apply(frame), self.reference(frame, *params))
+
+def write_video(filename, frames=6, size=(80, 40)):
+    # 每帧一种纯色的小 MJPG 视频，帧序号编码在红色通道里
+    path = os.path.join(led.UPLOAD_FOLDER, filename)
+    os.makedirs(led.UPLOAD_FOLDER, exist_ok=True)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 10, size)
+    for i in range(frames):
+        writer.write(np.full((size[1], size[0], 3), (0, 0, 40 * i), dtype=np.uint8))
+    writer.release()
+    return path
+
+class RawVideoTest(unittest.TestCase):
+    def test_transcode_and_play(self):
+        write_video('raw.avi')
+        self.assertFalse(led.raw_video_ready('raw.avi'))
+        self.assertEqual(led.transcode_video('raw.avi'), 6)
+        self.assertEqual(led.read_raw_header(led.raw_video_path('raw.avi')), led.panel_geometry() + (10.0, 6))
+        display = led.video_display_for('raw.avi')
+        self.assertIsInstance(display, led.RawVideoDisplay)
+        source = display.output
+        reds = [int(source.next_frame(t)[0, 0, 0]) for t in (0, 0.15, 0.45)]
+        self.assertEqual([round(red / 40) for red in reds], [0, 1, 4])
+        self.assertIsNone(source.next_frame(0.48))  # 同一帧不重复输出
+        self.assertEqual((source.shown, source.dropped), (3, 2))
+        self.assertEqual(round(int(source.next_frame(0.75)[0, 0, 0]) / 40), 1)  # 播完后循环
+
+    def test_geometry_change_rebuilds(self):
+        write_video('rebuild.avi')
+        led.transcode_video('rebuild.avi')
+        display = led.video_display_for('rebuild.avi')
+        with mock.patch.dict(led.HARDWARE_CONFIG, cols=32):
+            # 容器按旧几何转码，不能再直接播放，重建后回退到解码播放
+            self.assertFalse(led.raw_video_ready('rebuild.avi'))
+            rebuilt = display.rebuild()
+            self.assertIsInstance(rebuilt, led.VideoDisplay)
+            self.assertEqual((rebuilt.height, rebuilt.width), led.panel_geometry())
+            led.transcode_video('rebuild.avi')
+            self.assertIsInstance(display.rebuild(), led.RawVideoDisplay)
+
+    def test_stale_container_is_ignored(self):
+        path = write_video('stale.avi')
+        led.transcode_video('stale.avi')
+        os.utime(path, (time.time() + 10, time.time() + 10))  # 源文件比容器新
+        self.assertFalse(led.raw_video_ready('stale.avi'))
+
+class UploadTest(AppTestCase):
+    def upload(self, name, data, path='/upload_image'):
+        return self.client.post(path, data={'file': (io.BytesIO(data), name)}, content_type='multipart/form-data')
+
+    def incoming(self):
+        # 接收中的临时文件，请求结束后应当都已清理
+        return os.listdir(led.UPLOAD_TMP_FOLDER) if os.path.isdir(led.UPLOAD_TMP_FOLDER) else []
+
+    def test_duplicate_content_is_stored_once(self):
+        data = cv2.imencode('.png', np.full((8, 8, 3), 7, dtype=np.uint8))[1].tobytes()
+        first = self.upload('dedup.png', data).json
+        self.assertEqual((first['success'], first['duplicate']), (True, False))
+        self.assertEqual(first['content_id'], hashlib.sha256(data).hexdigest())
+        second = self.upload('copy-of-dedup.png', data).json
+        self.assertEqual((second['filename'], second['duplicate']), ('dedup.png', True))
+        self.assertFalse(os.path.exists(os.path.join(led.UPLOAD_FOLDER, 'copy-of-dedup.png')))
+        # 同名但内容不同：保留两份，新文件名带内容 id 前缀
+        other = self.upload('dedup.png', data + b'\0').json
+        self.assertEqual(other['filename'], f"dedup-{other['content_id'][:8]}.png")
+        with open(os.path.join(led.UPLOAD_FOLDER, other['filename']), 'rb') as f:
+            self.assertEqual(f.read(), data + b'\0')
+
+    def test_too_large_is_rejected_without_leftovers(self):
+        with mock.patch.object(led, 'MAX_IMAGE_UPLOAD_BYTES', 1000):
+            response = self.upload('big.png', os.urandom(5000))
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(os.path.exists(os.path.join(led.UPLOAD_FOLDER, 'big.png')))
+        self.assertEqual(self.incoming(), [])
+
+    def test_rejects_disallowed_type(self):
+        response = self.upload('script.sh', b'echo hi')
+        self.assertFalse(response.json['success'])
+        self.assertEqual(self.incoming(), [])
+
+class MediaIndexTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        folder = tempfile.mkdtemp(prefix='media-', dir=WORKDIR)
+        for i in range(12):
+            with open(os.path.join(folder, f'img{i:02d}.png'), 'wb') as f:
+                f.write(b'x' * (i + 1))
+        for name in ('demo.mp4', 'other.avi', 'notes.txt'):
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(b'v')
+        self.folder = folder
+        self.index = led.MediaIndex(os.path.join(folder, '.media.db'), folder)
+        patcher = mock.patch.object(led, 'media_index', self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def media(self, query):
+        response = self.client.get('/media?' + query)
+        return response.status_code, response.json
+
+    def test_pagination_and_filters(self):
+        _, page = self.media('kind=image&offset=5&limit=4')
+        self.assertEqual(page['total'], 12)
+        self.assertEqual([item['filename'] for item in page['items']], ['img05.png', 'img06.png', 'img07.png', 'img08.png'])
+        _, page = self.media('q=demo')
+        self.assertEqual((page['total'], page['items'][0]['kind']), (1, 'video'))
+        _, page = self.media('kind=image&sort=size&desc=1&limit=2')
+        self.assertEqual([item['size'] for item in page['items']], [12, 11])
+        _, page = self.media('sort=filename;DROP TABLE media&limit=1')  # 未知排序列按文件名
+        self.assertEqual((page['total'], page['items'][0]['filename']), (14, 'demo.mp4'))
+
+    def test_follows_directory_changes(self):
+        self.assertEqual(self.media('kind=video')[1]['total'], 2)
+        os.remove(os.path.join(self.folder, 'demo.mp4'))
+        with open(os.path.join(self.folder, 'new.mp4'), 'wb') as f:
+            f.write(b'n')
+        os.utime(self.folder, ns=(0, time.time_ns() + 10 ** 9))  # 保证目录 mtime 变化
+        self.assertEqual(self.index.names('video'), ['new.mp4', 'other.avi'])
+
+    def test_rejects_bad_arguments(self):
+        for query in ('limit=abc', 'offset=x', 'kind=audio'):
+            with self.subTest(query=query):
+                self.assertEqual(self.media(query)[0], 400)
+
+TINY_BDF = """STARTFONT 2.1
+FONTBOUNDINGBOX 3 2 0 0
+STARTPROPERTIES 2
+FONT_ASCENT 4
+FONT_DESCENT 1
+ENDPROPERTIES
+CHARS 2
+STARTCHAR A
+ENCODING 65
+DWIDTH 5 0
+BBX 3 2 1 0
+BITMAP
+A0
+40
+ENDCHAR
+STARTCHAR question
+ENCODING 63
+DWIDTH 3 0
+BBX 2 1 0 1
+BITMAP
+C0
+ENDCHAR
+ENDFONT
+"""
+
+class FontTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='fonts-', dir=WORKDIR)
+        self.path = os.path.join(self.folder, 'tiny.bdf')
+        with open(self.path, 'w') as f:
+            f.write(TINY_BDF)
+
+    def test_parse_and_draw(self):
+        atlas = led.parse_bdf(self.path)
+        self.assertEqual((atlas.ascent, atlas.descent, atlas.height), (4, 1, 5))
+        self.assertEqual(atlas.glyph(atlas.lookup('A')).tolist(), [[True, False, True], [False, True, False]])
+        self.assertEqual(atlas.lookup('Z'), atlas.lookup('?'))  # 缺字用问号
+        self.assertEqual(atlas.text_width('AZ'), 8)
+        canvas = np.zeros((5, 8, 3), dtype=np.uint8)
+        self.assertEqual(atlas.draw(canvas, 'AA', 0, 0, (9, 9, 9)), 10)
+        # 基线在第 4 行，两行高的字形占第 2、3 行，x 偏移 1；第二个字形只画得下一部分
+        expected = np.zeros((5, 8), dtype=bool)
+        expected[2, [1, 3, 6]] = expected[3, [2, 7]] = True
+        np.testing.assert_array_equal(canvas[..., 0] == 9, expected)
+
+    def test_registry_caches_until_files_change(self):
+        registry = led.FontRegistry(self.folder)
+        self.assertEqual(registry.list(), ['tiny.bdf'])
+        atlas = registry.get('tiny.bdf')
+        self.assertIs(registry.get('tiny.bdf'), atlas)
+        with open(self.path, 'w') as f:
+            f.write(TINY_BDF.replace('DWIDTH 5 0', 'DWIDTH 6 0'))
+        os.utime(self.path, (time.time() + 5, time.time() + 5))
+        self.assertEqual(registry.get('tiny.bdf').text_width('A'), 6)
+        open(os.path.join(self.folder, 'other.ttf'), 'w').close()
+        os.utime(self.folder, ns=(0, time.time_ns() + 10 ** 9))
+        self.assertEqual(registry.list(), ['other.ttf', 'tiny.bdf'])
+        with self.assertRaises(ValueError):
+            registry.get('other.ttf')
+
+class TextSourceTest(unittest.TestCase):
+    def expected(self, text, x, y, color):
+        canvas = np.zeros(led.panel_geometry() + (3,), dtype=np.uint8)
+        led.font_registry.get(FONT).draw(canvas, text, x, y, color)
+        return canvas
+
+    def test_static_text(self):
+        source = led.TextSource('Hi', FONT, (255, 0, 0), 0, x=3, y=2)
+        np.testing.assert_array_equal(source.next_frame(0), self.expected('Hi', 3, 2, (255, 0, 0)))
+        self.assertIsNone(source.next_frame(1))  # 静止文字只输出一次
+
+    def test_scrolls_by_slicing_the_strip(self):
+        text = 'hello world'
+        source = led.TextSource(text, FONT, (0, 255, 0), 2, y=1)
+        strip, period, pixels_per_second = source.layout
+        width = led.panel_geometry()[1]
+        self.assertEqual(period, led.font_registry.get(FONT).text_width(text) + width)
+        self.assertEqual(pixels_per_second, 2 * 6)  # 每秒两个字符，测试字体字宽 6
+        for now in (0, 1, 5.5, 9.0, 12.25):
+            frame = source.next_frame(now)
+            self.assertTrue(np.shares_memory(frame, strip))  # 视图，不拷贝
+            offset = int(now * pixels_per_second) % period
+            expected = self.expected(text, -offset, 1, (0, 255, 0))
+            led.font_registry.get(FONT).draw(expected, text, period - offset, 1, (0, 255, 0))  # 绕回的开头
+            np.testing.assert_array_equal(frame, expected)
+        self.assertIsNone(source.next_frame(12.25))
+
+    def test_live_update_keeps_position(self):
+        source = led.TextSource('abc', FONT, (0, 0, 255), 1)
+        source.next_frame(0)
+        source.next_frame(2)
+        source.update(text='xyz', color=(255, 255, 255))
+        source.apply_pending()
+        frame = source.next_frame(2)
+        np.testing.assert_array_equal(frame, self.expected('xyz', -12, 0, (255, 255, 255)))
+
+class FakeClock:
+    """替换 led_web_test 里的 time 模块：time() 返回设定的时刻，其余函数照常（引擎线程仍在运行）"""
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class ClockSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(datetime.datetime(2026, 1, 2, 12, 0, 8).timestamp())
+        patcher = mock.patch.object(led, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.atlas = led.font_registry.get(FONT)
+
+    def expected(self, moment):
+        canvas = np.zeros(led.panel_geometry() + (3,), dtype=np.uint8)
+        self.atlas.draw(canvas, moment.strftime('%H:%M:%S'), 0, 0, (255, 255, 0))
+        self.atlas.draw(canvas, moment.strftime('%Y-%m-%d'), 0, self.atlas.height, (255, 255, 0))
+        return canvas
+
+    def test_redraws_only_changed_cells(self):
+        source = led.ClockSource(FONT, (255, 255, 0))
+        np.testing.assert_array_equal(source.next_frame(0), self.expected(datetime.datetime(2026, 1, 2, 12, 0, 8)))
+        self.assertEqual(source.dirty[0], (0, 0) + led.panel_geometry()[::-1])  # 首帧整屏
+        self.assertIsNone(source.next_frame(0.5))  # 同一秒内不重绘
+        self.clock.now += 1
+        frame = source.next_frame(1)
+        self.assertEqual(source.dirty, [(7 * 6, 0, 6, self.atlas.height)])  # 只有秒的个位
+        np.testing.assert_array_equal(frame, self.expected(datetime.datetime(2026, 1, 2, 12, 0, 9)))
+        self.clock.now += 1
+        frame = source.next_frame(2)
+        self.assertEqual(source.dirty, [(6 * 6, 0, 6, self.atlas.height), (7 * 6, 0, 6, self.atlas.height)])
+        np.testing.assert_array_equal(frame, self.expected(datetime.datetime(2026, 1, 2, 12, 0, 10)))
+
+    def test_date_line_changes_at_midnight(self):
+        self.clock.now = datetime.datetime(2026, 1, 2, 23, 59, 59).timestamp()
+        source = led.ClockSource(FONT, (255, 255, 0))
+        source.next_frame(0)
+        self.clock.now += 1
+        frame = source.next_frame(1)
+        np.testing.assert_array_equal(frame, self.expected(datetime.datetime(2026, 1, 3, 0, 0, 0)))
+        self.assertIn((9 * 6, self.atlas.height, 6, self.atlas.height), source.dirty)  # 日期的个位
+
+class GateSource(led.ContentSource):
+    """构造时等待闸门打开的内容源，用来让控制器线程停住、积压命令"""
+    def __init__(self, gate):
+        gate.wait(5)
+        super().__init__()
+
+class CoalescingTest(AppTestCase):
+    def hold(self):
+        # 控制器线程卡在一个内容源的构造里，之后提交的命令全部积压成一批
+        gate = threading.Event()
+        led.controller.submit('source', (GateSource, {'gate': gate}, None))
+        self.assertTrue(wait_until(lambda: led.controller.commands.qsize() == 0))
+        return gate
+
+    def text(self, text, wait=False):
+        params = dict(text=text, font=FONT, color=(255, 255, 255), speed=0)
+        return led.controller.submit('source', (led.TextSource, params, None), wait=wait)
+
+    def test_only_last_switch_runs(self):
+        before = led.controller.stats()
+        gate = self.hold()
+        created, init = [], led.TextSource.__init__
+
+        def counting_init(source, text, *args, **kwargs):
+            created.append(text)
+            init(source, text, *args, **kwargs)
+        with mock.patch.object(led.TextSource, '__init__', counting_init):
+            for i in range(20):
+                self.text(f'n{i}')
+            led.controller.submit('params', {'x': 5})
+            last = led.controller.submit('params', {'y': 1})
+            gate.set()
+            last[3].wait(5)
+        self.assertEqual(created, ['n19'])  # 被取代的切换连内容源都不会创建
+        source = led.engine.content()
+        self.assertEqual((source.requested['text'], source.requested['x'], source.requested['y']), ('n19', 5, 1))
+        after = led.controller.stats()
+        self.assertEqual(after['submitted'] - before['submitted'], 23)
+        self.assertEqual(after['executed'] - before['executed'], 3)  # 闸门、最后一条切换、合并后的参数更新
+        self.assertEqual(after['coalesced'] - before['coalesced'], 20)
+
+    def test_power_commands_follow_content(self):
+        gate = self.hold()
+        led.controller.submit('off')
+        self.text('on again')
+        gate.set()
+        self.text('sync', wait=True)
+        self.assertIsNone(led.engine.paused_source)  # 新内容取代了之前的关屏
+        gate = self.hold()
+        self.text('then off')
+        command = led.controller.submit('off')
+        gate.set()
+        command[3].wait(5)
+        self.assertEqual(led.engine.paused_source.requested['text'], 'then off')
+        led.controller.submit('on', wait=True)
+        self.assertEqual(led.engine.content().requested['text'], 'then off')
+
+class BatchTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(self.settle, {'hardware': {'cols': led.HARDWARE_CONFIG['cols']},
+                                      'color': {'brightness': led.COLOR_CONFIG['brightness']}})
+
+    def settle(self, batch):
+        self.assertEqual(self.post('/batch', batch).status_code, 200)
+        led.controller.submit('params', {}, wait=True)
+
+    def shown(self, width):
+        # 引擎按新几何输出了画面
+        backend = led.engine.backend
+        return backend is not None and backend.width == width and backend.frame.any()
+
+    def test_invalid_section_rejects_whole_batch(self):
+        hardware, brightness = dict(led.HARDWARE_CONFIG), led.COLOR_CONFIG['brightness']
+        response = self.post('/batch', {'hardware': {'cols': 32}, 'color': {'brightness': 7},
+                                        'content': {'type': 'image', 'file': 'missing.png'}, 'extra': 1})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(response.json['errors']), 2)
+        led.controller.submit('params', {}, wait=True)
+        self.assertEqual(led.HARDWARE_CONFIG, hardware)
+        self.assertEqual(led.COLOR_CONFIG['brightness'], brightness)
+
+    def test_geometry_and_content_apply_together(self):
+        inits = led.engine.backend_inits
+        self.settle({'hardware': {'cols': 32}, 'color': {'brightness': 80},
+                     'content': {'type': 'text', 'text': 'wide', 'speed': 0}})
+        source = led.engine.content()
+        self.assertEqual((source.requested['text'], source.width), ('wide', 32))
+        self.assertEqual(led.COLOR_CONFIG['brightness'], 80)
+        self.assertTrue(wait_until(lambda: self.shown(32)))
+        self.assertEqual(led.engine.backend_inits - inits, 1)  # 后端只重新初始化一次
+
+    def test_geometry_change_rebuilds_current_content(self):
+        self.assertEqual(self.post('/text', {'text': 'keep', 'color': '#ffffff', 'speed': 0}).status_code, 200)
+        led.controller.submit('params', {}, wait=True)
+        before = led.engine.content()
+        self.settle({'hardware': {'cols': 32}})
+        source = led.engine.content()
+        self.assertIsNot(source, before)
+        self.assertEqual((source.requested['text'], source.width), ('keep', 32))
+        self.assertTrue(wait_until(lambda: self.shown(32)))
+
+class StatusEventsTest(AppTestCase):
+    def events(self):
+        response = self.client.get('/events', buffered=False)
+        self.addCleanup(response.close)
+        chunks = iter(response.response)
+
+        def read():
+            event, version, data = next(chunks).decode().strip().split('\n')
+            return event[len('event: '):], int(version[len('id: '):]), json.loads(data[len('data: '):])
+        return read
+
+    def test_state_then_only_changed_keys(self):
+        read = self.events()
+        event, version, state = read()
+        self.assertEqual(event, 'state')
+        self.assertTrue({'content', 'color', 'hardware', 'fps', 'errors'} <= set(state))
+        self.assertGreaterEqual(led.status_hub.subscribers, 1)
+        brightness = led.COLOR_CONFIG['brightness']
+        self.addCleanup(self.client.get, f'/brightness/{brightness}')
+        self.client.get(f'/brightness/{brightness // 2 + 1}')
+        event, new_version, changes = read()
+        while 'color' not in changes:  # 帧率等采样值可能先变化
+            event, new_version, changes = read()
+        self.assertEqual(event, 'diff')
+        self.assertGreater(new_version, version)
+        self.assertEqual(changes['color']['brightness'], brightness // 2 + 1)
+        self.assertNotIn('hardware', changes)
+
+    def test_slow_subscriber_gets_merged_changes(self):
+        version, state = led.status_hub.subscribe()
+        self.addCleanup(led.status_hub.unsubscribe)
+        self.assertEqual(led.status_hub.wait(version, timeout=0.05)[1], {})  # 没有变化时超时返回空差异
+        self.post('/text', {'text': 'a', 'color': '#ffffff', 'speed': 0})
+        led.controller.submit('params', {}, wait=True)
+        self.post('/text', {'text': 'b', 'color': '#ffffff', 'speed': 0})
+        led.controller.submit('params', {}, wait=True)
+        led.status_hub.sample()
+        _, changes = led.status_hub.wait(version, timeout=1)
+        self.assertEqual(changes['content']['params']['text'], 'b')  # 两次变化合并为最新状态
+
+class PreviewTest(AppTestCase):
+    def test_encodes_only_changed_frames_while_watched(self):
+        stream = led.PreviewStream(fps=1000, scale=2)
+        height, width = led.panel_geometry()
+        red = np.zeros((height, width, 3), dtype=np.uint8)
+        red[:, :width // 2] = (255, 0, 0)
+        stream.offer(red)
+        self.assertIsNone(stream.pending)  # 没有观看者时引擎线程什么都不做
+        stream.subscribe()
+        self.addCleanup(stream.unsubscribe)
+        self.assertTrue(wait_until(lambda: stream.encoded == 1))  # 起始画面：空屏时为黑屏
+        time.sleep(0.002)
+        stream.offer(np.zeros((height, width, 3), dtype=np.uint8))
+        self.assertTrue(wait_until(lambda: stream.skipped == 1))
+        time.sleep(0.002)
+        stream.offer(red)
+        self.assertTrue(wait_until(lambda: stream.encoded == 2))
+        image = cv2.cvtColor(cv2.imdecode(np.frombuffer(stream.jpeg, np.uint8), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+        self.assertEqual(image.shape, (height * 2, width * 2, 3))
+        expected = cv2.resize(led.color_lut.apply(red), None, fx=2, fy=2, interpolation=cv2.INTER_NEAREST)
+        self.assertLess(np.abs(image.astype(int) - expected).mean(), 8)
+
+    def test_route_streams_jpeg_parts(self):
+        response = self.client.get('/preview', buffered=False)
+        self.addCleanup(response.close)
+        self.assertEqual(response.mimetype, 'multipart/x-mixed-replace')
+        part = next(iter(response.response))
+        head, _, jpeg = part.partition(b'\r\n\r\n')
+        self.assertTrue(head.startswith(b'--frame\r\nContent-Type: image/jpeg'))
+        self.assertTrue(jpeg.startswith(b'\xff\xd8'))
+
+class TransitionTest(unittest.TestCase):
+    def transition(self, effect, budget=1.0):
+        height, width = led.panel_geometry()
+        outgoing = np.full((height, width, 3), 200, dtype=np.uint8)
+        return led.TransitionSource(outgoing, led.SolidColorSource((0, 100, 40)), effect, 1.0, budget)
+
+    def test_crossfade_blends_into_double_buffers(self):
+        source = self.transition('crossfade')
+        frames = []
+        for t in (0, 0.25, 0.5):
+            frames.append(source.next_frame(10 + t))
+            expected = 200 * (1 - t) + np.array([0, 100, 40]) * t
+            self.assertLessEqual(np.abs(frames[-1][0, 0] - expected).max(), 1)
+        self.assertFalse(np.shares_memory(frames[1], frames[2]))  # 引擎还持有上一帧时写另一块缓冲
+        self.assertTrue(np.shares_memory(frames[0], frames[2]))
+        final = source.next_frame(11.0)
+        self.assertTrue(source.finished)
+        self.assertIs(final, source.incoming.frame)
+
+    def test_wipe_slide_dissolve(self):
+        width = led.panel_geometry()[1]
+        wipe = self.transition('wipe')
+        wipe.next_frame(0)
+        frame = wipe.next_frame(0.25)
+        self.assertEqual(tuple(frame[0, width // 4 - 1]), (0, 100, 40))
+        self.assertEqual(tuple(frame[0, width // 4]), (200, 200, 200))
+        slide = self.transition('slide')
+        slide.next_frame(0)
+        frame = slide.next_frame(0.75)
+        self.assertEqual(int((frame[0, :, 1] == 100).sum()), int(0.75 * width))
+        self.assertEqual(tuple(frame[0, -1]), (0, 100, 40))
+        dissolve = self.transition('dissolve')
+        dissolve.next_frame(0)
+        frame = dissolve.next_frame(0.5)
+        self.assertEqual(int((frame[..., 1] == 100).sum()), frame.shape[0] * frame.shape[1] // 2)
+
+    def test_over_budget_cuts_to_incoming(self):
+        source = self.transition('crossfade', budget=0)
+        source.next_frame(0)
+        source.next_frame(0.1)
+        self.assertIs(source.next_frame(0.2), source.incoming.frame)
+        self.assertTrue(source.finished)
+
+    def test_validation(self):
+        self.assertEqual(led.validate_transition({'effect': 'wipe', 'duration': 1}), {'effect': 'wipe', 'duration': 1.0})
+        for data in ({'effect': 'spin'}, {'duration': -1}, {'duration': 6}, {'duration': float('nan')}):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    led.validate_transition(data)
+
+class BenchmarkTest(unittest.TestCase):
+    def test_quick_run_reports_every_case(self):
+        output = os.path.join(WORKDIR, 'bench.json')
+        subprocess.run([sys.executable, led_benchmark.__file__, '--quick', '--geometries', '64x32', '--repeats', '2',
+                        '--duration', '0.3', '--output', output], check=True, capture_output=True, timeout=300)
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual(report['meta']['backend'], 'framebuffer')
+        cases = {result['case'] for result in report['results']}
+        self.assertTrue({'text', 'clock'} <= cases)
+        for result in report['results']:
+            with self.subTest(case=result['case']):
+                self.assertEqual((result['geometry'], result['failures']), ('64x32', 0))
+                self.assertGreater(result['switch_ms']['p50'], 0)
+
+    def test_compare_flags_regressions(self):
+        def result(case, p99, fps):
+            return {'geometry': '64x32', 'case': case, 'switch_ms': {'p99': p99}, 'fps': fps}
+        baseline = os.path.join(WORKDIR, 'baseline.json')
+        with open(baseline, 'w') as f:
+            json.dump({'results': [result('text', 2.0, 30), result('image', 5.0, 30)]}, f)
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            regressions = led_benchmark.compare([result('text', 2.3, 29), result('image', 7.0, 20),
+                                                 result('video', 50.0, 1)], baseline, 0.2)
+        self.assertEqual(regressions, 1)  # 只有 image 超出阈值；基线里没有的 video 不比较
+        self.assertIn('REGRESSION 64x32 image', out.getvalue())
+
+class MetricsTest(AppTestCase):
+    def test_histogram_and_render_format(self):
+        registry = led.Metrics()
+        histogram = registry.histogram('test_seconds', 'Test latency', (0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value)
+        registry.collect('test_missing', 'Not available yet', lambda: None)
+        registry.collect('test_broken', 'Raises', lambda: 1 / 0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            text = registry.render()
+        self.assertEqual(text.splitlines(), [
+            '# HELP test_seconds Test latency', '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 2', 'test_seconds_bucket{le="1.0"} 3', 'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 3.65', 'test_seconds_count 4',
+            '# HELP test_missing Not available yet', '# TYPE test_missing gauge'])
+
+    def test_counter_is_thread_safe(self):
+        counter = led.Counter('test_total', 'Test')
+        threads = [threading.Thread(target=lambda: [counter.inc() for _ in range(10000)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.value, 40000)
+
+    def scrape(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        return dict(line.rsplit(' ', 1) for line in response.get_data(as_text=True).splitlines()
+                    if not line.startswith('#'))
+
+    def test_endpoint_reports_switches(self):
+        before = float(self.scrape().get('led_switch_seconds_count', 0))
+        self.post('/text', {'text': 'metrics', 'color': '#ffffff', 'speed': 0})
+        self.assertTrue(wait_until(lambda: float(self.scrape()['led_switch_seconds_count']) > before))
+        values = self.scrape()
+        for name in ('led_frames_shown_total', 'led_frame_render_seconds_count', 'led_command_queue_depth',
+                     'led_image_cache_bytes'):
+            self.assertIn(name, values)
+
+class TiledRendererTest(AppTestCase):
+    LAYOUTS = [
+        dict(chain=2, chain_rows=2, serpentine=True),
+        dict(chain=4, parallel=2, chain_rows=2, serpentine=True, rotation=90),
+        dict(chain=2, rotation=180),
+        dict(chain=3, parallel=2),
+        dict(chain=2, rotation=270),
+    ]
+
+    def setUp(self):
+        super().setUp()  # 引擎空闲，下面临时修改硬件配置不影响它
+        self.lut = led.ColorLUT()
+        patcher = mock.patch.object(led, 'color_lut', self.lut)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def layout(self, **config):
+        defaults = dict(chain=1, parallel=1, chain_rows=1, serpentine=False, rotation=0)
+        patcher = mock.patch.dict(led.HARDWARE_CONFIG, dict(defaults, **config))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return np.random.default_rng(1).integers(0, 256, led.panel_geometry() + (3,), dtype=np.uint8)
+
+    def test_serpentine_fold(self):
+        # 两块面板的链折成两行，第二块倒装：物理右半边是逻辑下半部分旋转 180°
+        self.lut.update(100, (1, 1, 1), 1.0, 'regular')
+        frame = self.layout(chain=2, chain_rows=2, serpentine=True)
+        self.assertEqual(frame.shape[:2], (64, 64))
+        out, tiles = led.TileRenderer(workers=1).render(frame)
+        self.assertIsNone(tiles)
+        np.testing.assert_array_equal(out[:, :64], frame[:32])
+        np.testing.assert_array_equal(out[:, 64:], frame[32:][::-1, ::-1])
+
+    def test_parallel_tiles_match_reference(self):
+        self.lut.update(70, (1.0, 0.8, 0.5), 2.2, 'bgr')
+        for config in self.LAYOUTS:
+            with self.subTest(config=config):
+                frame = self.layout(**config)
+                mapping = led.layout_map(led.HARDWARE_CONFIG)
+                expected = self.lut.apply(frame)
+                if mapping is not None:
+                    expected = expected[mapping[..., 1], mapping[..., 0]]
+                serial = led.TileRenderer(workers=1).render(frame)[0].copy()
+                parallel = led.TileRenderer(workers=4, min_pixels=0)
+                np.testing.assert_array_equal(serial, expected)
+                np.testing.assert_array_equal(parallel.render(frame)[0], expected)
+                self.assertEqual(parallel.stats()['tiles'], config.get('chain', 1) * config.get('parallel', 1))
+
+    def test_skips_unchanged_frames_and_tiles(self):
+        self.lut.update(100, (1, 1, 1), 1.0, 'regular')
+        frame = self.layout(chain=2)
+        renderer = led.TileRenderer(workers=1)
+        self.assertIsNone(renderer.render(frame)[1])  # 首帧整帧输出
+        self.assertEqual(renderer.render(frame.copy()), (None, []))
+        changed = frame.copy()
+        changed[5, 70] += 1
+        out, tiles = renderer.render(changed)
+        self.assertEqual(tiles, [(0, 32, 64, 128)])  # 只有第二块面板
+        self.assertIs(out, changed)  # 恒等排布不拷贝
+        renderer.invalidate()
+        self.assertIsNone(renderer.render(changed)[1])
+        self.assertEqual((renderer.frames_skipped, renderer.tiles_skipped), (1, 3))
+
+    def test_trusts_dirty_rectangles_of_the_same_source(self):
+        self.lut.update(100, (1, 1, 1), 1.0, 'regular')
+        frame = self.layout(chain=2)
+        renderer = led.TileRenderer(workers=1)
+        source = led.ContentSource()
+        renderer.render(frame, source)
+        changed = frame.copy()
+        changed[0, 0] += 1
+        changed[0, 100] += 1
+        source.dirty = [(96, 0, 8, 8)]  # 内容源只报告了右边的变化
+        self.assertEqual(renderer.render(changed, source)[1], [(0, 32, 64, 128)])
+        # 换了内容源，脏矩形不可信，整帧比较后补上左边漏掉的变化
+        other = led.ContentSource()
+        other.dirty = [(96, 0, 8, 8)]
+        self.assertEqual(renderer.render(changed, other)[1], [(0, 32, 0, 64)])
+
+class SharedFramesTest(AppTestCase):
+    def frames(self, count, seed=0):
+        height, width = led.panel_geometry()
+        return list(np.random.default_rng(seed).integers(0, 256, (count, height, width, 3), dtype=np.uint8))
+
+    def test_external_writer_reaches_the_panel(self):
+        response = self.client.post('/shared', json={})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json['height'], response.json['width']), led.panel_geometry())
+        writer = SharedFrameWriter(response.json['path'])
+        frame = self.frames(1)[0]
+        writer.publish(frame)
+        expected = led.color_lut.apply(frame)
+        self.assertTrue(wait_until(lambda: led.engine.backend is not None and
+                                   np.array_equal(led.engine.backend.frame, expected)))
+
+    def test_reader_slot_is_never_overwritten(self):
+        path = os.path.join(WORKDIR, 'handoff-frames')
+        source = led.SharedFrameSource(path)
+        writer = SharedFrameWriter(path)
+        frames = self.frames(8, seed=1)
+        writer.publish(frames[0])
+        held = source.next_frame(0)
+        for frame in frames[1:]:
+            writer.publish(frame)  # 读端一直持有第一帧，写端只能轮流使用另外两个槽位
+        np.testing.assert_array_equal(held, frames[0])
+        self.assertFalse(held.flags.writeable)
+        np.testing.assert_array_equal(source.next_frame(0), frames[-1])
+        self.assertIsNone(source.next_frame(0))  # 没有新帧
+        self.assertEqual(source.stats()['superseded'], 6)
+        self.assertEqual(source.stats()['received'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""点阵屏基准测试：通过 Flask 测试客户端驱动 led_web_test，在软件帧缓冲后端上测量
+各类内容从 HTTP 请求到第一帧的切换延迟、持续帧率、丢帧与 CPU 时间，结果写成 JSON 便于对比回归。
+--http-upload 模式则在子进程里启动真实的 HTTP 服务，上传大文件的同时测量控制接口的响应延迟。
+
+    python3 led_benchmark.py --output bench.json
+    python3 led_benchmark.py --quick --compare bench.json
+    python3 led_benchmark.py --http-upload 500 --servers pooled werkzeug
+"""
+import argparse, http.client, json, os, platform, socket, subprocess, sys, tempfile, threading, time
+
+# 必须在导入 led_web_test 之前设置：软件帧缓冲、关闭上传后台转码，避免干扰测量
+os.environ['LED_BACKEND'] = 'framebuffer'
+os.environ['LED_TRANSCODE_ON_UPLOAD'] = '0'
+
+import cv2
+import numpy as np
+
+# 面板几何 (rows, cols, chain, parallel)，从单块 64×32 到 chain=4 × parallel=3
+GEOMETRIES = {
+    '64x32': (32, 64, 1, 1),
+    '64x32-c2': (32, 64, 2, 1),
+    '64x32-c4': (32, 64, 4, 1),
+    '64x32-c4p3': (32, 64, 4, 3),
+}
+IMAGE_SIZES = {'small': (64, 32), 'vga': (640, 480), '1080p': (1920, 1080)}
+VIDEO_SIZES = {'qvga': (320, 240), '720p': (1280, 720)}
+VIDEO_FPS = 30
+VIDEO_SECONDS = 4
+BENCH_FONT = 'bench.bdf'
+
+def write_bdf(path, width=6, height=10):
+    # 生成固定的合成 BDF 字体，保证没有字体目录时结果也可复现
+    rng = np.random.default_rng(0)
+    lines = ['STARTFONT 2.1', 'FONT bench', f'SIZE {height} 75 75',
+             f'FONTBOUNDINGBOX {width} {height} 0 -2', 'STARTPROPERTIES 2',
+             'FONT_ASCENT 8', 'FONT_DESCENT 2', 'ENDPROPERTIES', 'CHARS 95']
+    for code in range(32, 127):
+        bits = rng.integers(0, 2, (height, width)) if code != 32 else np.zeros((height, width), int)
+        lines += [f'STARTCHAR U+{code:04X}', f'ENCODING {code}', 'SWIDTH 500 0', f'DWIDTH {width} 0',
+                  f'BBX {width} {height} 0 -2', 'BITMAP']
+        lines += ['%02X' % int(''.join(map(str, row)).ljust(8, '0'), 2) for row in bits]
+        lines.append('ENDCHAR')
+    lines.append('ENDFONT')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def write_media(folder):
+    # 确定性的测试图片与视频，文件名里带尺寸
+    rng = np.random.default_rng(1)
+    images, videos = {}, {}
+    for label, (w, h) in IMAGE_SIZES.items():
+        for variant in 'ab':
+            name = f'bench-{label}-{variant}.png'
+            cv2.imwrite(os.path.join(folder, name), rng.integers(0, 256, (h, w, 3), dtype=np.uint8))
+        images[label] = (f'bench-{label}-a.png', f'bench-{label}-b.png')
+    for label, (w, h) in VIDEO_SIZES.items():
+        name = f'bench-{label}.avi'
+        writer = cv2.VideoWriter(os.path.join(folder, name), cv2.VideoWriter_fourcc(*'MJPG'), VIDEO_FPS, (w, h))
+        base = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        for i in range(VIDEO_FPS * VIDEO_SECONDS):
+            writer.write(np.roll(base, i * 4, axis=1))
+        writer.release()
+        videos[label] = name
+    return images, videos
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p99': None, 'mean': None}
+    values = np.asarray(values) * 1000
+    return {'p50': float(np.percentile(values, 50)), 'p99': float(np.percentile(values, 99)),
+            'mean': float(values.mean())}
+
+class Bench:
+    def __init__(self, app, args):
+        self.led = app
+        self.args = args
+        self.client = app.app.test_client()
+
+    def set_geometry(self, rows, cols, chain, parallel):
+        led = self.led
+        config = {'rows': rows, 'cols': cols, 'chain': chain, 'parallel': parallel}
+        response = self.client.post('/hardware', json=config)
+        assert response.json['success'], response.json
+        led.controller.submit('stop', wait=True)  # 等待配置命令执行完
+
+    def wait_first_frame(self, timeout):
+        # 引擎输出切换后的第一帧时会记录一条切换延迟
+        deadline = time.perf_counter() + timeout
+        while not self.led.engine.switch_latencies:
+            if time.perf_counter() > deadline:
+                return False
+            time.sleep(0.0002)
+        return True
+
+    def run_case(self, name, switch):
+        # switch(i) 发出第 i 次切换请求；每次切换前先清空内容，测量的是从空屏切入的完整路径
+        led = self.led
+        e2e, internal, failures = [], [], 0
+        for i in range(self.args.repeats + 1):
+            led.controller.submit('stop', wait=True)
+            led.engine.switch_latencies.clear()
+            started = time.perf_counter()
+            switch(i)
+            if not self.wait_first_frame(self.args.timeout):
+                failures += 1
+                continue
+            if i == 0:
+                continue  # 第一次切换包含缓存预热与后端初始化，不计入
+            e2e.append(time.perf_counter() - started)
+            internal.append(led.engine.switch_latencies[0])
+        # 持续播放阶段：帧率、丢帧与整个进程的 CPU 时间
+        producer = led.controller.producer
+        before = producer.stats() if hasattr(producer, 'stats') else {}
+        frames, cpu, wall = led.engine.frames_shown, time.process_time(), time.perf_counter()
+        time.sleep(self.args.duration)
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        after = producer.stats() if hasattr(producer, 'stats') else {}
+        return {
+            'case': name,
+            'switch_ms': percentiles(e2e),
+            'engine_switch_ms': percentiles(internal),
+            'failures': failures,
+            'fps': (led.engine.frames_shown - frames) / wall,
+            'dropped': after.get('dropped', 0) - before.get('dropped', 0),
+            'late': after.get('late', 0) - before.get('late', 0),
+            'cpu_seconds': cpu,
+            'cpu_percent': cpu / wall * 100,
+        }
+
+    def cases(self, images, videos):
+        client = self.client
+        texts = ('Hello LED matrix benchmark', 'Another line of scrolling text')
+        yield 'text', lambda i: client.post('/text', json={'text': texts[i % 2], 'color': '#00ff00', 'speed': 5})
+        yield 'clock', lambda i: client.post('/clock', json={'color': '#ffff00'})
+        for label, pair in images.items():
+            yield f'image-{label}', lambda i, pair=pair: client.get(f'/image/{pair[i % 2]}')
+        for label, name in videos.items():
+            yield f'video-{label}', lambda i, name=name: client.get(f'/video/{name}')
+        if not self.args.quick:
+            for label, name in videos.items():
+                yield f'video-{label}-raw', lambda i, name=name: client.get(f'/video/{name}')
+
+    def run(self, images, videos):
+        led = self.led
+        self.client.get(f'/set_text_font/{BENCH_FONT}')
+        self.client.get(f'/set_clock_font/{BENCH_FONT}')
+        results = []
+        for geometry in self.args.geometries:
+            self.set_geometry(*GEOMETRIES[geometry])
+            for name, switch in self.cases(images, videos):
+                if name.endswith('-raw'):
+                    # 原始帧容器：按当前几何预先转码，播放时直接 memmap
+                    led.transcode_video(videos[name.split('-')[1]])
+                result = self.run_case(name, switch)
+                result['geometry'] = geometry
+                result['panel'] = list(led.panel_geometry())
+                results.append(result)
+                print(f"{geometry:>12} {name:<18} switch p50 {fmt(result['switch_ms']['p50'])} "
+                      f"p99 {fmt(result['switch_ms']['p99'])} ms  fps {result['fps']:6.1f}  "
+                      f"dropped {result['dropped']:4d}  cpu {result['cpu_percent']:5.1f}%", flush=True)
+            for name in videos.values():
+                raw_path = led.raw_video_path(name)
+                if os.path.exists(raw_path):
+                    os.remove(raw_path)
+        led.controller.submit('stop', wait=True)
+        return results
+
+def serve_http(server, port):
+    # --http-upload 的子进程：使用基准字体，按指定方式启动 HTTP 服务
+    import led_web_test as led
+    led.font_registry.folder = os.path.abspath('fonts')
+    if server == 'pooled':
+        led.http_server = led.PooledHTTPServer(led.app, '127.0.0.1', port)
+        led.http_server.serve_forever()
+    else:
+        led.app.run(host='127.0.0.1', port=port, debug=False, threaded=True)
+
+def upload(port, size, state):
+    # 流式发送 size 字节的 multipart 视频上传，不在内存里拼出整个请求体；
+    # 一次上传结束后立即开始下一次，直到测量结束，保证每一轮控制请求都发生在上传期间
+    boundary = 'led-bench-boundary'
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    chunk = os.urandom(1 << 20)
+
+    def body(head):
+        yield head
+        for offset in range(0, size, len(chunk)):
+            yield chunk[:size - offset]
+        yield tail
+    while not state['stop'].is_set():
+        # 每次的文件名不同，避免被当作重复上传
+        head = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; '
+                f'filename="bench-upload-{state["uploads"]}.avi"\r\nContent-Type: video/x-msvideo\r\n\r\n').encode()
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+        try:
+            conn.request('POST', '/upload_video', body=body(head), headers={
+                'Content-Type': f'multipart/form-data; boundary={boundary}',
+                'Content-Length': str(len(head) + size + len(tail))})
+            state['status'] = conn.getresponse().status
+        finally:
+            conn.close()
+        state['uploads'] += 1
+        if state['status'] != 200:
+            return
+
+def measure_http(port, size, minimum=200):
+    # 上传进行期间在一个长连接上交替请求 /brightness 与 /text，另外每轮新建一个连接请求 /brightness，
+    # 至少测满 minimum 轮；上传失败时报错，而不是给出没有上传负载的结果
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.request('GET', f'/set_text_font/{BENCH_FONT}')
+    response = conn.getresponse()
+    response.read()
+    headers = {'Content-Type': 'application/json', 'Cookie': response.getheader('Set-Cookie').split(';')[0]}
+    state = {'stop': threading.Event(), 'status': None, 'uploads': 0}
+    uploader = threading.Thread(target=upload, args=(port, size, state), daemon=True)
+    if size:
+        uploader.start()
+        time.sleep(0.5)  # 等上传开始占用带宽与 CPU
+    latencies = {'brightness': [], 'text': [], 'new_connection': []}
+    started, i = time.perf_counter(), 0
+    try:
+        while i < minimum:
+            if size and not uploader.is_alive():
+                raise RuntimeError(f"upload failed with HTTP {state['status']} after {i} rounds")
+            t = time.perf_counter()
+            conn.request('GET', f'/brightness/{50 + i % 10}')
+            conn.getresponse().read()
+            latencies['brightness'].append(time.perf_counter() - t)
+            t = time.perf_counter()
+            conn.request('POST', '/text', body=json.dumps({'text': f'bench {i}', 'color': '#ff0000', 'speed': 3}),
+                         headers=headers)
+            conn.getresponse().read()
+            latencies['text'].append(time.perf_counter() - t)
+            t = time.perf_counter()
+            fresh = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            fresh.request('GET', '/brightness/70')
+            fresh.getresponse().read()
+            fresh.close()
+            latencies['new_connection'].append(time.perf_counter() - t)
+            i += 1
+            time.sleep(0.01)
+    finally:
+        state['stop'].set()
+    if size:
+        uploader.join()
+        if state['status'] != 200:
+            raise RuntimeError(f"upload failed with HTTP {state['status']}")
+    result = {name: percentiles(values) for name, values in latencies.items()}
+    result.update(requests=i, seconds=time.perf_counter() - started, upload_status=state['status'],
+                  uploads=state['uploads'])
+    return result
+
+def run_http(args, workdir):
+    # 每种服务器各启动一次子进程，先测空载再测上传期间
+    results = []
+    for server in args.servers:
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve-http', server, str(port)],
+                                   cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline or process.poll() is not None:
+                        raise RuntimeError(f'{server} server did not start')
+                    time.sleep(0.1)
+            for label, size in (('idle', 0), (f'upload-{args.http_upload}MB', args.http_upload << 20)):
+                result = measure_http(port, size)
+                result.update(server=server, case=label)
+                results.append(result)
+                print(f"{server:>9} {label:<14} brightness p99 {fmt(result['brightness']['p99'])} ms  "
+                      f"text p99 {fmt(result['text']['p99'])} ms  new connection p99 "
+                      f"{fmt(result['new_connection']['p99'])} ms  ({result['requests']} rounds, "
+                      f"{result['uploads']} uploads)", flush=True)
+        finally:
+            process.terminate()
+            process.wait()
+    return results
+
+def fmt(value):
+    return f'{value:7.2f}' if value is not None else '    n/a'
+
+def compare(results, baseline_path, threshold):
+    # 与基线逐项对比：切换延迟 p99 上升或帧率下降超过阈值视为回归
+    with open(baseline_path) as f:
+        baseline = {(r['geometry'], r['case']): r for r in json.load(f)['results']}
+    regressions = 0
+    for r in results:
+        base = baseline.get((r['geometry'], r['case']))
+        if base is None:
+            continue
+        flags = []
+        old, new = base['switch_ms']['p99'], r['switch_ms']['p99']
+        if old and new and new > old * (1 + threshold):
+            flags.append(f'switch p99 {old:.2f} -> {new:.2f} ms')
+        if base['fps'] and r['fps'] < base['fps'] * (1 - threshold):
+            flags.append(f"fps {base['fps']:.1f} -> {r['fps']:.1f}")
+        if flags:
+            regressions += 1
+            print(f"REGRESSION {r['geometry']} {r['case']}: {'; '.join(flags)}")
+    print(f"{regressions} regression(s) against {baseline_path}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='LED matrix switch latency / fps / CPU benchmark')
+    parser.add_argument('--geometries', nargs='+', default=list(GEOMETRIES), choices=list(GEOMETRIES))
+    parser.add_argument('--repeats', type=int, default=20, help='switches per case')
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds of sustained playback per case')
+    parser.add_argument('--timeout', type=float, default=5.0, help='seconds to wait for a first frame')
+    parser.add_argument('--quick', action='store_true', help='fewer repeats and cases, for smoke runs')
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative change counted as regression')
+    parser.add_argument('--http-upload', type=int, metavar='MB',
+                        help='measure control route latency over HTTP while uploading a file of this size')
+    parser.add_argument('--servers', nargs='+', default=['pooled', 'werkzeug'], choices=('pooled', 'werkzeug'),
+                        help='HTTP servers to compare with --http-upload')
+    parser.add_argument('--serve-http', nargs=2, metavar=('SERVER', 'PORT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.http_upload and args.compare:
+        parser.error('--compare only applies to the render benchmark')
+    if args.serve_http:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        return serve_http(args.serve_http[0], int(args.serve_http[1]))
+    if args.quick:
+        args.repeats, args.duration = min(args.repeats, 5), min(args.duration, 1.0)
+
+    # 在临时目录里运行，上传目录、缓存与数据库都不影响真实部署
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    workdir = tempfile.mkdtemp(prefix='led-bench-')
+    here = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(workdir)
+    sys.path.insert(0, here)
+    import led_web_test as led
+    font_dir = os.path.join(workdir, 'fonts')
+    os.makedirs(font_dir)
+    write_bdf(os.path.join(font_dir, BENCH_FONT))
+    led.font_registry.folder = font_dir
+
+    started = time.time()
+    if args.http_upload:
+        results = run_http(args, workdir)
+    else:
+        images, videos = write_media(led.UPLOAD_FOLDER)
+        results = Bench(led, args).run(images, videos)
+    report = {
+        'meta': {
+            'timestamp': started,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'engine_fps': led.ENGINE_FPS,
+            'backend': led.engine.backend_name,
+            'repeats': args.repeats,
+            'duration': args.duration,
+        },
+        'results': results,
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if baseline:
+        sys.exit(1 if compare(results, baseline, args.threshold) else 0)
+
+if __name__ == '__main__':
+    main()
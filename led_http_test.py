@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""PooledHTTPServer 测试：在本机端口上用一个小 WSGI 应用驱动服务器，检查 HTTP/1.1 长连接、流水线、
+分块请求/响应、HEAD、100-continue、路径解码、超长请求行、请求头超时，以及各线程池满时的 503 与池之间的隔离。
+
+    python3 led_http_test.py
+"""
+import http.client, json, os, socket, sys, tempfile, threading, time, unittest
+
+# 必须在导入 led_web_test 之前设置：软件帧缓冲，不需要矩阵硬件；上传目录与数据库放在临时目录，不落在仓库里
+os.environ['LED_BACKEND'] = 'framebuffer'
+os.environ['LED_TRANSCODE_ON_UPLOAD'] = '0'
+os.chdir(tempfile.mkdtemp(prefix='led-http-test-'))
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import led_web_test as led
+
+POOLS = {'control': (2, 0), 'upload': (1, 0), 'media': (2, 0), 'stream': (2, 0)}
+release = threading.Event()  # /slow 请求等待的事件，测试结束前总会放行
+
+def app(environ, start_response):
+    path = environ['PATH_INFO']
+    if path == '/chunked':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'one ', b'two ', b'three']
+    if path in ('/events', '/preview'):
+        start_response('200 OK', [('Content-Type', 'text/event-stream')])
+        return stream()
+    if path == '/slow':
+        release.wait(10)
+    if path.startswith('/uploads/'):
+        body = b'x' * 100000
+    else:
+        body = json.dumps({
+            'method': environ['REQUEST_METHOD'],
+            'path': path.encode('latin-1').decode('utf-8'),
+            'query': environ['QUERY_STRING'],
+            'body': environ['wsgi.input'].read().decode(),
+            'header': environ.get('HTTP_X_TEST'),
+        }).encode()
+    start_response('200 OK', [('Content-Type', 'application/octet-stream'), ('Content-Length', str(len(body)))])
+    return [body]
+
+def stream():
+    # 不会结束的推送流，客户端断开后写入失败，由服务器结束
+    while True:
+        yield b'data: tick\n\n'
+        time.sleep(0.05)
+
+class PooledHTTPServerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = led.PooledHTTPServer(app, '127.0.0.1', 0, pools=POOLS)
+        cls.port = cls.server.listener.getsockname()[1]
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        release.set()
+        cls.server.running = False
+
+    def setUp(self):
+        release.clear()
+        self.addCleanup(release.set)
+
+    def connect(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        self.addCleanup(conn.close)
+        return conn
+
+    def request(self, method, path, conn=None, **kwargs):
+        conn = conn or self.connect()
+        conn.request(method, path, **kwargs)
+        response = conn.getresponse()
+        return response, response.read()
+
+    def raw(self, data):
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+        self.addCleanup(sock.close)
+        sock.sendall(data)
+        return sock
+
+    def read_all(self, sock):
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def test_keep_alive(self):
+        conn = self.connect()
+        sockets = set()
+        for i in range(3):
+            response, body = self.request('GET', f'/echo?i={i}', conn)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(json.loads(body)['query'], f'i={i}')
+            sockets.add(conn.sock)
+        self.assertIsNone(response.getheader('Connection'))
+        self.assertEqual(len(sockets), 1)  # 三个请求用的是同一个连接
+
+    def test_post_body_and_headers(self):
+        response, body = self.request('POST', '/echo', body=b'hello', headers={'X-Test': 'yes'})
+        self.assertEqual(json.loads(body), {'method': 'POST', 'path': '/echo', 'query': '',
+                                            'body': 'hello', 'header': 'yes'})
+
+    def test_expect_continue(self):
+        sock = self.raw(b'POST /echo HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\nExpect: 100-continue\r\n'
+                        b'Connection: close\r\n\r\n')
+        self.assertTrue(sock.recv(1024).startswith(b'HTTP/1.1 100 Continue\r\n\r\n'))
+        sock.sendall(b'hello')
+        self.assertIn(b'"body": "hello"', self.read_all(sock))
+
+    def test_chunked_request(self):
+        response, body = self.request('POST', '/echo', body=iter([b'ab', b'cd']), encode_chunked=True,
+                                      headers={'Transfer-Encoding': 'chunked'})
+        self.assertEqual(json.loads(body)['body'], 'abcd')
+        self.assertEqual(response.getheader('Connection'), 'close')
+
+    def test_chunked_response(self):
+        response, body = self.request('GET', '/chunked')
+        self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+        self.assertEqual(body, b'one two three')
+
+    def test_head(self):
+        sock = self.raw(b'HEAD /chunked HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+        head, _, rest = self.read_all(sock).partition(b'\r\n\r\n')
+        self.assertTrue(head.startswith(b'HTTP/1.1 200'))
+        self.assertEqual(rest, b'')
+
+    def test_http10_closes(self):
+        sock = self.raw(b'GET /echo HTTP/1.0\r\n\r\n')
+        data = self.read_all(sock)  # 服务器关闭连接后才会返回
+        self.assertIn(b'Connection: close', data)
+
+    def test_pipelined(self):
+        sock = self.raw(b'GET /echo?n=1 HTTP/1.1\r\nHost: x\r\n\r\n'
+                        b'GET /echo?n=2 HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+        data = self.read_all(sock)
+        self.assertEqual(data.count(b'HTTP/1.1 200 OK'), 2)
+        self.assertLess(data.index(b'n=1'), data.index(b'n=2'))
+
+    def test_path_decoding(self):
+        _, body = self.request('GET', '/files/%E5%8E%9F%E7%A5%9E.png')
+        self.assertEqual(json.loads(body)['path'], '/files/原神.png')
+
+    def test_uri_too_long(self):
+        sock = self.raw(b'GET /' + b'a' * (led.HTTP_MAX_LINE + 10) + b' HTTP/1.1\r\n\r\n')
+        self.assertTrue(self.read_all(sock).startswith(b'HTTP/1.1 414'))
+
+    def test_control_pool_full(self):
+        # 两个控制线程都被占住、不允许排队时，第三个请求立即得到 503，上传池不受影响
+        slow = [self.raw(b'GET /slow HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n') for _ in range(2)]
+        self.wait_active('control', 2)
+        response, _ = self.request('GET', '/echo')
+        self.assertEqual(response.status, 503)
+        self.assertEqual(response.getheader('Retry-After'), '1')
+        response, _ = self.request('POST', '/upload_image', body=b'x')
+        self.assertEqual(response.status, 200)
+        release.set()
+        for sock in slow:
+            self.assertTrue(self.read_all(sock).startswith(b'HTTP/1.1 200'))
+
+    def test_streams_do_not_block_media(self):
+        # 推送流占满自己的池之后，文件下载和控制接口照常响应，多出来的流得到 503
+        streams = []
+        for path in ('/events', '/preview'):
+            conn = self.connect()
+            conn.request('GET', path)
+            response = conn.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.readline(), b'data: tick\n')
+            streams.append(conn)
+        response, body = self.request('GET', '/uploads/a.png')
+        self.assertEqual((response.status, len(body)), (200, 100000))
+        response, _ = self.request('GET', '/echo')
+        self.assertEqual(response.status, 200)
+        response, _ = self.request('GET', '/events')
+        self.assertEqual(response.status, 503)
+        for conn in streams:
+            conn.close()
+        self.wait_active('stream', 0)
+
+    def test_slow_headers_do_not_hold_workers(self):
+        # 只发了半个请求头的连接在分发线程里等待，比控制线程多得多的慢客户端也不会拖住 /brightness
+        slow = [self.raw(b'POST /brightness HTTP/1.1\r\nHost: x\r\nX-Te') for _ in range(8)]
+        deadline = time.monotonic() + 5
+        while len(self.server.idle) < len(slow):
+            self.assertLess(time.monotonic(), deadline, 'slow clients never reached the server')
+            time.sleep(0.01)
+        self.assertEqual(self.server.pools['control'].active, 0)
+        started = time.monotonic()
+        response, _ = self.request('POST', '/brightness', body=b'50')
+        self.assertEqual(response.status, 200)
+        self.assertLess(time.monotonic() - started, 1)
+        for sock in slow:
+            sock.sendall(b'st: yes\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok')
+            data = self.read_all(sock)
+            self.assertTrue(data.startswith(b'HTTP/1.1 200'))
+            self.assertIn(b'"body": "ok", "header": "yes"', data)
+
+    def test_header_timeout(self):
+        # 请求头在期限内收不齐时回 408，即使客户端一直在慢慢发送
+        self.addCleanup(setattr, led, 'HTTP_HEADER_TIMEOUT', led.HTTP_HEADER_TIMEOUT)
+        led.HTTP_HEADER_TIMEOUT = 0.3
+        sock = self.raw(b'GET /echo HTTP/1.1\r\n')
+        sock.settimeout(0.1)
+        started = time.monotonic()
+        while time.monotonic() - started < 3:
+            try:
+                data = sock.recv(1024)
+                break
+            except socket.timeout:
+                sock.sendall(b'X: y\r\n')
+        self.assertTrue(data.startswith(b'HTTP/1.1 408'))
+        self.assertLess(time.monotonic() - started, 2.5)
+
+    def wait_active(self, pool, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while self.server.pools[pool].active != count:
+            self.assertLess(time.monotonic(), deadline, f'{pool} pool never reached {count} active')
+            time.sleep(0.01)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""多节点分发测试：在本机启动若干接收节点进程，外加一个从不确认的节点和一个无人监听的端口，
+用 NetworkBackend 推送帧，检查渲染线程调用 show() 不被慢节点拖住、正常节点最终显示的画面与控制端一致，
+以及发来错误帧头的对端只会断开自己的连接。
+
+    python3 led_network_test.py
+    python3 led_network_test.py --receivers 4 --frames 300 --output network.json
+"""
+import argparse, json, os, socket, subprocess, sys, tempfile, threading, time, zlib
+
+# 必须在导入 led_web_test 之前设置：软件帧缓冲，不需要矩阵硬件；接收节点子进程继承这些设置
+os.environ['LED_BACKEND'] = 'framebuffer'
+os.environ['LED_TRANSCODE_ON_UPLOAD'] = '0'
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def serve_receiver(port):
+    # 接收节点子进程：真实的 FrameReceiver，每显示一帧向标准输出写一行 "帧计数 CRC32"
+    sys.path.insert(0, HERE)
+    import led_web_test as led
+
+    def present(counter, frame):
+        print(counter, zlib.crc32(frame.tobytes()), flush=True)
+    led.FrameReceiver(port, present=present).serve_forever()
+
+class ReceiverProcess:
+    """一个接收节点子进程，后台线程读取它报告的已显示帧"""
+    def __init__(self, port):
+        self.port = port
+        self.presented = []
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve-receiver', str(port)],
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for line in self.process.stdout:
+            parts = line.split()
+            if len(parts) == 2 and all(part.isdigit() for part in parts):
+                self.presented.append((int(parts[0]), int(parts[1])))
+
+    def wait_listening(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except OSError:
+                if time.monotonic() > deadline or self.process.poll() is not None:
+                    raise RuntimeError(f'receiver on port {self.port} did not start')
+                time.sleep(0.1)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+def stalled_node(port):
+    # 接受连接、读走数据但从不回复确认，模拟卡住的节点
+    server = socket.create_server(('127.0.0.1', port))
+    def serve():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=lambda: all(iter(lambda: conn.recv(65536), b'')), daemon=True).start()
+    threading.Thread(target=serve, daemon=True).start()
+
+def send_bad_header(led, port):
+    # 分块边长为 0、区域巨大的 DATA 帧头：接收节点只应断开这个连接
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(led.NODE_HEADER.pack(led.NODE_MAGIC, led.NODE_DATA, 1, 60000, 60000, 0, 16))
+        sock.sendall(b'\0' * 16)
+        sock.settimeout(5)
+        try:
+            return sock.recv(1) == b''  # 被接收节点关闭
+        except OSError:
+            return True
+
+def percentiles(values):
+    values = np.asarray(values) * 1000
+    return {'p50_ms': float(np.percentile(values, 50)), 'p99_ms': float(np.percentile(values, 99)),
+            'max_ms': float(values.max())}
+
+def main():
+    parser = argparse.ArgumentParser(description='Local multi-node streaming test for the network backend')
+    parser.add_argument('--receivers', type=int, default=3, help='healthy receiver node processes')
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--fps', type=float, default=60)
+    parser.add_argument('--max-show-ms', type=float, default=5.0, help='fail if show() ever takes longer')
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--serve-receiver', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve_receiver:
+        return serve_receiver(args.serve_receiver)
+
+    sys.path.insert(0, HERE)
+    sys.argv = sys.argv[:1]
+    os.chdir(tempfile.mkdtemp(prefix='led-network-'))  # 上传目录与缓存不落在仓库里，接收节点子进程同样继承
+    import led_web_test as led
+
+    height, width = led.physical_geometry()
+    columns = args.receivers + 2  # 正常节点 + 卡住的节点 + 无人监听的端口，各占一列区域
+    step = width // columns
+    receivers, nodes = [], []
+    try:
+        for i in range(args.receivers):
+            receivers.append(ReceiverProcess(free_port()))
+            nodes.append(('127.0.0.1', receivers[-1].port, (0, i * step, height, step)))
+        for receiver in receivers:
+            receiver.wait_listening()
+        stalled = free_port()
+        stalled_node(stalled)
+        nodes.append(('127.0.0.1', stalled, (0, args.receivers * step, height, step)))
+        nodes.append(('127.0.0.1', free_port(), (0, (args.receivers + 1) * step, height, step)))
+
+        failures = []
+        if not send_bad_header(led, receivers[0].port):
+            failures.append('receiver kept a connection with a bad frame header open')
+
+        led.NETWORK_NODES[:] = nodes
+        backend = led.NetworkBackend({})
+        rng = np.random.default_rng(0)
+        frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        show_times = []
+        for i in range(args.frames):
+            frame = frame.copy()
+            frame[rng.integers(0, height), :] = rng.integers(0, 256, 3)  # 每帧改一行，产生增量
+            started = time.perf_counter()
+            backend.show(frame)
+            show_times.append(time.perf_counter() - started)
+            time.sleep(max(0, 1 / args.fps - show_times[-1]))
+        time.sleep(max(1.0, 4 * led.NODE_ACK_TIMEOUT))  # 等发送线程把最后一帧送达、子进程报告
+        stats = backend.stats()
+        backend.close()
+    finally:
+        for receiver in receivers:
+            receiver.stop()
+
+    if max(show_times) * 1000 > args.max_show_ms:
+        failures.append(f"show() took {max(show_times) * 1000:.1f} ms")
+    for receiver, (_, port, (y, x, h, w)) in zip(receivers, nodes):
+        if not receiver.presented:
+            failures.append(f"node {port} presented nothing")
+            continue
+        counter, crc = receiver.presented[-1]
+        expected = zlib.crc32(np.ascontiguousarray(frame[y:y + h, x:x + w]).tobytes())
+        if counter != stats['counter'] or crc != expected:
+            failures.append(f"node {port} ended on frame {counter}, expected {stats['counter']}")
+    results = {'show': percentiles(show_times), 'frames': args.frames,
+               'presented': {receiver.port: len(receiver.presented) for receiver in receivers},
+               'nodes': stats['nodes'], 'failures': failures}
+    print(json.dumps(results, indent=2, default=str))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""点阵屏共享内存帧输入：外部进程把 RGB 帧写进 mmap 三缓冲，led_web_test 的渲染引擎直接读取最新的完整帧，不经过 HTTP。
+
+    from led_shared_frames import SharedFrameWriter
+    writer = SharedFrameWriter.select('http://raspberrypi:8080')  # 切换到共享内存输入并映射缓冲区
+    while True:
+        frame = writer.frame()   # 下一个空闲槽位的 (H, W, 3) uint8 RGB 视图
+        frame[:] = ...
+        writer.publish()
+
+文件布局：64 字节文件头 + slots 个槽位，每个槽位 64 字节槽头（帧序号）后跟 H×W×3 字节像素。
+写端只写既不是最新帧、也不是读端正在使用的槽位，写之前把槽位序号清零，写完再填序号并发布为最新帧。
+握手：读端先登记槽位再复查序号，写端先清零序号再复查登记，两边总有一方看到对方，
+因此三个槽位就能保证引擎读到的帧不会被覆盖一半。
+"""
+import json, mmap, os, struct, tempfile, urllib.request
+import numpy as np
+
+MAGIC = b'LEDF'
+VERSION = 1
+HEADER = struct.Struct('<4sHHHH')  # 魔数、版本、高、宽、槽位数
+HEADER_SIZE = 64
+LATEST_OFFSET = 16   # u8 最新帧序号
+SLOT_OFFSET = 24     # u8 最新帧所在槽位
+READING_OFFSET = 32  # u8 读端正在使用的槽位
+SLOT_HEADER_SIZE = 64
+DEFAULT_SLOTS = 3
+DEFAULT_PATH = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'led-frames')
+
+class SharedFrameBuffer:
+    """映射共享帧文件；create() 由服务端调用，attach() 由外部程序调用"""
+    def __init__(self, path, file, height, width, slots):
+        self.path = path
+        self.inode = os.fstat(file.fileno()).st_ino
+        self.height, self.width, self.slots = height, width, slots
+        self.slot_size = SLOT_HEADER_SIZE + (height * width * 3 + 63) // 64 * 64
+        self.mm = mmap.mmap(file.fileno(), HEADER_SIZE + slots * self.slot_size)
+        file.close()
+        words = np.ndarray((HEADER_SIZE // 8,), dtype='<u8', buffer=self.mm)
+        self.latest = words[LATEST_OFFSET // 8:LATEST_OFFSET // 8 + 1]
+        self.latest_slot = words[SLOT_OFFSET // 8:SLOT_OFFSET // 8 + 1]
+        self.reading = words[READING_OFFSET // 8:READING_OFFSET // 8 + 1]
+        self.sequences = [np.ndarray((1,), dtype='<u8', buffer=self.mm, offset=self.slot_offset(i))
+                          for i in range(slots)]
+        self.held = 0  # 读端上一次取到的槽位
+        self.frames = [np.ndarray((height, width, 3), dtype=np.uint8, buffer=self.mm,
+                                  offset=self.slot_offset(i) + SLOT_HEADER_SIZE) for i in range(slots)]
+
+    def slot_offset(self, slot):
+        return HEADER_SIZE + slot * self.slot_size
+
+    @classmethod
+    def create(cls, path, height, width, slots=DEFAULT_SLOTS):
+        # 几何与槽位数一致时沿用现有文件，已连接的写端不受影响；否则原子替换为新文件
+        try:
+            existing = cls.attach(path)
+            if (existing.height, existing.width, existing.slots) == (height, width, slots):
+                return existing
+        except (OSError, ValueError):
+            pass
+        size = HEADER_SIZE + slots * (SLOT_HEADER_SIZE + (height * width * 3 + 63) // 64 * 64)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.truncate(size)
+            f.write(HEADER.pack(MAGIC, VERSION, height, width, slots))
+        os.chmod(tmp_path, 0o666)  # 允许非 root 的外部程序写入
+        os.replace(tmp_path, path)
+        return cls.attach(path)
+
+    @classmethod
+    def attach(cls, path):
+        f = open(path, 'r+b')
+        try:
+            magic, version, height, width, slots = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION or slots < 3:
+                raise ValueError(f"{path} is not a shared frame buffer")
+            return cls(path, f, height, width, slots)
+        except BaseException:
+            f.close()
+            raise
+
+    def replaced(self):
+        # 服务端按新几何重建文件后，旧映射不再被读取
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except OSError:
+            return True
+
+    def acquire(self):
+        # 读端：取最新的完整帧，返回 (序号, 只读视图)；没有帧或正被覆盖时返回 (None, None)
+        sequence = int(self.latest[0])
+        if sequence == 0:
+            return None, None
+        slot = int(self.latest_slot[0])
+        self.reading[0] = slot
+        if int(self.sequences[slot][0]) != sequence:
+            self.reading[0] = self.held  # 登记之前写端已经开始覆盖这个槽位，继续保护上一帧，下一帧再取
+            return None, None
+        self.held = slot
+        frame = self.frames[slot].view()
+        frame.flags.writeable = False
+        return sequence, frame
+
+    def free_slot(self):
+        # 写端：选一个既不是最新帧也不是读端正在使用的槽位，清零序号表示正在写
+        latest = int(self.latest_slot[0]) if self.latest[0] else -1
+        while True:
+            reading = int(self.reading[0])
+            slot = next(i for i in range(self.slots) if i not in (latest, reading))
+            self.sequences[slot][0] = 0
+            # 清零之后复查：读端在此之前登记了这个槽位并通过了序号检查，就换一个槽位
+            if int(self.reading[0]) != slot:
+                return slot
+
+    def commit(self, slot):
+        sequence = int(self.latest[0]) + 1
+        self.sequences[slot][0] = sequence
+        self.latest_slot[0] = slot
+        self.latest[0] = sequence
+        return sequence
+
+class SharedFrameWriter:
+    """外部程序使用的写端：frame() 取空闲槽位直接绘制，publish() 发布为最新帧"""
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.buffer = SharedFrameBuffer.attach(path)
+        self.slot = None
+
+    @classmethod
+    def select(cls, url, timeout=5):
+        # 通过 HTTP 让面板切换到共享内存输入，服务端按当前几何建好缓冲区后返回文件路径
+        request = urllib.request.Request(url.rstrip('/') + '/shared', data=b'{}', method='POST',
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            result = json.load(response)
+        if not result.get('success'):
+            raise RuntimeError(result.get('error', 'shared frame input unavailable'))
+        return cls(result['path'])
+
+    @property
+    def shape(self):
+        return self.buffer.height, self.buffer.width, 3
+
+    def frame(self):
+        if self.slot is None:
+            if self.buffer.replaced():
+                self.buffer = SharedFrameBuffer.attach(self.path)  # 面板几何变化，重新映射
+            self.slot = self.buffer.free_slot()
+        return self.buffer.frames[self.slot]
+
+    def publish(self, frame=None):
+        # 可以直接传入一帧 (H, W, 3) RGB 图像，等价于 frame()[:] = frame
+        if frame is not None:
+            np.copyto(self.frame(), frame)
+        elif self.slot is None:
+            raise RuntimeError('publish() without frame(): nothing was drawn')
+        slot, self.slot = self.slot, None
+        return self.buffer.commit(slot)
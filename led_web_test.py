@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
-from flask import Flask, request, render_template_string, session, jsonify, send_from_directory, redirect, url_for
-import cv2, time, threading, datetime, os, sys, re, subprocess, signal
+from flask import Flask, Response, request, render_template_string, session, jsonify, send_from_directory, redirect, url_for
+import cv2, io, math, time, threading, datetime, os, sys, re, subprocess, signal, hashlib, struct, queue, tempfile, sqlite3, json, random, bisect, socket, zlib, argparse, selectors, http.client
 import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
 from werkzeug.routing import BaseConverter
+from werkzeug.formparser import parse_form_data
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.wsgi import LimitedStream
+from werkzeug.serving import DechunkedInput
+from email.utils import formatdate
+from urllib.parse import unquote
+from led_shared_frames import SharedFrameBuffer, DEFAULT_PATH as SHARED_FRAMES_DEFAULT_PATH
 
 class BooleanConverter(BaseConverter):
     """自定义布尔类型转换器"""
@@ -28,8 +37,116 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'avi'}
 ALLOWED_VIDEO_EXTENSIONS = {'mp4', 'avi'}  # 新增视频文件扩展名
 ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
-current_process = None
-stop_event = threading.Event()
+# 运行指标：热路径上只做计数与分桶，/metrics 抓取时再汇总；LED_METRICS=0 时不计时也不计数
+METRICS_ENABLED = os.environ.get('LED_METRICS', '1') == '1'
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class Counter:
+    """单调递增计数器；错误、上传等计数由多个线程写入，用锁保证 += 不丢失"""
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name, self.help = name, help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+class Histogram:
+    """固定分桶直方图；上传、解码耗时等由多个线程写入，分桶与总和在同一把锁下更新，抓取时看到的是一致的快照"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name, self.help = name, help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts, total_sum = list(self.counts), self.sum
+        samples, total = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            samples.append((f'{self.name}_bucket{{le="{le}"}}', total))
+        return samples + [(f'{self.name}_sum', total_sum), (f'{self.name}_count', total)]
+
+class Collected:
+    """抓取时才读取的指标，热路径上没有任何开销"""
+    def __init__(self, name, help, read, kind='gauge'):
+        self.name, self.help, self.read, self.kind = name, help, read, kind
+
+    def samples(self):
+        return [(self.name, self.read())]
+
+class Metrics:
+    """指标注册表，按 Prometheus 文本格式输出"""
+    def __init__(self):
+        self.items = []
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def collect(self, name, help, read, kind='gauge'):
+        return self.register(Collected(name, help, read, kind))
+
+    def register(self, item):
+        self.items.append(item)
+        return item
+
+    def render(self):
+        lines = []
+        for item in self.items:
+            try:
+                samples = item.samples()
+            except Exception as e:
+                print(f"Metric {item.name} failed: {e}")
+                continue
+            lines += [f'# HELP {item.name} {item.help}', f'# TYPE {item.name} {item.kind}']
+            lines += [f'{name} {value}' for name, value in samples if value is not None]
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+ERRORS = metrics.counter('led_errors_total', 'Errors reported by render, decode and command paths')
+FRAME_RENDER_SECONDS = metrics.histogram('led_frame_render_seconds', 'Time for a content source to produce a frame')
+COLOR_LUT_SECONDS = metrics.histogram('led_color_lut_seconds', 'Time to colour-correct, dither and map a frame to the panel layout')
+OUTPUT_SECONDS = metrics.histogram('led_output_seconds', 'Time to hand a frame to the panel backend')
+DECODE_SECONDS = metrics.histogram('led_decode_seconds', 'Time to decode and scale one video frame')
+IMAGE_DECODE_SECONDS = metrics.histogram('led_image_decode_seconds', 'Time to decode and scale an image on cache miss')
+SWITCH_SECONDS = metrics.histogram('led_switch_seconds', 'Content switch request to first frame on the panel')
+PROCESS_SWITCH_SECONDS = metrics.histogram('led_process_switch_seconds', 'Content switch request to external program start')
+FRAMES_DROPPED = metrics.counter('led_frames_dropped_total', 'Video frames skipped to catch up with the clock')
+FRAMES_SKIPPED = metrics.counter('led_frames_skipped_total', 'Frames identical to the panel contents, not output')
+FRAMES_LATE = metrics.counter('led_frames_late_total', 'Video frames shown more than one frame interval late')
+VIDEO_UNDERRUNS = metrics.counter('led_video_underruns_total', 'Times a video frame was due but not decoded yet')
+UPLOAD_BYTES = metrics.counter('led_upload_bytes_total', 'Bytes received by upload routes')
+UPLOAD_SECONDS = metrics.histogram('led_upload_seconds', 'Time to receive and store one upload',
+                                   (0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+# 最近的运行错误，随状态事件推送给监控端
+recent_errors = deque(maxlen=20)
+
+def report_error(message):
+    print(message)
+    recent_errors.append({'time': time.time(), 'message': message})
+    ERRORS.inc()
+
 DEFAULT_RGB_ORDER = "adafruit-hat" 
 # 硬件配置默认值
 HARDWARE_CONFIG = {
@@ -40,9 +157,1741 @@ HARDWARE_CONFIG = {
     'gpio_mapping': 'adafruit-hat',
     'brightness': 50,
     'pwm_bits': 11,
-    'rgb_sequence': 'RBG'
+    'rgb_sequence': 'RBG',
+    # 面板排布：每条链折成 chain_rows 行、蛇形走线时偶数行反向且旋转 180°，整个画布再顺时针旋转 rotation 度
+    'chain_rows': int(os.environ.get('LED_CHAIN_ROWS', 1)),
+    'serpentine': os.environ.get('LED_SERPENTINE', '0') == '1',
+    'rotation': int(os.environ.get('LED_ROTATION', 0)),
+}
+
+# 渲染后端：rgbmatrix 直接驱动 GPIO，framebuffer 为纯软件帧缓冲（无硬件时调试/测试用）
+RENDER_BACKEND = os.environ.get('LED_BACKEND', 'rgbmatrix')
+ENGINE_FPS = int(os.environ.get('LED_ENGINE_FPS', 60))
+
+def physical_geometry():
+    # 矩阵帧缓冲的 (高, 宽)：rows × parallel 行，cols × chain 列
+    return (HARDWARE_CONFIG['rows'] * HARDWARE_CONFIG['parallel'],
+            HARDWARE_CONFIG['cols'] * HARDWARE_CONFIG['chain'])
+
+def panel_geometry():
+    # 内容画布的 (高, 宽)：按面板排布折叠、旋转后的逻辑尺寸
+    fold = HARDWARE_CONFIG['chain_rows']
+    height = HARDWARE_CONFIG['rows'] * HARDWARE_CONFIG['parallel'] * fold
+    width = HARDWARE_CONFIG['cols'] * HARDWARE_CONFIG['chain'] // fold
+    return (width, height) if HARDWARE_CONFIG['rotation'] in (90, 270) else (height, width)
+
+def layout_map(config):
+    # 为矩阵帧缓冲的每个像素预先算出它取自逻辑画布的哪个像素，恒等排布返回 None
+    rows, cols, chain, parallel = (config[k] for k in ('rows', 'cols', 'chain', 'parallel'))
+    fold, rotation = config['chain_rows'], config['rotation']
+    if fold == 1 and rotation == 0:
+        return None
+    y, x = np.mgrid[0:rows * parallel, 0:cols * chain]
+    panel, y_in = divmod(y, rows)          # 并行链序号、面板内行
+    index, x_in = divmod(x, cols)          # 链上第几块、面板内列
+    per_row = chain // fold
+    panel_row, panel_col = divmod(index, per_row)
+    if config['serpentine']:
+        flipped = panel_row % 2 == 1
+        panel_col = np.where(flipped, per_row - 1 - panel_col, panel_col)
+        x_in = np.where(flipped, cols - 1 - x_in, x_in)
+        y_in = np.where(flipped, rows - 1 - y_in, y_in)
+    y = (panel * fold + panel_row) * rows + y_in
+    x = panel_col * cols + x_in
+    height, width = rows * parallel * fold, cols * per_row
+    if rotation == 90:
+        y, x = width - 1 - x, y
+    elif rotation == 180:
+        y, x = height - 1 - y, width - 1 - x
+    elif rotation == 270:
+        y, x = x, height - 1 - y
+    # 转成 cv2.remap 的定点格式，整帧重映射就是一次 gather
+    return cv2.convertMaps(x.astype(np.float32), y.astype(np.float32), cv2.CV_16SC2, nninterpolation=True)[0]
+
+class FramebufferBackend:
+    """软件帧缓冲后端，不依赖 GPIO 硬件"""
+    def __init__(self, config):
+        self.config = dict(config)
+        self.height, self.width = physical_geometry()
+        self.frame = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        self.frames_shown = 0
+
+    def show(self, frame, tiles=None):
+        # tiles 为变化的分块 [(y0, y1, x0, x1)]，None 表示整帧
+        if tiles is None:
+            np.copyto(self.frame, frame)
+        else:
+            for y0, y1, x0, x1 in tiles:
+                self.frame[y0:y1, x0:x1] = frame[y0:y1, x0:x1]
+        self.frames_shown += 1
+
+    def clear(self):
+        self.frame.fill(0)
+
+    def close(self):
+        pass
+
+class RGBMatrixBackend:
+    """rpi-rgb-led-matrix Python 绑定后端，矩阵只初始化一次"""
+    @staticmethod
+    def probe():
+        # 只检查绑定是否已安装，不初始化矩阵；缺失时抛出 ImportError
+        import rgbmatrix, PIL
+
+    def __init__(self, config):
+        from rgbmatrix import RGBMatrix, RGBMatrixOptions
+        from PIL import Image
+        self._image = Image
+        self.config = dict(config)
+        options = RGBMatrixOptions()
+        options.rows = config['rows']
+        options.cols = config['cols']
+        options.chain_length = config['chain']
+        options.parallel = config['parallel']
+        options.hardware_mapping = config['gpio_mapping']
+        options.brightness = config['brightness']
+        options.pwm_bits = config['pwm_bits']
+        options.led_rgb_sequence = config['rgb_sequence']
+        options.gpio_slowdown = 2
+        if hasattr(options, 'drop_privileges'):
+            options.drop_privileges = False  # 保留 root 权限，上传目录仍需写入
+        self.matrix = RGBMatrix(options=options)
+        self.canvas = self.matrix.CreateFrameCanvas()
+        self.height, self.width = self.matrix.height, self.matrix.width
+
+    def show(self, frame, tiles=None):
+        # 双缓冲画布交换后内容不确定，总是整帧写入
+        self.canvas.SetImage(self._image.fromarray(frame, 'RGB'))
+        self.canvas = self.matrix.SwapOnVSync(self.canvas)
+
+    def clear(self):
+        self.matrix.Clear()
+
+    def close(self):
+        self.matrix.Clear()
+        self.matrix = self.canvas = None
+
+# 多节点分发：控制端渲染整块画布，按区域把分块增量帧通过 TCP 发给各接收节点，节点按共享帧计数同步显示
+NODE_TILE = int(os.environ.get('LED_NODE_TILE', 16))
+NODE_ACK_TIMEOUT = float(os.environ.get('LED_NODE_ACK_TIMEOUT', 0.05))
+NODE_QUEUE = max(1, int(os.environ.get('LED_NODE_QUEUE', 2)))  # 每个节点待发送的帧数上限，超出丢弃最旧的帧
+NODE_MAGIC = b'LEDN'
+NODE_HEADER = struct.Struct('<4sBIHHHI')  # magic, 类型, 帧计数, 区域高, 区域宽, 分块边长, 负载长度
+NODE_DATA, NODE_PRESENT, NODE_ACK = 1, 2, 3
+
+def parse_nodes(spec):
+    # "host:port@y,x,h,w;host:port@y,x,h,w"，区域为控制端输出帧中的矩形
+    nodes = []
+    for item in filter(None, (part.strip() for part in spec.split(';'))):
+        address, region = item.split('@')
+        host, port = address.rsplit(':', 1)
+        y, x, h, w = (int(v) for v in region.split(','))
+        nodes.append((host.strip('[]'), int(port), (y, x, h, w)))
+    return nodes
+
+NETWORK_NODES = parse_nodes(os.environ.get('LED_NODES', ''))
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+class TileDelta:
+    """分块增量编解码：变化分块位图 + zlib 压缩的分块像素，编码端与解码端各持有一份上一帧"""
+    def __init__(self, height, width, tile=NODE_TILE):
+        self.height, self.width, self.tile = height, width, tile
+        self.rows, self.cols = -(-height // tile), -(-width // tile)
+        self.buffer = np.zeros((self.rows * tile, self.cols * tile, 3), dtype=np.uint8)
+        # (分块行, 分块列, tile, tile, 3) 视图，按位图一次取出或写回所有变化分块
+        self.blocks = self.buffer.reshape(self.rows, tile, self.cols, tile, 3).swapaxes(1, 2)
+        self.changed = np.zeros(self.buffer.shape[:2], dtype=bool)
+        self.keyframe = True
+
+    def encode(self, region):
+        view = self.buffer[:self.height, :self.width]
+        if self.keyframe:
+            mask = np.ones((self.rows, self.cols), dtype=bool)
+            self.keyframe = False
+        else:
+            np.any(region != view, axis=2, out=self.changed[:self.height, :self.width])
+            mask = self.changed.reshape(self.rows, self.tile, self.cols, self.tile).any(axis=(1, 3))
+        np.copyto(view, region)
+        return np.packbits(mask).tobytes() + zlib.compress(self.blocks[mask].tobytes(), 1)
+
+    def decode(self, payload):
+        bitmap_size = -(-self.rows * self.cols // 8)
+        mask = np.unpackbits(np.frombuffer(payload[:bitmap_size], dtype=np.uint8),
+                             count=self.rows * self.cols).astype(bool).reshape(self.rows, self.cols)
+        expected = int(mask.sum()) * self.tile * self.tile * 3
+        # 最多解压出变化分块需要的字节数，压缩炸弹不会撑爆内存
+        data = zlib.decompressobj().decompress(payload[bitmap_size:], expected) if expected else b''
+        if len(data) != expected:
+            raise ValueError('Frame payload does not match its tile bitmap')
+        self.blocks[mask] = np.frombuffer(data, dtype=np.uint8).reshape(-1, self.tile, self.tile, 3)
+        return self.buffer[:self.height, :self.width]
+
+class NodeFrame:
+    """一帧在同步节点间的汇合点：这些节点的发送线程都收到确认或超时后才一起发 PRESENT"""
+    def __init__(self, parties):
+        self.deadline = time.monotonic() + NODE_ACK_TIMEOUT
+        self.remaining = parties
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def arrive(self):
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.done.set()
+
+    def wait(self):
+        self.done.wait(max(0, self.deadline - time.monotonic()))
+
+class NodeLink(threading.Thread):
+    """到一个接收节点的发送线程：连接、编码、等待确认都不在渲染线程里；断开后每秒最多重连一次，重连后先发关键帧"""
+    def __init__(self, host, port, region):
+        super().__init__(name=f'node-{host}:{port}', daemon=True)
+        self.host, self.port, self.region = host, port, region
+        self.sock = None
+        self.delta = None
+        self.inbox = bytearray()
+        self.next_attempt = 0
+        self.acked = 0
+        self.frames = self.bytes_sent = self.ack_timeouts = self.connects = self.dropped = 0
+        self.synced = False  # 上一帧按时确认的节点参与同步显示，超时或断开的节点收到确认后单独显示
+        self.queue = queue.Queue(maxsize=NODE_QUEUE)
+
+    def submit(self, counter, frame, node_frame):
+        # 渲染线程调用，从不阻塞：队列满时丢弃最旧的一帧，增量编码以实际发出的上一帧为基准
+        y, x, h, w = self.region
+        item = (counter, frame[y:y + h, x:x + w].copy(), node_frame)
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            try:
+                stale = self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            self.dropped += 1
+            if stale[2] is not None:
+                stale[2].arrive()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            counter, region, node_frame = item
+            deadline = node_frame.deadline if node_frame else time.monotonic() + NODE_ACK_TIMEOUT
+            sent = self.connect() and self.send_data(counter, region)
+            self.synced = sent and self.wait_ack(counter, deadline)
+            if node_frame is not None:
+                node_frame.arrive()
+                if sent:
+                    node_frame.wait()
+            if sent and self.sock is not None:
+                self.send(NODE_PRESENT, counter)
+        self.close()
+
+    def stop(self):
+        # 丢弃还没发送的帧，发送线程处理完当前帧后退出并断开连接
+        while True:
+            try:
+                stale = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if stale is not None and stale[2] is not None:
+                stale[2].arrive()
+        self.queue.put(None)
+
+    def connect(self):
+        if self.sock is not None:
+            return True
+        now = time.monotonic()
+        if now < self.next_attempt:
+            return False
+        self.next_attempt = now + 1
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=0.2)
+        except OSError:
+            return False
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(1.0)
+        self.sock, self.inbox = sock, bytearray()
+        self.delta = TileDelta(self.region[2], self.region[3])
+        self.connects += 1
+        return True
+
+    def send(self, kind, counter, payload=b''):
+        _, _, h, w = self.region
+        try:
+            self.sock.sendall(NODE_HEADER.pack(NODE_MAGIC, kind, counter, h, w, NODE_TILE, len(payload)) + payload)
+        except OSError as e:
+            self.close()
+            report_error(f"Node {self.host}:{self.port} disconnected: {e}")
+            return False
+        self.bytes_sent += NODE_HEADER.size + len(payload)
+        return True
+
+    def send_data(self, counter, region):
+        self.frames += 1
+        return self.send(NODE_DATA, counter, self.delta.encode(region))
+
+    def wait_ack(self, counter, deadline):
+        # 在截止时间前收到这一帧的确认返回 True
+        while self.sock is not None and self.acked != counter:
+            while len(self.inbox) >= NODE_HEADER.size:
+                magic, kind, acked = NODE_HEADER.unpack_from(self.inbox)[:3]
+                del self.inbox[:NODE_HEADER.size]
+                if magic == NODE_MAGIC and kind == NODE_ACK:
+                    self.acked = acked
+            if self.acked == counter:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.ack_timeouts += 1
+                return False
+            try:
+                self.sock.settimeout(remaining)
+                chunk = self.sock.recv(4096)
+            except socket.timeout:
+                continue
+            except OSError:
+                chunk = b''
+            finally:
+                if self.sock is not None:
+                    self.sock.settimeout(1.0)
+            if not chunk:
+                self.close()
+                break
+            self.inbox += chunk
+        return self.acked == counter
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def stats(self):
+        return {'node': f'{self.host}:{self.port}', 'region': self.region, 'connected': self.sock is not None,
+                'frames': self.frames, 'bytes_sent': self.bytes_sent, 'acked': self.acked,
+                'ack_timeouts': self.ack_timeouts, 'connects': self.connects, 'dropped': self.dropped}
+
+class NetworkBackend:
+    """多节点分发后端：渲染线程只把帧交给各节点的发送线程，各线程发 DATA、等待确认（最多 LED_NODE_ACK_TIMEOUT 秒）后统一发 PRESENT"""
+    def __init__(self, config):
+        if not NETWORK_NODES:
+            raise ValueError('No receiver nodes configured (LED_NODES or --node)')
+        self.config = dict(config)
+        self.height, self.width = physical_geometry()
+        for _, _, (y, x, h, w) in NETWORK_NODES:
+            if y < 0 or x < 0 or y + h > self.height or x + w > self.width:
+                raise ValueError(f"Node region {(y, x, h, w)} outside the {self.width}x{self.height} canvas")
+        self.links = [NodeLink(*node) for node in NETWORK_NODES]
+        for link in self.links:
+            link.start()
+        self.counter = 0
+
+    def show(self, frame, tiles=None):
+        # 各节点自己按分块做增量，不使用 tiles；慢节点或断开的节点只会丢自己的帧，不拖慢渲染线程
+        self.counter = (self.counter + 1) & 0xffffffff
+        synced = [link for link in self.links if link.synced]
+        node_frame = NodeFrame(len(synced)) if synced else None
+        for link in self.links:
+            link.submit(self.counter, frame, node_frame if link.synced else None)
+
+    def clear(self):
+        self.show(np.zeros((self.height, self.width, 3), dtype=np.uint8))
+
+    def close(self):
+        for link in self.links:
+            link.stop()
+        for link in self.links:
+            link.join(timeout=2)
+
+    def stats(self):
+        return {'counter': self.counter, 'nodes': [link.stats() for link in self.links]}
+
+BACKENDS = {
+    'framebuffer': FramebufferBackend,
+    'rgbmatrix': RGBMatrixBackend,
+    'network': NetworkBackend,
+}
+
+class ContentSource:
+    """内容源基类：引擎线程每帧调用 next_frame()，返回 None 表示画面无变化"""
+    dirty = None         # 上一帧变化的矩形列表 [(x, y, w, h)]，None 表示整帧都可能变化
+    PARAMS = ()          # 支持实时更新的参数名
+    requested_at = None  # 切换请求的提交时刻，引擎输出第一帧时据此记录切换延迟
+    transition = None    # 切入本内容源时使用的转场 {'effect', 'duration'}，None 表示使用全局默认
+    idle = False         # 画面只在外部事件后变化，无新帧时引擎不按帧率轮询
+
+    def __init__(self):
+        self.height, self.width = panel_geometry()
+        self.params = {}
+        self.requested = {}
+        self.pending = None
+        self.control_lock = threading.Lock()
+
+    def update(self, **params):
+        # 实时控制通道：在调用线程里准备好新状态，引擎线程在下一帧开始时整体生效
+        params = {k: v for k, v in params.items() if k in self.PARAMS}
+        if not params:
+            return False
+        with self.control_lock:
+            merged = dict(self.requested, **params)
+            self.pending = (merged, self.prepare(merged))
+            self.requested = merged
+        engine.wakeup.set()
+        return True
+
+    def apply_pending(self):
+        if self.pending is None:
+            return
+        with self.control_lock:
+            pending, self.pending = self.pending, None
+        if pending is not None:
+            self.apply(*pending)
+            self.params = pending[0]
+
+    def prepare(self, params):
+        return None
+
+    def apply(self, params, state):
+        pass
+
+    def next_frame(self, now):
+        return None
+
+    def close(self):
+        pass
+
+class SolidColorSource(ContentSource):
+    """纯色内容源"""
+    idle = True
+    def __init__(self, color=(0, 0, 0)):
+        super().__init__()
+        self.frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.frame[:] = color
+        self.drawn = False
+
+    def next_frame(self, now):
+        if self.drawn:
+            return None
+        self.drawn = True
+        return self.frame
+
+# 内容切换转场：none 为硬切，其余效果在帧缓冲上用 NumPy 整体混合
+TRANSITION_EFFECTS = ('none', 'crossfade', 'wipe', 'slide', 'dissolve')
+TRANSITION_MAX_DURATION = 5.0
+TRANSITION_CONFIG = {
+    'effect': os.environ.get('LED_TRANSITION', 'none'),
+    'duration': float(os.environ.get('LED_TRANSITION_DURATION', 0.5)),
 }
 
+def validate_transition(data):
+    effect = data.get('effect', TRANSITION_CONFIG['effect'])
+    if effect not in TRANSITION_EFFECTS:
+        raise ValueError(f"Unknown transition effect: {effect}")
+    duration = float(data.get('duration', TRANSITION_CONFIG['duration']))
+    if not 0 <= duration <= TRANSITION_MAX_DURATION:
+        raise ValueError(f"duration must be in [0, {TRANSITION_MAX_DURATION}]")
+    return {'effect': effect, 'duration': duration}
+
+class TransitionSource(ContentSource):
+    """转场：把切出前的最后一帧与新内容源的画面混合到预分配的双缓冲里，结束后引擎直接切到新内容源"""
+    def __init__(self, outgoing, incoming, effect, duration, budget):
+        super().__init__()
+        self.outgoing = outgoing
+        self.incoming = incoming
+        self.effect = effect
+        self.duration = duration
+        self.budget = budget  # 单帧混合耗时上限，超出后转场以硬切提前结束
+        self.over_budget = False
+        self.requested_at, incoming.requested_at = incoming.requested_at, None
+        height, width = outgoing.shape[:2]
+        self.buffers = np.empty((2, height, width, 3), dtype=np.uint8)  # 交替输出，引擎仍持有上一帧
+        self.back = 0
+        self.latest = None
+        self.start_time = None
+        self.finished = False
+        self.blend_times = []
+        if effect == 'crossfade':
+            self.accumulator = np.empty((height, width, 3), dtype=np.uint16)
+            self.scratch = np.empty((height, width, 3), dtype=np.uint16)
+        elif effect == 'dissolve':
+            self.rank = np.random.permutation(height * width).reshape(height, width)
+            self.mask = np.empty((height, width, 1), dtype=bool)
+
+    def apply_pending(self):
+        self.incoming.apply_pending()
+
+    def update(self, **params):
+        return self.incoming.update(**params)
+
+    def next_frame(self, now):
+        frame = self.incoming.next_frame(now)
+        if frame is not None:
+            self.latest = frame
+        if self.latest is None:
+            return None  # 新内容还没有画面，面板保持切出前的最后一帧
+        if self.start_time is None:
+            self.start_time = now
+        progress = (now - self.start_time) / self.duration if self.duration > 0 else 1
+        if progress >= 1 or self.over_budget or self.latest.shape != self.outgoing.shape:
+            self.finished = True
+            return self.latest
+        started = time.perf_counter()
+        out = self.buffers[self.back]
+        self.back ^= 1
+        getattr(self, '_' + self.effect)(self.outgoing, self.latest, out, progress)
+        elapsed = time.perf_counter() - started
+        self.blend_times.append(elapsed)
+        self.over_budget = elapsed > self.budget
+        return out
+
+    def _crossfade(self, a, b, out, t):
+        weight = int(t * 256)
+        # 显式指定 uint16 计算：NumPy 1.x 按数值推断类型，uint8 数组乘标量会在 uint8 里溢出
+        np.multiply(a, 256 - weight, out=self.accumulator, dtype=np.uint16)
+        np.multiply(b, weight, out=self.scratch, dtype=np.uint16)
+        self.accumulator += self.scratch
+        self.accumulator >>= 8
+        np.copyto(out, self.accumulator, casting='unsafe')
+
+    def _wipe(self, a, b, out, t):
+        col = int(t * a.shape[1])
+        out[:, :col] = b[:, :col]
+        out[:, col:] = a[:, col:]
+
+    def _slide(self, a, b, out, t):
+        # 新画面从右侧推入，旧画面同步移出
+        width = a.shape[1]
+        offset = int(t * width)
+        out[:, :width - offset] = a[:, offset:]
+        out[:, width - offset:] = b[:, :offset]
+
+    def _dissolve(self, a, b, out, t):
+        np.less(self.rank, int(t * self.rank.size), out=self.mask[..., 0])
+        np.copyto(out, a)
+        np.copyto(out, b, where=self.mask)
+
+    def close(self):
+        if not self.finished:
+            self.incoming.close()
+
+class RenderEngine:
+    """常驻渲染引擎：进程内持有画布，内容源原地切换，不再反复重建矩阵"""
+    def __init__(self, backend_name=RENDER_BACKEND, fps=ENGINE_FPS):
+        self.backend_name = backend_name
+        self.frame_interval = 1.0 / fps
+        self.backend = None
+        self.source = None
+        self.paused_source = None
+        self.lock = threading.Lock()          # 保护 source 切换
+        self.render_lock = threading.RLock()  # 保护 backend 的创建/输出/释放，批量配置期间由控制器持有
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.frames_shown = 0
+        self.shown_source = None
+        self.last_frame = None
+        self.lut_version = -1
+        self.switch_latencies = deque(maxlen=256)
+        self.backend_inits = 0
+        self.backend_error = None  # 后端依赖缺失的原因，'' 表示已检查过且可用
+        self.transitions = self.transitions_cut = 0
+        self.transition_times = deque(maxlen=1024)  # 每帧混合耗时（秒）
+
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._loop, name='render-engine', daemon=True)
+            self.thread.start()
+
+    def set_source(self, source):
+        self.start()
+        with self.lock:
+            old = self.source
+            self.source = self._transition(old, source) or source
+            paused, self.paused_source = self.paused_source, None
+        for stale in (old, paused):
+            if stale is not None and stale is not source:
+                stale.close()
+        if source is None:
+            self.clear()
+        self.wakeup.set()
+
+    def _transition(self, old, source):
+        # 只有旧内容已经输出过画面时才能转场，否则直接切换
+        if source is None or old is None or self.shown_source is not old or self.last_frame is None:
+            return None
+        config = source.transition or TRANSITION_CONFIG
+        if config['effect'] == 'none' or config['duration'] <= 0:
+            return None
+        self.transitions += 1
+        return TransitionSource(self.last_frame.copy(), source, config['effect'], config['duration'],
+                                self.frame_interval / 2)
+
+    def content(self):
+        # 当前内容源；转场期间返回切入的内容源
+        source = self.source
+        return source.incoming if isinstance(source, TransitionSource) else source
+
+    def off(self):
+        # 关闭显示：记住当前内容源，输出黑屏
+        self.start()
+        with self.lock:
+            if self.paused_source is None:
+                self.paused_source = self.content()
+            self.source = SolidColorSource()
+        self.wakeup.set()
+
+    def on(self):
+        # 恢复关闭前的内容源
+        with self.lock:
+            paused, self.paused_source = self.paused_source, None
+        if paused is not None:
+            self.set_source(paused)
+
+    def clear(self):
+        with self.render_lock:
+            if self.backend is not None:
+                self.backend.clear()
+            renderer.invalidate()
+
+    def release(self):
+        # 释放矩阵，让外部程序可以接管 GPIO
+        self.set_source(None)
+        with self.render_lock:
+            if self.backend is not None:
+                self.backend.close()
+                self.backend = None
+
+    def _ensure_backend(self):
+        # 硬件配置或画布尺寸变化时才重新初始化后端；新后端是空白的，下一帧要整帧输出
+        if self.backend is not None and (self.backend.config != HARDWARE_CONFIG or
+                                         (self.backend.height, self.backend.width) != physical_geometry()):
+            self.backend.close()
+            self.backend = None
+        if self.backend is None:
+            if self.missing():
+                # 不悄悄换成软件帧缓冲：那样面板一直是黑的，看起来却一切正常
+                raise RuntimeError(self.backend_error)
+            self.backend_inits += 1
+            self.backend = BACKENDS[self.backend_name](HARDWARE_CONFIG)
+            renderer.invalidate()
+        return self.backend
+
+    def missing(self):
+        # 后端依赖的绑定没有安装时返回原因，只检查并报告一次
+        if self.backend_error is None:
+            try:
+                getattr(BACKENDS[self.backend_name], 'probe', lambda: None)()
+                self.backend_error = ''
+            except ImportError as e:
+                self.backend_error = f"Backend {self.backend_name} unavailable: {e}"
+                report_error(self.backend_error)
+        return self.backend_error or None
+
+    def _output(self, source, frame):
+        with self.render_lock:
+            # 批量切换期间旧内容源的帧、尺寸已过期的帧直接丢弃
+            if self.source is not source or frame.shape[:2] != panel_geometry():
+                renderer.owner = None  # 脏矩形相对于被丢弃的帧，下一帧整帧比较
+                return
+            backend = self._ensure_backend()
+            if METRICS_ENABLED:
+                started = time.perf_counter()
+                output, tiles = renderer.render(frame, source)
+                rendered = time.perf_counter()
+                if output is not None:
+                    backend.show(output, tiles)
+                COLOR_LUT_SECONDS.observe(rendered - started)
+                OUTPUT_SECONDS.observe(time.perf_counter() - rendered)
+            else:
+                output, tiles = renderer.render(frame, source)
+                if output is not None:
+                    backend.show(output, tiles)
+        if output is None:
+            if METRICS_ENABLED:
+                FRAMES_SKIPPED.inc()
+        else:
+            self.frames_shown += 1
+            preview.offer(frame)
+        # 与当前画面相同的切换也算完成
+        if source.requested_at is not None:
+            latency = time.monotonic() - source.requested_at
+            self.switch_latencies.append(latency)
+            if METRICS_ENABLED:
+                SWITCH_SECONDS.observe(latency)
+            source.requested_at = None
+
+    def _finish_transition(self, transition):
+        # 转场结束后直接交给新内容源，最后一帧已经是新内容的完整画面
+        with self.lock:
+            if self.source is transition:
+                self.source = self.shown_source = transition.incoming
+        self.transition_times.extend(transition.blend_times)
+        if transition.over_budget:
+            self.transitions_cut += 1
+
+    def transition_stats(self):
+        times = list(self.transition_times)
+        return {
+            'default': TRANSITION_CONFIG,
+            'count': self.transitions,
+            'over_budget': self.transitions_cut,
+            'blend_ms': {
+                'mean': sum(times) / len(times) * 1000 if times else None,
+                'p99': percentile(times, 99) * 1000 if times else None,
+                'max': max(times) * 1000 if times else None,
+            },
+        }
+
+    def _loop(self):
+        next_tick = time.monotonic()
+        while True:
+            self.wakeup.clear()  # 读取内容源、取帧之前清除，之后到来的唤醒不会丢失
+            with self.lock:
+                source = self.source
+            if source is None:
+                self.wakeup.wait()
+                next_tick = time.monotonic()
+                continue
+            if source is not self.shown_source:
+                self.shown_source, self.last_frame = source, None
+            try:
+                source.apply_pending()  # 实时参数在帧边界生效
+                started = time.perf_counter() if METRICS_ENABLED else 0
+                frame = source.next_frame(time.monotonic())
+                if frame is None and self.lut_version != color_lut.version:
+                    # 静态画面在颜色参数变化后用上一帧重新输出
+                    frame = self.last_frame
+                if frame is not None:
+                    self.last_frame = frame
+                    self.lut_version = color_lut.version
+                    if METRICS_ENABLED:
+                        FRAME_RENDER_SECONDS.observe(time.perf_counter() - started)
+                    self._output(source, frame)
+                if isinstance(source, TransitionSource) and source.finished:
+                    self._finish_transition(source)
+            except Exception as e:
+                report_error(f"Render failed: {e}")
+                with self.lock:
+                    if self.source is source:
+                        self.source = None
+                source.close()
+                continue
+            if frame is None and source.idle:
+                # 画面静止且只由外部事件改变：不再按帧率轮询，等待推帧、切换或参数变化
+                self.wakeup.wait()
+                next_tick = time.monotonic()
+                continue
+            next_tick += self.frame_interval
+            delay = next_tick - time.monotonic()
+            if delay <= 0:
+                next_tick = time.monotonic()
+            elif self.wakeup.wait(delay):
+                # 内容切换时立即渲染新内容源的第一帧
+                next_tick = time.monotonic()
+
+engine = RenderEngine()
+
+# 软件 RGB 顺序：输出通道依次取自输入的哪个通道
+RGB_ORDERS = {
+    'regular': (0, 1, 2),
+    'grb': (1, 0, 2),
+    'rbg': (0, 2, 1),
+    'brg': (2, 0, 1),
+    'bgr': (2, 1, 0),
+}
+
+# 软件颜色参数：亮度(0-100)、RGB 增益、gamma 与 RGB 顺序，统一在输出阶段生效
+COLOR_CONFIG = {
+    'brightness': 100,
+    'rgb': [1.0, 1.0, 1.0],
+    'gamma': 1.0,
+    'rgb_order': 'regular',
+}
+
+class ColorLUT:
+    """把亮度、RGB 增益、gamma 和通道顺序合成一张 3×256 查找表，每帧一次索引完成校色"""
+    CHANNELS = np.arange(3)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.params = None
+        self.state = (None, None)  # (查找表, 通道顺序)，整体替换保证引擎线程读到一致的组合
+        self.version = 0
+
+    def update(self, brightness, rgb, gamma, rgb_order):
+        params = (max(0, min(100, int(brightness))), tuple(float(g) for g in rgb),
+                  float(gamma), rgb_order)
+        with self.lock:
+            if params == self.params:
+                return False
+            brightness, gains, gamma, rgb_order = params
+            order = RGB_ORDERS.get(rgb_order, (0, 1, 2))
+            curve = np.power(np.arange(256) / 255.0, gamma) * (brightness / 100.0) * 255.0
+            # 输出通道 c 取自输入通道 order[c]，增益跟随原始颜色通道
+            table = np.empty((3, 256), dtype=np.uint8)
+            for c in range(3):
+                table[c] = np.clip(np.rint(curve * gains[order[c]]), 0, 255)
+            identity = order == (0, 1, 2) and np.array_equal(table, np.tile(np.arange(256), (3, 1)))
+            self.state = (None if identity else table,
+                          None if order == (0, 1, 2) else np.array(order))
+            self.params = params
+            self.version += 1
+            return True
+
+    def apply(self, frame):
+        table, order = self.state
+        if table is None:
+            return frame
+        if order is not None:
+            frame = frame[..., order]
+        return table[self.CHANNELS, frame]
+
+color_lut = ColorLUT()
+color_lut.update(**COLOR_CONFIG)
+
+RENDER_WORKERS = int(os.environ.get('LED_RENDER_WORKERS', os.cpu_count() or 1))
+TILE_MIN_PIXELS = int(os.environ.get('LED_TILE_MIN_PIXELS', 128 * 64))  # 小于此像素数时不分块并行
+DITHER = os.environ.get('LED_DITHER', '0') == '1'
+BAYER_4X4 = np.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]], dtype=np.uint16)
+
+class TileRenderer:
+    """输出阶段：逻辑画布 → 矩阵帧缓冲的排布映射、通道顺序、校色查找表与有序抖动。
+    大画布按面板切块，分给线程池并行处理；cv2.remap / mixChannels / LUT 执行期间释放 GIL。
+    与上一帧逐面板比较，只处理变化的分块，整帧未变化时跳过输出"""
+    def __init__(self, workers=RENDER_WORKERS, min_pixels=TILE_MIN_PIXELS, dither=DITHER):
+        self.workers = max(1, workers)
+        self.min_pixels = min_pixels
+        self.dither = dither
+        self.pool = None
+        self.layout = None   # (硬件配置, 映射表, 抖动表, 分块列表, 逻辑分块尺寸)
+        self.lut = (None, None, None)  # (ColorLUT 状态, cv2 查找表, 通道映射)
+        self.output = None
+        self.scratch = None
+        self.previous = None  # 上一次输出的逻辑画面
+        self.changed = None   # 逐像素变化掩码
+        self.valid = False    # previous 与面板上的内容一致
+        self.owner = None     # previous 来自哪个内容源，只有同一内容源的脏矩形可信
+        self.frames_skipped = self.tiles_rendered = self.tiles_skipped = 0
+
+    def invalidate(self):
+        # 面板内容未知（新后端、清屏、参数变化），下一帧整帧输出
+        self.valid = False
+        self.owner = None
+
+    def _prepare_layout(self):
+        config = dict(HARDWARE_CONFIG)
+        if self.layout is not None and self.layout[0] == config:
+            return self.layout
+        height, width = physical_geometry()
+        rows, cols = config['rows'], config['cols']
+        mapping = layout_map(config)
+        # 每块面板一个分块，附带它在逻辑画布上对应的面板格 (by, bx)
+        block = (cols, rows) if config['rotation'] in (90, 270) else (rows, cols)
+        tiles = []
+        for y in range(0, height, rows):
+            for x in range(0, width, cols):
+                lx, ly = (x, y) if mapping is None else (int(v) for v in mapping[y, x])
+                tiles.append((y, y + rows, x, x + cols, ly // block[0], lx // block[1]))
+        dither = None
+        if self.dither and config['pwm_bits'] < 8:
+            # 抖动幅度为面板 PWM 位数丢掉的那部分量化步长
+            step = 1 << (8 - config['pwm_bits'])
+            pattern = (BAYER_4X4 * step // 16).astype(np.uint8)
+            dither = np.tile(pattern, (height // 4 + 1, width // 4 + 1))[:height, :width, None]
+            dither = np.ascontiguousarray(dither.repeat(3, axis=2))
+        self.layout = (config, mapping, dither, tiles, block)
+        # 部分更新依赖上一帧的输出，单缓冲常驻；后端在 show() 里同步拷贝
+        self.output = np.zeros((height, width, 3), dtype=np.uint8)
+        self.scratch = np.empty((height, width, 3), dtype=np.uint8)
+        logical = panel_geometry()
+        self.previous = np.zeros(logical + (3,), dtype=np.uint8)
+        self.changed = np.empty(logical, dtype=bool)
+        self.invalidate()
+        return self.layout
+
+    def _prepare_lut(self):
+        state = color_lut.state
+        if self.lut[0] is not state:
+            table, order = state
+            lut = None if table is None else np.ascontiguousarray(table.T).reshape(1, 256, 3)
+            mixing = None if order is None else [v for c in range(3) for v in (int(order[c]), c)]
+            self.lut = (state, lut, mixing)
+            self.invalidate()
+        return self.lut
+
+    def _changed_blocks(self, frame, dirty, block):
+        # 返回逻辑面板格的变化掩码，同时把变化的像素写回 previous
+        bh, bw = block
+        height, width = frame.shape[:2]
+        if not self.valid:
+            np.copyto(self.previous, frame)
+            self.valid = True
+            return np.ones((height // bh, width // bw), dtype=bool)
+        changed, previous = self.changed, self.previous
+        if dirty is None:
+            np.any(frame != previous, axis=2, out=changed)
+        else:
+            # 内容源报告了脏矩形：只比较这些区域
+            changed.fill(False)
+            for x, y, w, h in dirty:
+                region = (slice(y, y + h), slice(x, x + w))
+                np.any(frame[region] != previous[region], axis=2, out=changed[region])
+        mask = changed.reshape(height // bh, bh, width // bw, bw).any(axis=(1, 3))
+        if mask.any():
+            np.copyto(previous, frame, where=changed[..., None])
+        return mask
+
+    def render(self, frame, source=None):
+        # 返回 (输出帧, 变化的物理分块)；分块为 None 表示整帧，输出帧为 None 表示画面没有变化
+        _, mapping, dither, tiles, block = self._prepare_layout()
+        _, lut, mixing = self._prepare_lut()
+        dirty = source.dirty if source is not None and source is self.owner else None
+        self.owner = source
+        mask = self._changed_blocks(frame, dirty, block)
+        changed = [tile[:4] for tile in tiles if mask[tile[4], tile[5]]]
+        self.tiles_rendered += len(changed)
+        self.tiles_skipped += len(tiles) - len(changed)
+        if not changed:
+            self.frames_skipped += 1
+            return None, []
+        if len(changed) == len(tiles):
+            changed = None
+        if mapping is None and lut is None and mixing is None and dither is None:
+            return frame, changed  # 恒等输出，零拷贝
+        out = self.output
+        work = changed or [tile[:4] for tile in tiles]
+        height, width = self.output.shape[:2]
+        pixels = height * width * len(work) // len(tiles)
+        groups = min(self.workers, len(work)) if pixels >= self.min_pixels else 1
+        groups = [work[i::groups] for i in range(groups)]
+        if len(groups) == 1:
+            self._render_tiles(frame, out, groups[0], mapping, lut, mixing, dither)
+            return out, changed
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers - 1, thread_name_prefix='render-tile')
+        # 引擎线程自己处理第一组，其余交给线程池
+        futures = [self.pool.submit(self._render_tiles, frame, out, group, mapping, lut, mixing, dither)
+                   for group in groups[1:]]
+        self._render_tiles(frame, out, groups[0], mapping, lut, mixing, dither)
+        for future in futures:
+            future.result()
+        return out, changed
+
+    def _render_tiles(self, frame, out, tiles, mapping, lut, mixing, dither):
+        for y0, y1, x0, x1 in tiles:
+            tile = out[y0:y1, x0:x1]
+            if mapping is not None:
+                src = cv2.remap(frame, mapping[y0:y1, x0:x1], None, cv2.INTER_NEAREST,
+                                dst=self.scratch[y0:y1, x0:x1] if mixing else tile)
+            else:
+                src = frame[y0:y1, x0:x1]
+            if mixing is not None:
+                cv2.mixChannels([src], [tile], mixing)
+                src = tile
+            if lut is not None:
+                cv2.LUT(src, lut, dst=tile)
+            elif src is not tile:
+                np.copyto(tile, src)
+            if dither is not None:
+                cv2.add(tile, dither[y0:y1, x0:x1], dst=tile)
+
+    def stats(self):
+        tiles = self.layout[3] if self.layout else []
+        return {'workers': self.workers, 'tiles': len(tiles), 'dither': self.dither,
+                'remap': self.layout is not None and self.layout[1] is not None,
+                'frames_skipped': self.frames_skipped, 'tiles_rendered': self.tiles_rendered,
+                'tiles_skipped': self.tiles_skipped}
+
+renderer = TileRenderer()
+
+def fit_to_panel(image, height, width):
+    # OpenCV 的 BGR 图像一次性缩放到面板尺寸并转为连续的 RGB uint8 帧
+    if image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    elif image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+    if image.shape[:2] != (height, width):
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    return np.ascontiguousarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), dtype=np.uint8)
+
+# 预缩放图片缓存：内存 + 磁盘两级 LRU，按字节预算淘汰
+IMAGE_CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, '.cache')
+IMAGE_CACHE_BYTES = int(os.environ.get('LED_IMAGE_CACHE_BYTES', 32 * 1024 * 1024))
+IMAGE_CACHE_DISK_BYTES = int(os.environ.get('LED_IMAGE_CACHE_DISK_BYTES', 256 * 1024 * 1024))
+
+class ImageCache:
+    """面板就绪帧缓存，键为 (文件 mtime/大小, 面板几何)，颜色校正在输出阶段完成"""
+    def __init__(self, folder=IMAGE_CACHE_FOLDER, max_bytes=IMAGE_CACHE_BYTES,
+                 max_disk_bytes=IMAGE_CACHE_DISK_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = 0
+
+    def make_key(self, path):
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_size, st.st_mtime_ns, panel_geometry())
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def get(self, path):
+        # 命中时直接返回只读帧，未命中时解码缩放后写入两级缓存
+        key = self.make_key(path)
+        with self.lock:
+            frame = self.entries.get(key)
+            if frame is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return frame
+        frame = self.load_disk(key)
+        miss = frame is None
+        if miss:
+            started = time.perf_counter()
+            image = cv2.imread(path, cv2.IMREAD_COLOR)
+            if image is None:
+                return None
+            height, width = panel_geometry()
+            frame = fit_to_panel(image, height, width)
+            if METRICS_ENABLED:
+                IMAGE_DECODE_SECONDS.observe(time.perf_counter() - started)
+            self.save_disk(key, frame)
+        frame.flags.writeable = False
+        self.put(key, frame, miss)
+        return frame
+
+    def put(self, key, frame, miss):
+        with self.lock:
+            # 未命中与磁盘命中的计数和其他计数一样在锁内更新
+            if miss:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+            if key in self.entries:
+                return
+            self.entries[key] = frame
+            self.size += frame.nbytes
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, old = self.entries.popitem(last=False)
+                self.size -= old.nbytes
+
+    def load_disk(self, key):
+        path = os.path.join(self.folder, key + '.npy')
+        try:
+            frame = np.load(path)
+            os.utime(path)  # 以 mtime 记录最近使用时间
+            return frame
+        except (OSError, ValueError):
+            return None
+
+    def save_disk(self, key, frame):
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            tmp_path = os.path.join(self.folder, key + '.tmp.npy')
+            np.save(tmp_path, frame)
+            os.replace(tmp_path, os.path.join(self.folder, key + '.npy'))
+            self.evict_disk()
+        except OSError as e:
+            print(f"Image cache write failed: {e}")
+
+    def evict_disk(self):
+        files = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.npy'):
+                st = entry.stat()
+                files.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+image_cache = ImageCache()
+
+class FrameSlotSource(ContentSource):
+    """最新帧槽：生产者线程写入，引擎线程取走，只保留最新一帧"""
+    idle = True
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.frame = None
+
+    def push(self, frame):
+        with self.lock:
+            self.frame = frame
+        engine.wakeup.set()  # 立即输出，不等下一个帧间隔
+
+    def next_frame(self, now):
+        with self.lock:
+            frame, self.frame = self.frame, None
+        return frame
+
+# 共享内存帧输入：外部程序（仪表盘、游戏演示等）通过 led_shared_frames.SharedFrameWriter 直接写帧
+SHARED_FRAMES_PATH = os.environ.get('LED_SHARED_FRAMES', SHARED_FRAMES_DEFAULT_PATH)
+SHARED_FRAMES_SLOTS = max(3, int(os.environ.get('LED_SHARED_FRAME_SLOTS', 3)))
+
+class SharedFrameSource(ContentSource):
+    """共享内存帧输入：每帧只检查一次序号，有新帧时直接返回 mmap 槽位的只读视图，零拷贝"""
+    def __init__(self, path=SHARED_FRAMES_PATH, slots=SHARED_FRAMES_SLOTS):
+        super().__init__()
+        self.buffer = SharedFrameBuffer.create(path, self.height, self.width, slots)
+        self.sequence = int(self.buffer.latest[0])
+        self.received = self.superseded = 0
+
+    def next_frame(self, now):
+        if int(self.buffer.latest[0]) == self.sequence:
+            return None
+        sequence, frame = self.buffer.acquire()
+        if frame is None:
+            return None
+        if self.received:
+            self.superseded += sequence - self.sequence - 1  # 引擎两次取帧之间被覆盖的帧
+        self.received += 1
+        self.sequence = sequence
+        return frame
+
+    def stats(self):
+        return {'path': self.buffer.path, 'sequence': self.sequence, 'received': self.received,
+                'superseded': self.superseded}
+
+class DisplayThread(threading.Thread):
+    """帧生产线程基类：解码、缩放后推送到渲染引擎，每个线程通过自己的 stopped 事件停止"""
+    def __init__(self, source):
+        super().__init__(daemon=True)
+        self.source = source
+        self.output = FrameSlotSource()
+        self.height, self.width = self.output.height, self.output.width
+        self.stopped = threading.Event()
+        self.preloaded = False
+
+    def preload(self):
+        # 提前开始解码，画面准备好但还不接入引擎
+        if not self.preloaded:
+            self.preloaded = True
+            super().start()
+
+    def start(self):
+        engine.set_source(self.output)
+        self.preload()
+
+    def stop(self):
+        self.stopped.set()
+
+    def rebuild(self):
+        # 面板几何变化后按新尺寸重新创建同一内容
+        return type(self)(self.source)
+
+    def emit(self, image):
+        self.output.push(fit_to_panel(image, self.height, self.width))
+
+class ImageDisplay(DisplayThread):
+    """图片显示线程，GIF 按帧循环播放"""
+    def run(self):
+        if self.source.lower().endswith('.gif'):
+            self.play_gif()
+            return
+        try:
+            frame = image_cache.get(self.source)
+        except OSError:
+            frame = None
+        if frame is None:
+            report_error(f"Failed to load image: {self.source}")
+            return
+        self.output.push(frame)
+
+    def play_gif(self):
+        cap = cv2.VideoCapture(self.source)
+        delay = 1.0 / (cap.get(cv2.CAP_PROP_FPS) or 10)
+        try:
+            while not self.stopped.is_set():
+                ok, image = cap.read()
+                if not ok:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    ok, image = cap.read()
+                    if not ok:
+                        break
+                self.emit(image)
+                self.stopped.wait(delay)
+        finally:
+            cap.release()
+
+VIDEO_RING_SIZE = int(os.environ.get('LED_VIDEO_RING_SIZE', 8))
+
+class FrameRing:
+    """预分配的定长帧环：解码线程写入，引擎线程读取（单生产者单消费者）"""
+    def __init__(self, size, height, width):
+        self.size = size
+        self.frames = np.zeros((size, height, width, 3), dtype=np.uint8)
+        self.pts = np.zeros(size)  # 相对播放起点的显示时刻（秒）
+        self.head = 0  # 已写入的帧数
+        self.tail = 0  # 已释放的帧数
+        self.cond = threading.Condition()
+
+    def acquire(self, timeout=0.1):
+        # 环满时等待消费者释放槽位，超时返回 None
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.head - self.tail < self.size, timeout):
+                return None
+        return self.head % self.size
+
+    def commit(self, pts):
+        self.pts[self.head % self.size] = pts
+        with self.cond:
+            self.head += 1
+
+    def release(self, count):
+        if count > 0:
+            with self.cond:
+                self.tail += count
+                self.cond.notify()
+
+class VideoSource(ContentSource):
+    """按单调时钟为帧环定时出帧，落后时丢帧追赶而不是整体漂移"""
+    def __init__(self, ring_size=VIDEO_RING_SIZE):
+        super().__init__()
+        self.ring = FrameRing(ring_size, self.height, self.width)
+        self.frame_interval = 1.0 / 30
+        self.start_time = None
+        self.showing = False  # 环尾那一帧正在显示，未释放
+        self.starved = False
+        self.shown = self.dropped = self.late = self.underruns = 0
+
+    def next_frame(self, now):
+        ring = self.ring
+        index = ring.tail + (1 if self.showing else 0)
+        pending = ring.head - index
+        if pending <= 0:
+            # 到了下一帧的时刻却没有可用帧，记一次欠载
+            if (self.start_time is not None and not self.starved and
+                    now > self.start_time + ring.pts[(index - 1) % ring.size] + 2 * self.frame_interval):
+                self.starved = True
+                self.underruns += 1
+                if METRICS_ENABLED:
+                    VIDEO_UNDERRUNS.inc()
+            return None
+        if self.start_time is None:
+            self.start_time = now - ring.pts[index % ring.size]
+        if now < self.start_time + ring.pts[index % ring.size]:
+            return None
+        # 后一帧也已到期时丢弃当前帧
+        while pending > 1 and now >= self.start_time + ring.pts[(index + 1) % ring.size]:
+            index += 1
+            pending -= 1
+            self.dropped += 1
+            if METRICS_ENABLED:
+                FRAMES_DROPPED.inc()
+        slot = index % ring.size
+        if now - (self.start_time + ring.pts[slot]) > self.frame_interval:
+            self.late += 1
+            if METRICS_ENABLED:
+                FRAMES_LATE.inc()
+        ring.release(index - ring.tail)
+        self.showing = True
+        self.starved = False
+        self.shown += 1
+        return ring.frames[slot]
+
+    def stats(self):
+        return {
+            'shown': self.shown,
+            'decoded': self.ring.head,
+            'buffered': self.ring.head - self.ring.tail,
+            'dropped': self.dropped,
+            'late': self.late,
+            'underruns': self.underruns,
+        }
+
+class VideoDisplay(DisplayThread):
+    """视频解码线程：提前解码、缩放到帧环，由引擎线程按源帧率出帧，循环播放本地文件或 URL"""
+    def __init__(self, source):
+        super().__init__(source)
+        self.output = VideoSource()
+
+    def stats(self):
+        return self.output.stats()
+
+    def run(self):
+        cap = cv2.VideoCapture(self.source)
+        if not cap.isOpened():
+            report_error(f"Failed to open video: {self.source}")
+            return
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        if not 0 < fps <= 240:
+            fps = 30
+        self.output.frame_interval = 1.0 / fps
+        ring = self.output.ring
+        index = 0
+        try:
+            while not self.stopped.is_set():
+                started = time.perf_counter() if METRICS_ENABLED else 0
+                ok, image = cap.read()
+                if not ok:
+                    # 播放结束后从头循环，网络流无法回退时重新打开
+                    if not cap.set(cv2.CAP_PROP_POS_FRAMES, 0):
+                        cap.release()
+                        cap = cv2.VideoCapture(self.source)
+                    ok, image = cap.read()
+                    if not ok:
+                        break
+                slot = None
+                waiting = time.perf_counter() if METRICS_ENABLED else 0
+                while slot is None and not self.stopped.is_set():
+                    slot = ring.acquire()
+                waited = time.perf_counter() - waiting if METRICS_ENABLED else 0
+                if slot is None:
+                    break
+                if image.shape[:2] != (self.height, self.width):
+                    image = cv2.resize(image, (self.width, self.height), interpolation=cv2.INTER_AREA)
+                cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=ring.frames[slot])
+                if METRICS_ENABLED:
+                    # 不含等待空槽位的时间
+                    DECODE_SECONDS.observe(time.perf_counter() - started - waited)
+                ring.commit(index / fps)
+                index += 1
+        finally:
+            cap.release()
+
+# 面板分辨率原始帧容器：头部 + 连续的 RGB 帧，播放时直接 memmap，无需解码
+RAW_VIDEO_FOLDER = os.path.join(UPLOAD_FOLDER, '.raw')
+RAW_VIDEO_MAGIC = b'LEDR'
+RAW_VIDEO_HEADER = struct.Struct('<4sHHHfI')  # magic, 版本, 高, 宽, fps, 帧数
+RAW_VIDEO_HEADER_SIZE = 64  # 头部补齐到 64 字节，帧数据保持对齐
+TRANSCODE_ON_UPLOAD = os.environ.get('LED_TRANSCODE_ON_UPLOAD', '1') == '1'
+
+def raw_video_path(filename):
+    return os.path.join(RAW_VIDEO_FOLDER, filename + '.ledraw')
+
+def read_raw_header(path):
+    with open(path, 'rb') as f:
+        magic, version, height, width, fps, count = RAW_VIDEO_HEADER.unpack(f.read(RAW_VIDEO_HEADER.size))
+    if magic != RAW_VIDEO_MAGIC or version != 1:
+        raise ValueError(f"Not a raw video container: {path}")
+    return height, width, fps, count
+
+def raw_video_ready(filename):
+    # 容器存在、不比源文件旧且几何与当前面板一致才可直接播放
+    raw_path = raw_video_path(filename)
+    try:
+        if os.path.getmtime(raw_path) < os.path.getmtime(os.path.join(UPLOAD_FOLDER, filename)):
+            return False
+        height, width, _, count = read_raw_header(raw_path)
+    except (OSError, ValueError, struct.error):
+        return False
+    return (height, width) == panel_geometry() and count > 0
+
+def transcode_video(filename):
+    # 解码一次并缩放到面板分辨率，写完后原子替换旧容器
+    cap = cv2.VideoCapture(os.path.join(UPLOAD_FOLDER, filename))
+    if not cap.isOpened():
+        raise OSError(f"Failed to open video: {filename}")
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    if not 0 < fps <= 240:
+        fps = 30
+    height, width = panel_geometry()
+    raw_path = raw_video_path(filename)
+    tmp_path = raw_path + '.tmp'
+    os.makedirs(RAW_VIDEO_FOLDER, exist_ok=True)
+    count = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(bytes(RAW_VIDEO_HEADER_SIZE))
+            while True:
+                ok, image = cap.read()
+                if not ok:
+                    break
+                f.write(fit_to_panel(image, height, width).data)
+                count += 1
+            f.seek(0)
+            f.write(RAW_VIDEO_HEADER.pack(RAW_VIDEO_MAGIC, 1, height, width, fps, count))
+        os.replace(tmp_path, raw_path)
+    finally:
+        cap.release()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return count
+
+class Transcoder:
+    """后台转码队列，同一文件排队期间只转码一次"""
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, filename):
+        with self.lock:
+            if filename in self.pending:
+                return
+            self.pending.add(filename)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._worker, name='transcoder', daemon=True)
+                self.thread.start()
+        self.queue.put(filename)
+
+    def submit_all(self):
+        # 面板几何变化后重新生成所有已有的容器
+        if not os.path.isdir(RAW_VIDEO_FOLDER):
+            return
+        for name in os.listdir(RAW_VIDEO_FOLDER):
+            if name.endswith('.ledraw') and os.path.exists(os.path.join(UPLOAD_FOLDER, name[:-7])):
+                self.submit(name[:-7])
+
+    def _worker(self):
+        while True:
+            filename = self.queue.get()
+            try:
+                if not raw_video_ready(filename):
+                    transcode_video(filename)
+            except Exception as e:
+                report_error(f"Transcode failed for {filename}: {e}")
+            finally:
+                with self.lock:
+                    self.pending.discard(filename)
+
+transcoder = Transcoder()
+
+class RawVideoSource(ContentSource):
+    """memmap 原始帧容器，按单调时钟直接返回帧视图，零解码零拷贝"""
+    def __init__(self, path):
+        super().__init__()
+        height, width, fps, count = read_raw_header(path)
+        self.frames = np.memmap(path, dtype=np.uint8, mode='r', offset=RAW_VIDEO_HEADER_SIZE,
+                                shape=(count, height, width, 3))
+        self.fps = fps
+        self.start_time = None
+        self.index = -1
+        self.shown = self.dropped = 0
+
+    def next_frame(self, now):
+        if self.start_time is None:
+            self.start_time = now
+        index = int((now - self.start_time) * self.fps)
+        if index == self.index:
+            return None
+        if self.index >= 0 and index > self.index + 1:
+            self.dropped += index - self.index - 1
+            if METRICS_ENABLED:
+                FRAMES_DROPPED.inc(index - self.index - 1)
+        self.index = index
+        self.shown += 1
+        return self.frames[index % len(self.frames)]
+
+    def stats(self):
+        return {'shown': self.shown, 'dropped': self.dropped, 'frames': len(self.frames), 'raw': True}
+
+class RawVideoDisplay(DisplayThread):
+    """原始帧容器播放，不需要解码线程"""
+    def __init__(self, source):
+        super().__init__(source)
+        self.output = RawVideoSource(source)
+
+    def rebuild(self):
+        # 原始帧容器按旧几何转码，重新选择容器或回退到解码播放
+        return video_display_for(os.path.basename(self.source)[:-len('.ledraw')])
+
+    def stats(self):
+        return self.output.stats()
+
+    def run(self):
+        pass
+
+def video_display_for(filename):
+    if raw_video_ready(filename):
+        return RawVideoDisplay(raw_video_path(filename))
+    if TRANSCODE_ON_UPLOAD and os.path.exists(os.path.join(UPLOAD_FOLDER, filename)):
+        transcoder.submit(filename)
+    return VideoDisplay(os.path.join(UPLOAD_FOLDER, filename))
+
+def video_command(source, factory):
+    # 进程内播放需要矩阵绑定；没有时像原来一样交给外部的 video-viewer
+    if engine.missing():
+        return 'process', lambda: ['video-viewer', '--led-slowdown-gpio=2', '-f'] + build_base_args() + [source]
+    return 'thread', factory
+
+def start_display_thread(filename):
+    controller.submit(*video_command(os.path.join(UPLOAD_FOLDER, filename), lambda: video_display_for(filename)))
+
+# 字体目录与 BDF 字形图集
+FONT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rpi-rgb-led-matrix', 'fonts')
+FONT_EXTENSIONS = ('.ttf', '.otf', '.woff2', '.ttc', '.bdf')
+
+class GlyphAtlas:
+    """BDF 字体的紧凑字形图集：所有字形位图拼在一张数组里，附带步进与包围盒数组"""
+    def __init__(self, ascent, descent, codepoints, advance, bbox, offsets, bitmap):
+        self.ascent = ascent
+        self.descent = descent
+        self.height = ascent + descent
+        self.codepoints = codepoints  # (n,) int32
+        self.advance = advance        # (n,) int16，水平步进
+        self.bbox = bbox              # (n, 4) int16：宽、高、x 偏移、y 偏移
+        self.offsets = offsets        # (n,) int32，字形在 bitmap 中的起始行
+        self.bitmap = bitmap          # (总行数, 最大宽度) bool
+        self.index = {cp: i for i, cp in enumerate(codepoints.tolist())}
+        self.fallback = self.index.get(ord('?'), 0)
+
+    def lookup(self, char):
+        return self.index.get(ord(char), self.fallback)
+
+    def glyph(self, i):
+        w, h, _, _ = self.bbox[i]
+        return self.bitmap[self.offsets[i]:self.offsets[i] + h, :w]
+
+    def text_width(self, text):
+        return int(sum(self.advance[self.lookup(c)] for c in text))
+
+    def draw(self, canvas, text, x, y, color):
+        # y 为文字顶部，基线在 y + ascent，与 text-scroller/clock 的坐标含义一致
+        baseline = y + self.ascent
+        height, width = canvas.shape[:2]
+        for char in text:
+            i = self.lookup(char)
+            w, h, xoff, yoff = (int(v) for v in self.bbox[i])
+            left, top = x + xoff, baseline - yoff - h
+            x0, y0 = max(left, 0), max(top, 0)
+            x1, y1 = min(left + w, width), min(top + h, height)
+            if x0 < x1 and y0 < y1:
+                mask = self.glyph(i)[y0 - top:y1 - top, x0 - left:x1 - left]
+                canvas[y0:y1, x0:x1][mask] = color
+            x += int(self.advance[i])
+        return x
+
+def parse_bdf(path):
+    ascent = descent = None
+    font_bbox = (0, 0, 0, 0)
+    glyphs = []
+    with open(path, 'rb') as f:
+        lines = iter(f.read().splitlines())
+    for line in lines:
+        if line.startswith(b'FONTBOUNDINGBOX'):
+            font_bbox = tuple(int(v) for v in line.split()[1:5])
+        elif line.startswith(b'FONT_ASCENT'):
+            ascent = int(line.split()[1])
+        elif line.startswith(b'FONT_DESCENT'):
+            descent = int(line.split()[1])
+        elif line.startswith(b'STARTCHAR'):
+            codepoint, dwidth, bbx, rows = -1, None, None, []
+            for line in lines:
+                if line.startswith(b'ENCODING'):
+                    codepoint = int(line.split()[1])
+                elif line.startswith(b'DWIDTH'):
+                    dwidth = int(line.split()[1])
+                elif line.startswith(b'BBX'):
+                    bbx = tuple(int(v) for v in line.split()[1:5])
+                elif line.startswith(b'BITMAP') and bbx:
+                    rows = [bytes.fromhex(next(lines).strip().decode()) for _ in range(bbx[1])]
+                elif line.startswith(b'ENDCHAR'):
+                    break
+            if codepoint >= 0 and bbx:
+                glyphs.append((codepoint, bbx[0] if dwidth is None else dwidth, bbx, rows))
+    if not glyphs:
+        raise ValueError(f"No glyphs in BDF font: {path}")
+    if ascent is None:
+        ascent = font_bbox[1] + font_bbox[3]
+    if descent is None:
+        descent = -font_bbox[3]
+    glyphs.sort(key=lambda g: g[0])
+    # 所有位图行补齐到同一字节宽度后一次 unpackbits
+    row_bytes = max(1, max((len(r) for g in glyphs for r in g[3]), default=1))
+    rows = [r.ljust(row_bytes, b'\0') for g in glyphs for r in g[3]]
+    packed = np.frombuffer(b''.join(rows), dtype=np.uint8).reshape(-1, row_bytes)
+    bitmap = np.unpackbits(packed, axis=1).astype(bool)
+    heights = np.array([len(g[3]) for g in glyphs], dtype=np.int32)
+    offsets = np.concatenate(([0], np.cumsum(heights)[:-1])).astype(np.int32)
+    return GlyphAtlas(
+        ascent, descent,
+        np.array([g[0] for g in glyphs], dtype=np.int32),
+        np.array([g[1] for g in glyphs], dtype=np.int16),
+        np.array([g[2] for g in glyphs], dtype=np.int16).reshape(-1, 4),
+        offsets,
+        bitmap,
+    )
+
+class FontRegistry:
+    """字体注册表：目录 mtime 不变时不重新扫描，BDF 首次使用时才解析，文件更新后重新加载"""
+    def __init__(self, folder=FONT_FOLDER):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.dir_mtime = None
+        self.names = []
+        self.atlases = {}  # 字体名 -> (文件 mtime, GlyphAtlas)
+
+    def list(self):
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder, exist_ok=True)
+            os.chmod(self.folder, 0o755)  # 设置适当权限
+        dir_mtime = os.stat(self.folder).st_mtime_ns
+        if dir_mtime != self.dir_mtime:
+            self.names = sorted(name for name in os.listdir(self.folder)
+                                if name.lower().endswith(FONT_EXTENSIONS))
+            self.dir_mtime = dir_mtime
+        return list(self.names)
+
+    def path(self, name):
+        return os.path.join(self.folder, os.path.basename(name))
+
+    def get(self, name):
+        path = self.path(name)
+        if not name.lower().endswith('.bdf'):
+            raise ValueError(f"Only BDF fonts can be rendered in-process: {name}")
+        mtime = os.path.getmtime(path)
+        cached = self.atlases.get(name)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with self.lock:
+            cached = self.atlases.get(name)
+            if cached and cached[0] == mtime:
+                return cached[1]
+            atlas = parse_bdf(path)
+            self.atlases[name] = (mtime, atlas)
+            return atlas
+
+font_registry = FontRegistry()
+
+class TextSource(ContentSource):
+    """进程内文字滚动：文字只渲染一次到宽条带，每帧取条带在当前偏移处的切片视图"""
+    PARAMS = ('text', 'font', 'color', 'speed', 'x', 'y')
+
+    def __init__(self, text, font, color, speed, x=0, y=0):
+        super().__init__()
+        self.position = 0.0     # 文字左边缘在面板上的浮点位置，支持亚像素累加
+        self.last_time = None
+        self.offset = None
+        self.update(text=text, font=font, color=color, speed=speed, x=x, y=y)
+        self.apply_pending()
+
+    def prepare(self, params):
+        # 条带在调用线程里渲染，引擎线程只做替换
+        atlas = font_registry.get(params['font'])
+        text, speed = params['text'], float(params['speed'])
+        text_width = atlas.text_width(text)
+        if speed:
+            # 一个周期 = 文字宽度 + 一屏空白，尾部再拼接一屏，保证任意偏移的切片都是连续视图
+            period = text_width + self.width
+            strip = np.zeros((self.height, period + self.width, 3), dtype=np.uint8)
+            atlas.draw(strip, text, 0, params['y'], params['color'])
+            strip[:, period:] = strip[:, :self.width]
+        else:
+            period = None
+            strip = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+            atlas.draw(strip, text, params['x'], params['y'], params['color'])
+        # text-scroller 的速度单位是“每秒字符数”，按平均字宽换算成像素/秒
+        return strip, period, speed * text_width / max(len(text), 1)
+
+    def apply(self, params, layout):
+        if params['x'] != self.params.get('x'):
+            self.position = float(params['x'])
+        self.layout = layout
+        self.offset = None
+
+    def next_frame(self, now):
+        strip, period, pixels_per_second = self.layout
+        if period is None:
+            if self.offset == 0:
+                return None
+            self.offset = 0
+            return strip
+        if self.last_time is not None:
+            # 正速度从右向左移动，与 text-scroller 一致
+            self.position -= pixels_per_second * (now - self.last_time)
+        self.last_time = now
+        offset = int(-self.position) % period
+        if offset == self.offset:
+            return None
+        self.offset = offset
+        return strip[:, offset:offset + self.width]
+
+class ClockSource(ContentSource):
+    """进程内时钟：两行只排版一次，每秒只重绘字符发生变化的格子，并报告脏矩形"""
+    PARAMS = ('font', 'color', 'x', 'y', 'formats')
+
+    def __init__(self, font, color, x=0, y=0, formats=('%H:%M:%S', '%Y-%m-%d')):
+        super().__init__()
+        self.canvas = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        self.update(font=font, color=color, x=x, y=y, formats=formats)
+        self.apply_pending()
+
+    def prepare(self, params):
+        return font_registry.get(params['font'])
+
+    def apply(self, params, atlas):
+        # 参数变化后整屏重排
+        self.atlas = atlas
+        self.lines = [None] * len(params['formats'])
+        self.cells = [None] * len(params['formats'])  # 每行每个字符格子的 (x, 宽)
+        self.second = None
+
+    def layout(self, row, text):
+        # 按字符步进计算格子位置，行内容长度或字宽变化时才需要重新排版
+        x = self.params['x']
+        cells = []
+        for char in text:
+            advance = int(self.atlas.advance[self.atlas.lookup(char)])
+            cells.append((x, advance))
+            x += advance
+        self.cells[row] = cells
+
+    def draw_cell(self, row, i, char, dirty):
+        x, advance = self.cells[row][i]
+        top = self.params['y'] + row * self.atlas.height
+        x0, y0 = max(x, 0), max(top, 0)
+        x1, y1 = min(x + advance, self.width), min(top + self.atlas.height, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        cell = self.canvas[y0:y1, x0:x1]
+        cell.fill(0)
+        self.atlas.draw(cell, char, x - x0, top - y0, self.params['color'])
+        dirty.append((x0, y0, x1 - x0, y1 - y0))
+
+    def next_frame(self, now):
+        second = int(time.time())
+        if second == self.second:
+            return None
+        self.second = second
+        moment = datetime.datetime.fromtimestamp(second)
+        dirty = []
+        for row, fmt in enumerate(self.params['formats']):
+            text, previous = moment.strftime(fmt), self.lines[row]
+            if previous is None or len(text) != len(previous) or any(
+                    self.atlas.advance[self.atlas.lookup(a)] != self.atlas.advance[self.atlas.lookup(b)]
+                    for a, b in zip(text, previous) if a != b):
+                # 首次绘制或字宽变化：整行重排
+                if previous is None and row == 0:
+                    self.canvas.fill(0)
+                    dirty.append((0, 0, self.width, self.height))
+                elif previous is not None:
+                    # 旧排版的字符可能超出新格子，先清掉整行
+                    top = self.params['y'] + row * self.atlas.height
+                    y0, y1 = max(top, 0), min(top + self.atlas.height, self.height)
+                    if y0 < y1:
+                        self.canvas[y0:y1].fill(0)
+                        dirty.append((0, y0, self.width, y1 - y0))
+                self.layout(row, text)
+                changed = range(len(text))
+            else:
+                changed = [i for i, (a, b) in enumerate(zip(text, previous)) if a != b]
+            for i in changed:
+                self.draw_cell(row, i, text[i], dirty)
+            self.lines[row] = text
+        self.dirty = dirty
+        return self.canvas if dirty else None
+
 def build_base_args():
     return [
         f"--led-rows={HARDWARE_CONFIG['rows']}",
@@ -53,31 +1902,476 @@ def build_base_args():
         f"--led-brightness={HARDWARE_CONFIG['brightness']}",
         f"--led-pwm-bits={HARDWARE_CONFIG['pwm_bits']}",
         f"--led-rgb-sequence={HARDWARE_CONFIG['rgb_sequence']}"
-    ]
+    ] + pixel_mapper_args()
+
+def pixel_mapper_args():
+    # 外部程序只能表达库自带的映射：U-mapper（链对折成两行蛇形）和整体旋转
+    mappers = []
+    if HARDWARE_CONFIG['chain_rows'] == 2 and HARDWARE_CONFIG['serpentine']:
+        mappers.append('U-mapper')
+    if HARDWARE_CONFIG['rotation']:
+        mappers.append(f"Rotate:{HARDWARE_CONFIG['rotation']}")
+    return [f"--led-pixel-mapper={';'.join(mappers)}"] if mappers else []
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+class DisplayController:
+    """显示控制器：唯一持有当前内容（外部进程、帧生产线程、内容源），命令在自己的线程里串行执行，
+    积压的切换命令只执行最后一条，之后的参数更新合并为一次；开关屏命令只与开关屏命令合并"""
+    CONTENT_COMMANDS = ('source', 'ready', 'thread', 'process', 'stop')
+    POWER_COMMANDS = ('off', 'on')
+
+    def command_kind(self, command):
+        # 批量命令按其中的内容命令归类
+        kind, payload = command[0], command[1]
+        if kind == 'batch':
+            kind = payload['content'][0] if payload.get('content') else None
+        return kind
+
+    def is_content(self, command):
+        return self.command_kind(command) in self.CONTENT_COMMANDS
+
+    def is_power(self, command):
+        return self.command_kind(command) in self.POWER_COMMANDS
+
+    def __init__(self):
+        self.commands = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.process = None
+        self.process_command = None
+        self.producer = None
+        self.submitted = self.executed = self.coalesced = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._loop, name='display-controller', daemon=True)
+            self.thread.start()
+
+    def submit(self, kind, payload=None, wait=False):
+        # 命令: source (类, 参数, 备用命令行) / ready 已准备好的内容源或生产线程 / thread 生产线程工厂
+        #       process 命令行 / params / stop / off / on
+        #       batch {'hardware', 'color', 'content': 上述内容命令}
+        self.start()
+        command = (kind, payload, time.monotonic(), threading.Event())
+        with self.lock:
+            self.submitted += 1  # 多个请求线程同时提交
+        self.commands.put(command)
+        if wait:
+            command[3].wait()
+        return command
+
+    def _loop(self):
+        while True:
+            batch = [self.commands.get()]
+            while True:
+                try:
+                    batch.append(self.commands.get_nowait())
+                except queue.Empty:
+                    break
+            last = max((i for i, c in enumerate(batch) if self.is_content(c)), default=-1)
+            # 开关屏只作用于它之前的内容：在最后一条切换命令之前的开关屏被新内容取代
+            power = max((i for i, c in enumerate(batch) if self.is_power(c)), default=-1)
+            if power < last:
+                power = -1
+            params = {}
+            for kind, payload, _, _ in batch[last + 1:]:
+                if kind == 'params':
+                    params.update(payload)
+            try:
+                for i, (kind, payload, requested_at, _) in enumerate(batch):
+                    if i == last:
+                        self._execute(kind, payload, requested_at)
+                    elif kind == 'ready':
+                        discard_prepared(payload)  # 被合并掉的预加载内容要释放
+                    elif kind == 'batch' and i != power:
+                        # 被合并掉的批量命令仍要应用其中的硬件与颜色设置
+                        self._execute(kind, dict(payload, content=None), requested_at)
+                if params and engine.content() is not None:
+                    engine.content().update(**params)
+                if power >= 0:
+                    self._execute(*batch[power][:3])
+            except Exception as e:
+                report_error(f"Display command failed: {e}")
+            finally:
+                status_hub.poke()  # 内容变化后立即推送，不必等下一次采样
+                executed = (last >= 0) + (power >= 0) + bool(params) + sum(
+                    1 for i, c in enumerate(batch) if c[0] == 'batch' and i not in (last, power))
+                self.executed += executed
+                self.coalesced += len(batch) - executed
+                for command in batch:
+                    command[3].set()
+
+    def _rebuild_command(self):
+        # 按新几何重建当前内容的命令：内容源带上最新的实时参数，帧生产线程重新创建，外部程序重新生成参数
+        if self.process is not None:
+            return 'process', self.process_command
+        if self.producer is not None:
+            return 'thread', self.producer.rebuild
+        source = engine.paused_source or engine.content()
+        if source is None or isinstance(source, FrameSlotSource):
+            return None
+        return 'source', (type(source), dict(source.requested), None)
+
+    def _execute(self, kind, payload, requested_at):
+        if kind == 'batch':
+            # 持有渲染锁，引擎只会看到整体生效后的配置与内容，后端最多重新初始化一次
+            with engine.render_lock:
+                geometry = panel_geometry()
+                HARDWARE_CONFIG.update(payload.get('hardware') or {})
+                if payload.get('color'):
+                    set_color(**payload['color'])
+                if payload.get('content'):
+                    self._execute(*payload['content'], requested_at)
+                elif panel_geometry() != geometry:
+                    # 当前内容按旧尺寸生成的帧会被引擎丢弃，在同一个事务里按新几何重建
+                    rebuild, paused = self._rebuild_command(), engine.paused_source is not None
+                    if rebuild is not None:
+                        self._execute(*rebuild, requested_at)
+                        if paused:
+                            engine.off()
+            if TRANSCODE_ON_UPLOAD and panel_geometry() != geometry:
+                transcoder.submit_all()
+        elif kind == 'source':
+            cls, params, fallback = payload
+            if fallback and engine.missing():
+                # 没有矩阵绑定时进程内渲染无处输出，文字和时钟直接交给外部程序
+                return self._execute('process', fallback, requested_at)
+            current = engine.content()
+            if (isinstance(current, cls) and self.process is None and self.producer is None and
+                    (current.height, current.width) == panel_geometry()):
+                # 同类内容只更新参数，不重建；面板几何变化后要按新尺寸重建
+                current.update(**params)
+                return
+            try:
+                source = cls(**params)
+            except (OSError, ValueError) as e:
+                if not fallback:
+                    raise
+                report_error(f"In-process {cls.__name__} failed, falling back to external program: {e}")
+                return self._execute('process', fallback, requested_at)
+            self._stop_owned()
+            source.requested_at = requested_at
+            engine.set_source(source)
+        elif kind == 'ready' and not isinstance(payload, DisplayThread):
+            self._stop_owned()
+            payload.requested_at = requested_at
+            engine.set_source(payload)
+        elif kind in ('thread', 'ready'):
+            producer = payload if kind == 'ready' else payload()
+            self._stop_owned()
+            producer.output.requested_at = requested_at
+            producer.start()
+            self.producer = producer
+        elif kind == 'process':
+            self._stop_owned()
+            engine.release()  # 外部程序需要独占矩阵
+            self.process_command = payload
+            try:
+                self.process = subprocess.Popen(
+                    payload() if callable(payload) else payload,
+                    preexec_fn=os.setsid  # 创建进程组以便终止整个进程树
+                )
+                if METRICS_ENABLED:
+                    PROCESS_SWITCH_SECONDS.observe(time.monotonic() - requested_at)
+            except Exception as e:
+                report_error(f"Command failed: {e}")
+        elif kind == 'stop':
+            self._stop_owned()
+            engine.set_source(None)
+        elif kind == 'off':
+            # 外部程序无法暂停，只能结束；进程内内容暂停后可恢复
+            self._stop_process()
+            engine.off()
+        elif kind == 'on':
+            engine.on()
+
+    def _stop_process(self):
+        if self.process:
+            try:
+                os.killpg(os.getpgid(self.process.pid), signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            self.process = None
+
+    def _stop_owned(self):
+        self._stop_process()
+        if self.producer:
+            # 通知帧生产线程退出并等待其结束
+            self.producer.stop()
+            if self.producer.is_alive():
+                self.producer.join(timeout=2)
+            self.producer = None
+
+    def describe(self):
+        # 当前内容的简要描述：外部程序、帧生产线程或进程内内容源
+        if self.process is not None:
+            return {'type': 'process', 'program': self.process.args[0]}
+        if self.producer is not None:
+            return {'type': type(self.producer).__name__, 'source': self.producer.source}
+        source = engine.content()
+        if source is None:
+            return {'type': None}
+        content = {'type': type(source).__name__, 'params': dict(source.requested or source.params)}
+        if engine.paused_source is not None:
+            content['off'] = True
+        return content
+
+    def stats(self):
+        latencies = list(engine.switch_latencies)
+        return {
+            'queue_depth': self.commands.qsize(),
+            'submitted': self.submitted,
+            'executed': self.executed,
+            'coalesced': self.coalesced,
+            'switches': len(latencies),
+            'switch_latency_ms': {
+                'last': latencies[-1] * 1000 if latencies else None,
+                'p50': percentile(latencies, 50) * 1000 if latencies else None,
+                'p99': percentile(latencies, 99) * 1000 if latencies else None,
+            },
+        }
+
+controller = DisplayController()
+
+def discard_prepared(prepared):
+    if isinstance(prepared, DisplayThread):
+        prepared.stop()
+    else:
+        prepared.close()
 
 def run_command(cmd_args):
-    global current_process
-    stop_current()
-    # 添加错误处理
-    try:
-        current_process = subprocess.Popen(
-            cmd_args,
-            preexec_fn=os.setsid  # 创建进程组以便终止整个进程树
-        )
-    except Exception as e:
-        print(f"Command failed: {e}")
+    controller.submit('process', cmd_args)
+
+def stop_current(wait=False):
+    controller.submit('stop', wait=wait)
+
+STATUS_EVENT_INTERVAL = float(os.environ.get('LED_STATUS_EVENT_INTERVAL', 0.5))
+
+class StatusHub:
+    """状态推送：单个采样线程比较状态快照，只有变化的部分才通知订阅者；订阅者再多也只采样一次"""
+    STATS_KEYS = ('dropped', 'late', 'underruns')
+
+    def __init__(self, interval=STATUS_EVENT_INTERVAL):
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.wakeup = threading.Event()
+        self.version = 0
+        self.state = {}
+        self.changed_at = {}  # 每个键最后一次变化时的版本号，慢订阅者据此一次拿到合并后的差异
+        self.subscribers = 0
+        self.thread = None
+        self.frames = self.sampled_at = None
+
+    def snapshot(self):
+        now = time.monotonic()
+        frames = engine.frames_shown
+        fps = 0
+        if self.sampled_at is not None and now > self.sampled_at:
+            fps = round((frames - self.frames) / (now - self.sampled_at))
+        self.frames, self.sampled_at = frames, now
+        producer = controller.producer
+        stats = producer.stats() if hasattr(producer, 'stats') else {}
+        return {
+            'content': controller.describe(),
+            'color': dict(COLOR_CONFIG),
+            'hardware': dict(HARDWARE_CONFIG),
+            'fps': fps,
+            'frames': {k: v for k, v in stats.items() if k in self.STATS_KEYS},
+            'errors': list(recent_errors),
+        }
+
+    def sample(self):
+        state = json.loads(json.dumps(self.snapshot()))  # 统一成 JSON 类型后再比较，元组与列表视为相同
+        with self.cond:
+            changed = [k for k, v in state.items() if self.state.get(k) != v]
+            if changed:
+                self.version += 1
+                for key in changed:
+                    self.state[key] = state[key]
+                    self.changed_at[key] = self.version
+                self.cond.notify_all()
+
+    def poke(self):
+        self.wakeup.set()
+
+    def subscribe(self):
+        with self.cond:
+            self.subscribers += 1
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._loop, name='status-hub', daemon=True)
+                self.thread.start()
+        self.sample()
+        with self.cond:
+            return self.version, dict(self.state)
+
+    def unsubscribe(self):
+        with self.cond:
+            self.subscribers -= 1
+
+    def wait(self, version, timeout):
+        # 阻塞到出现比 version 新的变化或超时，返回 (新版本, 变化的键值)
+        with self.cond:
+            self.cond.wait_for(lambda: self.version > version, timeout)
+            changes = {k: self.state[k] for k, v in self.changed_at.items() if v > version}
+            return self.version, changes
+
+    def _loop(self):
+        # 没有订阅者时采样线程退出，不产生任何开销
+        while True:
+            with self.cond:
+                if self.subscribers <= 0:
+                    self.thread = None
+                    return
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Status sample failed: {e}")
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+status_hub = StatusHub()
+
+PREVIEW_FPS = float(os.environ.get('LED_PREVIEW_FPS', 10))
+PREVIEW_SCALE = int(os.environ.get('LED_PREVIEW_SCALE', 8))
+PREVIEW_QUALITY = int(os.environ.get('LED_PREVIEW_QUALITY', 80))
+
+class PreviewStream:
+    """面板实时预览：引擎线程只在有观看者且到达预览间隔时拷贝一帧逻辑画布，校色与编码在独立线程完成，
+    每帧只编码一次供所有观看者共享，与上一帧相同的画面不再编码"""
+    def __init__(self, fps=PREVIEW_FPS, scale=PREVIEW_SCALE, quality=PREVIEW_QUALITY):
+        self.interval = 1.0 / fps
+        self.scale = max(1, scale)
+        self.quality = quality
+        self.cond = threading.Condition()
+        self.wakeup = threading.Event()
+        self.viewers = 0
+        self.thread = None
+        self.next_due = 0
+        self.pending = None  # 待编码的帧副本
+        self.last = None     # 上一次编码的帧
+        self.jpeg = None
+        self.seq = 0
+        self.encoded = self.skipped = 0
 
-def stop_current():
-    global current_process
-    if current_process:
+    def offer(self, frame):
+        # 引擎线程调用，无人观看或未到间隔时立即返回
+        if not self.viewers:
+            return
+        now = time.monotonic()
+        if now < self.next_due:
+            return
+        self.next_due = now + self.interval
+        self.pending = frame.copy()
+        self.wakeup.set()
+
+    def subscribe(self):
+        with self.cond:
+            self.viewers += 1
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._loop, name='preview', daemon=True)
+                self.thread.start()
+            if self.jpeg is None:
+                # 静态画面不会再输出新帧，用引擎最后一帧（无内容时为黑屏）作为起始画面
+                frame = engine.last_frame if engine.source is not None else None
+                if frame is None:
+                    frame = np.zeros(panel_geometry() + (3,), dtype=np.uint8)
+                self.pending = frame.copy()
+                self.wakeup.set()
+
+    def unsubscribe(self):
+        with self.cond:
+            self.viewers -= 1
+
+    def frames(self):
+        # multipart/x-mixed-replace 生成器；画面长时间不变时重发当前帧，以便发现断开的连接
+        self.subscribe()
         try:
-            os.killpg(os.getpgid(current_process.pid), signal.SIGTERM)
-        except ProcessLookupError:
-            pass
-        current_process = None
+            seq = 0
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: self.seq != seq, timeout=5)
+                    seq, jpeg = self.seq, self.jpeg
+                if jpeg is not None:
+                    yield (b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' +
+                           str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg + b'\r\n')
+        finally:
+            self.unsubscribe()
+
+    def _encode(self, frame):
+        frame = color_lut.apply(frame)  # 引擎交给预览的是校色前的逻辑画布，在预览线程里校色
+        if self.last is not None and self.last.shape == frame.shape and np.array_equal(self.last, frame):
+            self.skipped += 1
+            return
+        self.last = frame
+        image = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_NEAREST)
+        ok, data = cv2.imencode('.jpg', cv2.cvtColor(image, cv2.COLOR_RGB2BGR),
+                                [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            return
+        with self.cond:
+            self.jpeg = data.tobytes()
+            self.seq += 1
+            self.encoded += 1
+            self.cond.notify_all()
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                if self.viewers <= 0:
+                    # 没有观看者时退出，下次观看从当前画面重新开始
+                    self.thread = self.jpeg = self.last = self.pending = None
+                    return
+            if not self.wakeup.wait(1):
+                continue
+            self.wakeup.clear()
+            frame, self.pending = self.pending, None
+            if frame is not None:
+                try:
+                    self._encode(frame)
+                except Exception as e:
+                    print(f"Preview encode failed: {e}")
+
+    def stats(self):
+        return {'viewers': self.viewers, 'encoded': self.encoded, 'skipped': self.skipped}
+
+preview = PreviewStream()
+
+def producer_stat(key):
+    producer = controller.producer
+    return producer.stats().get(key) if hasattr(producer, 'stats') else None
+
+def cache_hit_ratio():
+    lookups = image_cache.hits + image_cache.disk_hits + image_cache.misses
+    return (image_cache.hits + image_cache.disk_hits) / lookups if lookups else None
+
+metrics.collect('led_frames_shown_total', 'Frames sent to the panel', lambda: engine.frames_shown, 'counter')
+metrics.collect('led_backend_inits_total', 'Panel backend initializations', lambda: engine.backend_inits, 'counter')
+metrics.collect('led_command_queue_depth', 'Display commands waiting for the controller', lambda: controller.commands.qsize())
+metrics.collect('led_commands_coalesced_total', 'Display commands merged into a later one', lambda: controller.coalesced, 'counter')
+metrics.collect('led_video_buffered_frames', 'Decoded frames waiting in the video ring', lambda: producer_stat('buffered'))
+metrics.collect('led_image_cache_hits_total', 'Image cache memory hits', lambda: image_cache.hits, 'counter')
+metrics.collect('led_image_cache_disk_hits_total', 'Image cache disk hits', lambda: image_cache.disk_hits, 'counter')
+metrics.collect('led_image_cache_misses_total', 'Image cache misses', lambda: image_cache.misses, 'counter')
+metrics.collect('led_image_cache_hit_ratio', 'Share of image lookups served from cache', cache_hit_ratio)
+metrics.collect('led_image_cache_bytes', 'Bytes held by the in-memory image cache', lambda: image_cache.size)
+metrics.collect('led_transcode_pending', 'Videos waiting for raw transcoding', lambda: len(transcoder.pending))
+metrics.collect('led_preview_viewers', 'Connected preview viewers', lambda: preview.viewers)
+metrics.collect('led_status_subscribers', 'Connected status event clients', lambda: status_hub.subscribers)
+
+def sse_message(event, version, data):
+    return f"event: {event}\nid: {version}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 # 检查是否以root权限运行
 def check_root_permission():
+    if engine.backend_name in ('framebuffer', 'network'):
+        return  # 软件帧缓冲与多节点分发不访问 GPIO
     if os.geteuid() != 0:
         print("This script must be run as root to access GPIO pins.")
         print("Please run the script with `sudo`:")
@@ -88,8 +2382,9 @@ def check_root_permission():
 @app.route('/status')
 def get_status():
     status = {
-        'rgb': session.get('rgb', [1.0, 1.0, 1.0]),
-        'brightness': session.get('brightness', 50),
+        'rgb': session.get('rgb', COLOR_CONFIG['rgb']),
+        'brightness': session.get('brightness', COLOR_CONFIG['brightness']),
+        'gamma': COLOR_CONFIG['gamma'],
         'text': session.get('text', ''),
         'color': session.get('color', '#ff0000'),
         'speed': session.get('speed', 5),
@@ -99,31 +2394,82 @@ def get_status():
         'rgb_order': session.get('rgb_order', DEFAULT_RGB_ORDER),
         'dark_mode': session.get('dark_mode', False)
     }
+    if hasattr(controller.producer, 'stats'):
+        status['video'] = controller.producer.stats()
+    status['controller'] = controller.stats()
+    status['engine'] = {'backend': engine.backend_name, 'backend_inits': engine.backend_inits,
+                        'backend_error': engine.backend_error or None,
+                        'frames_shown': engine.frames_shown, 'renderer': renderer.stats()}
+    if isinstance(engine.content(), SharedFrameSource):
+        status['engine']['shared'] = engine.content().stats()
+    if hasattr(engine.backend, 'stats'):
+        status['engine']['network'] = engine.backend.stats()
+    status['preview'] = preview.stats()
+    status['playlist'] = scheduler.stats()
+    status['transition'] = engine.transition_stats()
+    if http_server is not None:
+        status['http'] = http_server.stats()
     return jsonify(status)
 
+# Server-Sent Events：连接时推送完整状态，之后只在变化时推送差异，空闲时发送心跳注释
+@app.route('/events')
+def status_events():
+    def stream():
+        version, state = status_hub.subscribe()
+        try:
+            yield sse_message('state', version, state)
+            while True:
+                version, changes = status_hub.wait(version, timeout=15)
+                yield sse_message('diff', version, changes) if changes else ': keepalive\n\n'
+        finally:
+            status_hub.unsubscribe()
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Prometheus 文本格式的运行指标；LED_METRICS=0 关闭
+@app.route('/metrics')
+def get_metrics():
+    if not METRICS_ENABLED:
+        return Response('metrics disabled\n', status=404, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# 面板画面的 MJPEG 预览，可直接用 <img src="/preview"> 观看
+@app.route('/preview')
+def preview_stream():
+    return Response(preview.frames(), mimetype='multipart/x-mixed-replace; boundary=frame',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 # 列出上传的视频文件
 @app.route('/videos')
 def list_videos():
-    videos = []
-    for filename in os.listdir(UPLOAD_FOLDER):
-        if filename.lower().endswith(tuple(ALLOWED_VIDEO_EXTENSIONS)):
-            videos.append(filename)
-    return jsonify(videos)
+    return jsonify(media_index.names('video'))
 
 # 列出上传的图片文件
 @app.route('/images')
 def list_images():
-    images = []
-    for filename in os.listdir(UPLOAD_FOLDER):
-        if filename.lower().endswith(tuple(ALLOWED_IMAGE_EXTENSIONS)):
-            images.append(filename)
-    return jsonify(images)
+    return jsonify(media_index.names('image'))
+
+# 分页、过滤的媒体列表，例如 /media?kind=video&q=demo&offset=0&limit=50&sort=mtime&desc=1
+@app.route('/media')
+def list_media():
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(500, max(1, int(request.args.get('limit', 50))))
+    except ValueError:
+        return jsonify(success=False, error='Invalid offset/limit'), 400
+    kind = request.args.get('kind')
+    if kind not in (None, 'image', 'video'):
+        return jsonify(success=False, error='Unknown kind'), 400
+    total, items = media_index.list(kind, request.args.get('q'), offset, limit,
+                                    request.args.get('sort', 'filename'),
+                                    request.args.get('desc', '0').lower() in ('1', 'true'))
+    return jsonify(success=True, total=total, offset=offset, limit=limit, items=items)
 
 # Web 界面
 @app.route('/')
 def index():
-    videos = [f for f in os.listdir(UPLOAD_FOLDER) if f.lower().endswith(tuple(ALLOWED_VIDEO_EXTENSIONS))]
-    images = [f for f in os.listdir(UPLOAD_FOLDER) if f.lower().endswith(tuple(ALLOWED_IMAGE_EXTENSIONS))]
+    videos = media_index.names('video')
+    images = media_index.names('image')
     dark_mode = session.get('dark_mode', False)
     hardware_mapping = session.get('hardware_mapping', DEFAULT_RGB_ORDER)
     return render_template_string('''
@@ -366,7 +2712,8 @@ input[type="number"] {
                         <button type="submit">显示时钟</button>
                     </form>
                     <h3>亮度调节</h3>
-                    <input type="range" id="brightness" min="0" max="100" step="1" value="{{ brightness }}">
+                    <input type="range" id="brightness" min="0" max="100" step="1" value="{{ brightness }}"
+                           oninput="sendLiveParams({brightness: parseInt(this.value)})">
                     <button onclick="setBrightness()">设置亮度</button>
                 </div>
 
@@ -451,8 +2798,32 @@ fetch('/status')
                 // 更新滑块值显示
                 function updateValue(channel, value) {
                     document.getElementById(`${channel}Value`).textContent = `${value}%`;
+                    sendLiveParams({rgb: ['red', 'green', 'blue'].map(c => parseFloat(document.getElementById(c).value) / 100)});
                 }
 
+// 实时参数：同一时间只有一个请求在途，拖动期间的中间值合并为最新一次
+let liveParams = null;
+let liveInFlight = false;
+function sendLiveParams(params) {
+    liveParams = Object.assign(liveParams || {}, params);
+    if (liveInFlight) {
+        return;
+    }
+    const body = liveParams;
+    liveParams = null;
+    liveInFlight = true;
+    fetch('/params', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify(body)
+    }).finally(() => {
+        liveInFlight = false;
+        if (liveParams) {
+            sendLiveParams({});
+        }
+    });
+}
+
                 // 应用 RGB 通道设置
 function applyRGB() {
     const red = parseFloat(document.getElementById('red').value) / 100;
@@ -643,7 +3014,7 @@ document.getElementById('darkModeToggle').addEventListener('change', function()
             </script>
         </body>
         </html>
-    ''', rgb=session.get('rbg', [1.0, 1.0, 1.0]), brightness=session.get('brightness', 50),
+    ''', rgb=session.get('rgb', COLOR_CONFIG['rgb']), brightness=session.get('brightness', COLOR_CONFIG['brightness']),
        text=session.get('text', ''), color=session.get('color', '#ffffff'), speed=session.get('speed', 5),
        scroll=session.get('scroll', True), uploaded_image=session.get('uploaded_image', ''),
        videos=videos, images=images, rgb_order=session.get('rgb_order', DEFAULT_RGB_ORDER),
@@ -651,20 +3022,10 @@ document.getElementById('darkModeToggle').addEventListener('change', function()
 
 @app.route('/fonts')
 def list_fonts():
-    fonts = []
     try:
-        # 使用动态路径获取方式
-        font_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "./rpi-rgb-led-matrix/fonts")
-        
-        # 添加目录存在性检查
-        if not os.path.exists(font_dir):
-            os.makedirs(font_dir, exist_ok=True)
-            os.chmod(font_dir, 0o755)  # 设置适当权限
-        for filename in os.listdir(font_dir):
-            if filename.lower().endswith(('.ttf', '.otf', '.woff2', '.ttc', '.bdf')):
-                fonts.append(filename)
+        fonts = font_registry.list()
     except Exception as e:
-        print(f"Error accessing fonts directory: {e}")
+        report_error(f"Error accessing fonts directory: {e}")
         return jsonify([])  # 返回空列表而不是500错误
     
     return jsonify(fonts)
@@ -681,66 +3042,205 @@ def set_clock_font(font):
 
 @app.route('/rgb_order/<string:order>')
 def set_rgb_order(order):
+    if order not in RGB_ORDERS:
+        return jsonify({'success': False, 'rgb_order': COLOR_CONFIG['rgb_order']})
     session['rgb_order'] = order
+    set_color(rgb_order=order)
     return jsonify({'success': True, 'rgb_order': order})
 
+def parse_hex_color(value):
+    if not isinstance(value, str):
+        raise ValueError(f"Invalid color: {value!r}")
+    value = value.lstrip('#')
+    if len(value) != 6:
+        raise ValueError(f"Invalid color: #{value}")
+    return tuple(int(value[i:i+2], 16) for i in (0, 2, 4))
+
+def parse_number(value, name):
+    # JSON 数字或数字字符串；布尔值、NaN 与无穷大都不是合法参数
+    if isinstance(value, bool):
+        raise ValueError(f"{name} must be a number")
+    try:
+        number = float(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"{name} must be a number") from None
+    if not math.isfinite(number):
+        raise ValueError(f"{name} must be a finite number")
+    return number
+
+def parse_integer(value, name):
+    # 整数或整数字符串，1.5 这样的小数不会被悄悄截断
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f"{name} must be an integer") from None
+    number = parse_number(value, name)
+    if not number.is_integer():
+        raise ValueError(f"{name} must be an integer")
+    return int(number)
+
+def parse_content_params(data):
+    # 校验文字/时钟的内容参数，入队之前发现错误，渲染线程只会拿到合法的值
+    params = {}
+    if 'text' in data:
+        if not isinstance(data['text'], str):
+            raise ValueError('text must be a string')
+        params['text'] = data['text']
+    for key in ('x', 'y'):
+        if key in data:
+            params[key] = parse_integer(data[key], key)
+    if 'speed' in data:
+        params['speed'] = parse_number(data['speed'], 'speed')
+    return params
+
+def text_command(data, font):
+    # 返回控制器命令；命令行参数延迟到执行时生成，批量配置中的硬件参数已生效
+    values = parse_content_params(dict({'x': 0, 'y': 0}, **data))
+    text, speed = values['text'], values['speed']
+    r, g, b = parse_hex_color(data['color'])
+    x = values['x']  # 新增x坐标
+    y = values['y']  # 新增y坐标
+    scroll_direction = -abs(speed) if data.get('scroll', True) else abs(speed)
+
+    def cmd():
+        return [
+            'text-scroller',
+            '-s', str(scroll_direction),
+            '-f', f'./rpi-rgb-led-matrix/fonts/{font}',
+            '-x', str(x),  # 新增x参数
+            '-y', str(y),  # 新增y参数
+            '-C', f'{r},{g},{b}',
+            '-l', '-1'
+        ] + build_base_args() + [text]
+
+    # BDF 字体在进程内渲染，失败时回退到 text-scroller；已在显示文字时原地更新参数
+    if font.lower().endswith('.bdf'):
+        params = dict(text=text, font=font, color=(r, g, b), speed=scroll_direction, x=x, y=y)
+        return 'source', (TextSource, params, cmd)
+    return 'process', cmd
+
+def clock_command(data, font):
+    values = parse_content_params({k: data.get(k, 0) for k in ('x', 'y')})
+    r, g, b = parse_hex_color(data.get('color', '#FFFF00'))
+    x = values['x']  # 新增x坐标
+    y = values['y']  # 新增y坐标
+
+    def cmd():
+        return [
+            'clock',
+            '-f', f'./rpi-rgb-led-matrix/fonts/{font}',
+            '-x', str(x),  # 新增x参数
+            '-y', str(y),  # 新增y参数
+            '-C', f'{r},{g},{b}',
+            '-d', '%H:%M:%S',
+            '-d', '%Y-%m-%d'
+        ] + build_base_args()
+
+    if font.lower().endswith('.bdf'):
+        return 'source', (ClockSource, dict(font=font, color=(r, g, b), x=x, y=y), cmd)
+    return 'process', cmd
+
 @app.route('/text', methods=['POST'])
 def show_text():
     data = request.json
-    text = data['text']
-    color = data['color'].lstrip('#')
-    r, g, b = [int(color[i:i+2], 16) for i in (0, 2, 4)]
-    speed = data['speed']
-    x = data.get('x', 0)  # 新增x坐标
-    y = data.get('y', 0)  # 新增y坐标
-    scroll_direction = -abs(speed) if data.get('scroll', True) else abs(speed)
     font = session.get('text_font', '原神cn.bdf')
-
-    cmd = [
-        'text-scroller',
-        '-s', str(scroll_direction),
-        '-f', f'./rpi-rgb-led-matrix/fonts/{font}',
-        '-x', str(x),  # 新增x参数
-        '-y', str(y),  # 新增y参数
-        '-C', f'{r},{g},{b}',
-        '-l', '-1'
-    ] + build_base_args() + [text]
-    
-    run_command(cmd)
+    try:
+        command = text_command(data, font)
+    except (KeyError, ValueError) as e:
+        return jsonify(success=False, error=str(e)), 400
+    session.update(text=data['text'], color=data['color'], speed=data['speed'], scroll=data.get('scroll', True))
+    controller.submit(*command)
     return jsonify(success=True)
 
 @app.route('/clock', methods=['POST'])
 def show_clock():
     data = request.json
-    color = data.get('color', '#FFFF00').lstrip('#')
-    r, g, b = [int(color[i:i+2], 16) for i in (0, 2, 4)]
-    x = data.get('x', 0)  # 新增x坐标
-    y = data.get('y', 0)  # 新增y坐标
     font = session.get('clock_font', '6x13.bdf')
-
-    cmd = [
-        'clock',
-        '-f', f'./rpi-rgb-led-matrix/fonts/{font}',
-        '-x', str(x),  # 新增x参数
-        '-y', str(y),  # 新增y参数
-        '-C', f'{r},{g},{b}',
-        '-d', '%H:%M:%S',
-        '-d', '%Y-%m-%d'
-    ] + build_base_args()
-    
-    run_command(cmd)
+    try:
+        command = clock_command(data, font)
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+    controller.submit(*command)
     return jsonify(success=True)
 
 @app.route('/brightness/<int:brightness>')
 def set_brightness(brightness):
+    brightness = max(0, min(100, brightness))
     session['brightness'] = brightness
+    set_color(brightness=brightness)
     return jsonify({'success': True, 'brightness': brightness})
 
 @app.route('/rgb/<float:r>/<float:g>/<float:b>')
 def set_rgb(r, g, b):
-    # 实际需要将颜色设置应用到命令行工具参数
     session['rgb'] = [r, g, b]
-    return jsonify(success=True)
+    set_color(rgb=[r, g, b])
+    return jsonify(success=True, rgb=[r, g, b])
+
+@app.route('/gamma/<float:gamma>')
+def set_gamma(gamma):
+    if gamma <= 0:
+        return jsonify(success=False, gamma=COLOR_CONFIG['gamma'])
+    set_color(gamma=gamma)
+    return jsonify(success=True, gamma=gamma)
+
+# 默认转场，例如 {"effect": "crossfade", "duration": 0.5}
+@app.route('/transition', methods=['POST'])
+def set_transition():
+    try:
+        TRANSITION_CONFIG.update(validate_transition(request.json or {}))
+    except (TypeError, ValueError) as e:
+        return jsonify(success=False, error=str(e)), 400
+    return jsonify(success=True, transition=TRANSITION_CONFIG)
+
+# 实时参数通道：颜色参数进查找表，内容参数进当前内容源，都在下一帧生效，不重启显示
+@app.route('/params', methods=['POST'])
+def update_params():
+    data = request.json or {}
+    try:
+        color = parse_color_params(data)
+        content = parse_content_params(data)
+        if 'color' in data:
+            content['color'] = parse_hex_color(data['color'])
+        if 'speed' in content:
+            content['speed'] = -abs(content['speed']) if data.get('scroll', True) else abs(content['speed'])
+    except (TypeError, ValueError) as e:
+        return jsonify(success=False, error=str(e)), 400
+    applied = list(color)
+    if color:
+        session.update({k: v for k, v in color.items() if k != 'gamma'})
+        set_color(**color)
+    if content:
+        controller.submit('params', content)
+        applied += list(content)
+    return jsonify(success=True, applied=applied)
+
+def parse_color_params(data):
+    # 非有限值会让查找表在转换时变成全零，面板全黑，必须在这里拒绝
+    color = {}
+    if 'brightness' in data:
+        color['brightness'] = max(0, min(100, parse_integer(data['brightness'], 'brightness')))
+    if 'rgb' in data:
+        if not isinstance(data['rgb'], (list, tuple)) or len(data['rgb']) != 3:
+            raise ValueError('rgb needs three gains')
+        color['rgb'] = [parse_number(v, 'rgb gain') for v in data['rgb']]
+        if min(color['rgb']) < 0:
+            raise ValueError('rgb gains must not be negative')
+    if 'gamma' in data:
+        color['gamma'] = parse_number(data['gamma'], 'gamma')
+        if color['gamma'] <= 0:
+            raise ValueError('gamma must be positive')
+    if 'rgb_order' in data:
+        if data['rgb_order'] not in RGB_ORDERS:
+            raise ValueError(f"Unknown rgb_order: {data['rgb_order']}")
+        color['rgb_order'] = data['rgb_order']
+    return color
+
+def set_color(**params):
+    # 更新颜色参数，只有参数真正变化时才重建查找表
+    COLOR_CONFIG.update(params)
+    if color_lut.update(**COLOR_CONFIG):
+        engine.wakeup.set()  # 静态画面按新参数重新输出
 
 @app.route('/command/<cmd>')
 def command(cmd):
@@ -749,38 +3249,300 @@ def command(cmd):
         stop_current()
         return jsonify(success=True, message="Screen cleared")
     elif cmd == 'off':
-        # 设置亮度为0
-        run_command(['text-scroller', '-C', '0,0,0', '-B', '0,0,0', ' '])  # 显示黑色背景
+        # 引擎内输出黑屏，不再重启外部程序
+        controller.submit('off')
         return jsonify(success=True, message="Display turned off")
     elif cmd == 'on':
-        # 恢复默认亮度
-        run_command(['text-scroller', '-C', '255,255,255', '-B', '0,0,0', ' '])  # 显示白色背景
+        # 恢复关闭前的内容
+        controller.submit('on')
         return jsonify(success=True, message="Display turned on")
     else:
         return jsonify(success=False, message="Unknown command")
 
+# 媒体索引：SQLite 持久化，列表请求只需一次目录 stat，不再每次 listdir
+MEDIA_DB_PATH = os.path.join(UPLOAD_FOLDER, '.media.db')
+MEDIA_SORT_COLUMNS = {'filename', 'size', 'mtime', 'duration'}
+
+def media_kind(filename):
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if ext in ALLOWED_VIDEO_EXTENSIONS:
+        return 'video'
+    if ext in ALLOWED_IMAGE_EXTENSIONS:
+        return 'image'
+    return None
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class MediaIndex:
+    """上传媒体的 SQLite 索引：按目录 mtime 增量扫描，尺寸/时长/哈希由后台线程补全"""
+    def __init__(self, path=MEDIA_DB_PATH, folder=UPLOAD_FOLDER):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript('''
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS media (
+                filename TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                size INTEGER,
+                width INTEGER,
+                height INTEGER,
+                duration REAL,
+                fps REAL,
+                hash TEXT,
+                mtime REAL
+            );
+            CREATE INDEX IF NOT EXISTS media_kind ON media (kind, filename);
+            CREATE INDEX IF NOT EXISTS media_hash ON media (hash);
+        ''')
+        self.dir_mtime = None
+        self.probe_queue = queue.Queue()
+        self.prober = None
+
+    def refresh(self):
+        # 目录 mtime 未变化时什么都不做
+        try:
+            dir_mtime = os.stat(self.folder).st_mtime_ns
+        except OSError:
+            return
+        if dir_mtime != self.dir_mtime:
+            self.scan()
+            self.dir_mtime = dir_mtime
+
+    def scan(self):
+        entries = {}
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                kind = media_kind(entry.name)
+                if kind and entry.is_file():
+                    st = entry.stat()
+                    entries[entry.name] = (kind, st.st_size, st.st_mtime)
+        changed = []
+        with self.lock:
+            known = {row['filename']: (row['size'], row['mtime'])
+                     for row in self.db.execute('SELECT filename, size, mtime FROM media')}
+            self.db.executemany('DELETE FROM media WHERE filename = ?',
+                                [(name,) for name in known.keys() - entries.keys()])
+            for name, (kind, size, mtime) in entries.items():
+                if known.get(name) != (size, mtime):
+                    self.db.execute('INSERT OR REPLACE INTO media (filename, kind, size, mtime) VALUES (?, ?, ?, ?)',
+                                    (name, kind, size, mtime))
+                    changed.append(name)
+            self.db.commit()
+        for name in changed:
+            self.queue_probe(name)
+
+    def add(self, filename, content_id=None):
+        # 上传完成后立即入库，不等下一次扫描
+        kind = media_kind(filename)
+        if kind is None:
+            return
+        st = os.stat(os.path.join(self.folder, filename))
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO media (filename, kind, size, hash, mtime) VALUES (?, ?, ?, ?, ?)',
+                            (filename, kind, st.st_size, content_id, st.st_mtime))
+            self.db.commit()
+        self.queue_probe(filename)
+
+    def queue_probe(self, filename):
+        self.probe_queue.put(filename)
+        if self.prober is None or not self.prober.is_alive():
+            self.prober = threading.Thread(target=self._probe_worker, name='media-prober', daemon=True)
+            self.prober.start()
+
+    def _probe_worker(self):
+        while True:
+            filename = self.probe_queue.get()
+            try:
+                self.probe(filename)
+            except Exception as e:
+                print(f"Media probe failed for {filename}: {e}")
+
+    def probe(self, filename):
+        path = os.path.join(self.folder, filename)
+        with self.lock:
+            row = self.db.execute('SELECT * FROM media WHERE filename = ?', (filename,)).fetchone()
+        if row is None or not os.path.exists(path):
+            return
+        width = height = duration = fps = None
+        if row['kind'] == 'image' and not filename.lower().endswith('.gif'):
+            image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+            if image is not None:
+                height, width = image.shape[:2]
+        else:
+            cap = cv2.VideoCapture(path)
+            if cap.isOpened():
+                width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) or None
+                height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or None
+                fps = cap.get(cv2.CAP_PROP_FPS) or None
+                frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+                duration = frames / fps if fps and frames > 0 else None
+            cap.release()
+        content_id = row['hash'] or file_sha256(path)
+        with self.lock:
+            # 探测期间文件被替换时放弃本次结果
+            self.db.execute('UPDATE media SET width = ?, height = ?, duration = ?, fps = ?, hash = ? '
+                            'WHERE filename = ? AND mtime = ?',
+                            (width, height, duration, fps, content_id, filename, row['mtime']))
+            self.db.commit()
+
+    def find_by_hash(self, content_id):
+        with self.lock:
+            row = self.db.execute('SELECT filename FROM media WHERE hash = ? LIMIT 1', (content_id,)).fetchone()
+        return row['filename'] if row else None
+
+    def list(self, kind=None, query=None, offset=0, limit=None, sort='filename', desc=False):
+        self.refresh()
+        where, args = [], []
+        if kind:
+            where.append('kind = ?')
+            args.append(kind)
+        if query:
+            where.append('filename LIKE ?')
+            args.append(f'%{query}%')
+        clause = (' WHERE ' + ' AND '.join(where)) if where else ''
+        if sort not in MEDIA_SORT_COLUMNS:
+            sort = 'filename'
+        with self.lock:
+            total = self.db.execute('SELECT COUNT(*) FROM media' + clause, args).fetchone()[0]
+            rows = self.db.execute(f'SELECT * FROM media{clause} ORDER BY {sort} {"DESC" if desc else "ASC"} '
+                                   'LIMIT ? OFFSET ?', args + [-1 if limit is None else limit, offset]).fetchall()
+        return total, [dict(row) for row in rows]
+
+    def names(self, kind):
+        return [item['filename'] for item in self.list(kind)[1]]
+
+# 流式上传：按固定块直接写入 uploads/ 并同时计算 sha256，相同内容只保存一份
+UPLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_TMP_FOLDER = os.path.join(UPLOAD_FOLDER, '.incoming')
+MAX_IMAGE_UPLOAD_BYTES = int(os.environ.get('LED_MAX_IMAGE_UPLOAD_BYTES', 32 * 1024 * 1024))
+MAX_VIDEO_UPLOAD_BYTES = int(os.environ.get('LED_MAX_VIDEO_UPLOAD_BYTES', 1024 * 1024 * 1024))
+
+class UploadRejected(Exception):
+    pass
+
+class UploadWriter:
+    """边接收边写盘并计算哈希的上传文件流，超出大小限制立即中止"""
+    def __init__(self, filename, max_bytes):
+        os.makedirs(UPLOAD_TMP_FOLDER, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=UPLOAD_TMP_FOLDER)
+        self.file = os.fdopen(fd, 'wb', buffering=UPLOAD_CHUNK_SIZE)
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if METRICS_ENABLED:
+            UPLOAD_BYTES.inc(len(data))
+        if self.size > self.max_bytes:
+            raise RequestEntityTooLarge()
+        self.hash.update(data)
+        return self.file.write(data)
+
+    def seek(self, offset, whence=0):
+        # 解析器结束时会 seek(0)，数据已落盘，无需回读
+        return 0
+
+    def close(self):
+        self.file.close()
+
+    def discard(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class ContentStore:
+    """内容寻址的上传存储，sha256 → 文件名的映射保存在媒体索引中"""
+    def __init__(self, index):
+        self.index = index
+        self.lock = threading.Lock()
+
+    def commit(self, writer):
+        # 已有相同内容时丢弃新文件，否则移入 uploads/，重名时追加内容 id 前缀
+        writer.close()
+        content_id = writer.hash.hexdigest()
+        with self.lock:
+            existing = self.index.find_by_hash(content_id)
+            if existing and os.path.exists(os.path.join(UPLOAD_FOLDER, existing)):
+                os.remove(writer.path)
+                return existing, content_id, True
+            filename = secure_filename(writer.filename)
+            if os.path.exists(os.path.join(UPLOAD_FOLDER, filename)):
+                stem, ext = os.path.splitext(filename)
+                filename = f"{stem}-{content_id[:8]}{ext}"
+            os.replace(writer.path, os.path.join(UPLOAD_FOLDER, filename))
+            self.index.add(filename, content_id)
+        return filename, content_id, False
+
+media_index = MediaIndex()
+content_store = ContentStore(media_index)
+
+def receive_upload(allowed_extensions, max_bytes):
+    # 不经过 request.files，直接把 multipart 的文件部分流式写入存储
+    if request.content_length is not None and request.content_length > max_bytes:
+        raise RequestEntityTooLarge()
+    writers = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        if not filename or '.' not in filename or \
+                filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
+            raise UploadRejected(f"File type not allowed: {filename}")
+        writer = UploadWriter(filename, max_bytes)
+        writers.append(writer)
+        return writer
+
+    try:
+        _, _, files = parse_form_data(request.environ, stream_factory=stream_factory,
+                                      max_content_length=max_bytes + UPLOAD_CHUNK_SIZE, silent=False)
+        upload = files.get('file')
+        if upload is None:
+            raise UploadRejected("No file uploaded")
+        return content_store.commit(upload.stream)
+    finally:
+        for writer in writers:
+            if os.path.exists(writer.path):
+                writer.discard()
+
+def handle_upload(allowed_extensions, max_bytes):
+    started = time.perf_counter()
+    try:
+        result = receive_upload(allowed_extensions, max_bytes)
+        if METRICS_ENABLED:
+            UPLOAD_SECONDS.observe(time.perf_counter() - started)
+        return result, None
+    except RequestEntityTooLarge:
+        return None, (jsonify({'success': False, 'error': 'File too large'}), 413)
+    except UploadRejected as e:
+        return None, jsonify({'success': False, 'error': str(e)})
+
 @app.route('/upload_image', methods=['POST'])
 def upload_image():
-    file = request.files['file']
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        file.save(os.path.join(UPLOAD_FOLDER, filename))
-        session['uploaded_image'] = filename
-        return jsonify({'success': True})
-    else:
-        return jsonify({'success': False})
+    result, error = handle_upload(ALLOWED_IMAGE_EXTENSIONS, MAX_IMAGE_UPLOAD_BYTES)
+    if error:
+        return error
+    filename, content_id, duplicate = result
+    session['uploaded_image'] = filename
+    return jsonify({'success': True, 'filename': filename, 'content_id': content_id, 'duplicate': duplicate})
 
 @app.route('/upload_video', methods=['POST'])
 def upload_video():
-    file = request.files['file']
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        file.save(os.path.join(UPLOAD_FOLDER, filename))
-        session['video_source'] = filename
-        start_display_thread(filename)
-        return jsonify({'success': True})
-    else:
-        return jsonify({'success': False})
+    result, error = handle_upload(ALLOWED_VIDEO_EXTENSIONS, MAX_VIDEO_UPLOAD_BYTES)
+    if error:
+        return error
+    filename, content_id, duplicate = result
+    session['video_source'] = filename
+    if TRANSCODE_ON_UPLOAD:
+        transcoder.submit(filename)
+    start_display_thread(filename)
+    return jsonify({'success': True, 'filename': filename, 'content_id': content_id, 'duplicate': duplicate})
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
@@ -788,42 +3550,411 @@ def uploaded_file(filename):
 
 @app.route('/video/<filename>')
 def play_video(filename):
-    video_path = os.path.join(UPLOAD_FOLDER, filename)
-    cmd = [
-        'video-viewer',
-        '--led-slowdown-gpio=2',
-        '-f'  # 全屏模式
-    ] + build_base_args() + [video_path]
-    
-    run_command(cmd)
+    session['video_source'] = filename
+    start_display_thread(filename)
     return jsonify(success=True)
 
 @app.route('/hardware', methods=['POST'])
 def update_hardware():
-    config = request.json
-    for key in HARDWARE_CONFIG:
-        if key in config:
-            HARDWARE_CONFIG[key] = config[key]
+    try:
+        hardware = validate_hardware(request.json or {})
+    except (TypeError, ValueError) as e:
+        return jsonify(success=False, error=str(e)), 400
+    controller.submit('batch', {'hardware': hardware})
+    return jsonify(success=True)
+
+GPIO_MAPPINGS = ('regular', 'adafruit-hat', 'adafruit-hat-pwm', 'regular-pi1', 'classic', 'classic-pi1', 'compute-module')
+HARDWARE_LIMITS = {
+    'rows': (8, 64),
+    'cols': (16, 128),
+    'chain': (1, 16),
+    'parallel': (1, 3),
+    'brightness': (0, 100),
+    'pwm_bits': (1, 11),
+    'chain_rows': (1, 16),
+}
+PANEL_ROTATIONS = (0, 90, 180, 270)
+
+def validate_hardware(config):
+    hardware = {}
+    for key, value in config.items():
+        if key in HARDWARE_LIMITS:
+            low, high = HARDWARE_LIMITS[key]
+            if isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+                raise ValueError(f"{key} must be an integer in [{low}, {high}]")
+        elif key == 'gpio_mapping':
+            if value not in GPIO_MAPPINGS:
+                raise ValueError(f"Unknown gpio_mapping: {value}")
+        elif key == 'rgb_sequence':
+            if not isinstance(value, str) or sorted(value.upper()) != ['B', 'G', 'R']:
+                raise ValueError(f"Invalid rgb_sequence: {value}")
+            value = value.upper()
+        elif key == 'rotation':
+            if value not in PANEL_ROTATIONS:
+                raise ValueError(f"rotation must be one of {PANEL_ROTATIONS}")
+        elif key == 'serpentine':
+            if not isinstance(value, bool):
+                raise ValueError('serpentine must be true or false')
+        else:
+            raise ValueError(f"Unknown hardware setting: {key}")
+        hardware[key] = value
+    merged = dict(HARDWARE_CONFIG, **hardware)
+    if merged['chain'] % merged['chain_rows']:
+        raise ValueError('chain must be a multiple of chain_rows')
+    return hardware
+
+def content_command(spec, text_font, clock_font):
+    # 把批量配置中的内容描述转换成控制器命令，同时校验引用的文件
+    kind = spec.get('type')
+    if kind == 'text':
+        if 'text' not in spec:
+            raise ValueError('text content needs a text string')
+        return text_command(dict({'color': '#ffffff', 'speed': 5}, **spec), text_font)
+    if kind == 'clock':
+        return clock_command(spec, clock_font)
+    if kind in ('image', 'video'):
+        filename = spec.get('file', '')
+        path = os.path.join(UPLOAD_FOLDER, os.path.basename(filename))
+        if media_kind(filename) != kind or not os.path.isfile(path):
+            raise ValueError(f"No such {kind}: {filename}")
+        if kind == 'image':
+            return 'thread', lambda: ImageDisplay(path)
+        return video_command(path, lambda: video_display_for(os.path.basename(filename)))
+    if kind == 'videourl':
+        url = spec.get('url')
+        if not url:
+            raise ValueError('videourl content needs a url')
+        return video_command(url, lambda: VideoDisplay(url))
+    if kind == 'shared':
+        return 'source', (SharedFrameSource, {}, None)
+    if kind in ('clear', 'off', 'on'):
+        return {'clear': 'stop'}.get(kind, kind), None
+    raise ValueError(f"Unknown content type: {kind}")
+
+# 批量配置：一个 JSON 同时描述硬件、颜色、字体和内容，先全部校验，再作为一个事务生效
+@app.route('/batch', methods=['POST'])
+def apply_batch():
+    data = request.json or {}
+    errors = []
+    hardware, color, fonts, content = {}, {}, {}, None
+    for key in set(data) - {'hardware', 'color', 'fonts', 'content'}:
+        errors.append(f"Unknown section: {key}")
+    try:
+        hardware = validate_hardware(data.get('hardware', {}))
+    except (TypeError, ValueError, AttributeError) as e:
+        errors.append(f"hardware: {e}")
+    try:
+        color = parse_color_params(data.get('color', {}))
+    except (TypeError, ValueError) as e:
+        errors.append(f"color: {e}")
+    try:
+        fonts = data.get('fonts', {})
+        available = font_registry.list()
+        for key, font in fonts.items():
+            if key not in ('text_font', 'clock_font'):
+                raise ValueError(f"Unknown font setting: {key}")
+            if font not in available:
+                raise ValueError(f"No such font: {font}")
+    except (TypeError, ValueError, AttributeError, OSError) as e:
+        errors.append(f"fonts: {e}")
+    if 'content' in data:
+        try:
+            content = content_command(data['content'],
+                                      fonts.get('text_font', session.get('text_font', '原神cn.bdf')),
+                                      fonts.get('clock_font', session.get('clock_font', '6x13.bdf')))
+        except (TypeError, ValueError, KeyError, AttributeError) as e:
+            errors.append(f"content: {e}")
+    if errors:
+        return jsonify(success=False, errors=errors), 400
+
+    session.update(fonts)
+    session.update({k: v for k, v in color.items() if k != 'gamma'})
+    if 'gpio_mapping' in hardware:
+        session['hardware_mapping'] = hardware['gpio_mapping']
+    controller.submit('batch', {'hardware': hardware, 'color': color, 'content': content})
     return jsonify(success=True)
+
+# 播放列表：按顺序、时长和时段规则轮播内容，列表保存在上传目录里，重启后继续播放
+PLAYLIST_FILE = os.path.join(UPLOAD_FOLDER, '.playlists.json')
+PLAYLIST_MODES = ('loop', 'once', 'shuffle')
+PLAYLIST_IDLE_RETRY = 30  # 当前时段没有可播条目时的重试间隔（秒）
+
+def parse_time_of_day(value):
+    hour, minute = (int(v) for v in value.split(':'))
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f"Invalid time of day: {value}")
+    return hour * 60 + minute
+
+def playlist_item_command(item):
+    font = item.get('font')
+    return content_command(item, font or '原神cn.bdf', font or '6x13.bdf')
+
+def validate_playlist(data):
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        raise ValueError('items must be a non-empty list')
+    mode = data.get('mode', 'loop')
+    if mode not in PLAYLIST_MODES:
+        raise ValueError(f"Unknown mode: {mode}")
+    checked = []
+    for i, item in enumerate(items):
+        try:
+            item = dict(item)
+            item['duration'] = parse_number(item.get('duration', 10), 'duration')  # NaN 会让调度线程空转
+            if item['duration'] <= 0:
+                raise ValueError('duration must be positive')
+            if ('start' in item) != ('end' in item):
+                raise ValueError('start and end must be given together')
+            if 'start' in item:
+                parse_time_of_day(item['start'])
+                parse_time_of_day(item['end'])
+            if 'transition' in item:
+                item['transition'] = validate_transition(item['transition'])
+            playlist_item_command(item)
+        except (TypeError, ValueError, KeyError, AttributeError) as e:
+            raise ValueError(f"item {i}: {e}")
+        checked.append(item)
+    return {'items': checked, 'mode': mode}
+
+def item_active(item, when):
+    # 时段规则 start/end 为 HH:MM，end 早于 start 表示跨午夜
+    if 'start' not in item:
+        return True
+    start, end = parse_time_of_day(item['start']), parse_time_of_day(item['end'])
+    minute = when.hour * 60 + when.minute
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+class PlaylistScheduler:
+    """播放列表调度：按顺序、时长和时段规则切换内容，当前条目播放期间提前准备好下一条，切换时没有冷启动"""
+    def __init__(self, path=PLAYLIST_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.playlists = {}
+        self.active = None
+        self.position = -1
+        self.started_at = None
+        self.restart = False
+        self.skip = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Failed to load playlists: {e}")
+            return
+        self.playlists = data.get('playlists', {})
+        self.active = data.get('active') if data.get('active') in self.playlists else None
+
+    def save(self):
+        # 先写临时文件再原子替换，断电也不会留下半个文件
+        data = {'playlists': self.playlists, 'active': self.active}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.playlists-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2, allow_nan=False)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            os.remove(tmp_path)
+            raise
+
+    def put(self, name, playlist):
+        with self.lock:
+            self.playlists[name] = playlist
+            self.save()
+        self.wakeup.set()  # 正在播放的列表被修改时重新准备下一条
+
+    def delete(self, name):
+        with self.lock:
+            if self.playlists.pop(name, None) is None:
+                return False
+            if self.active == name:
+                self.active = None
+            self.save()
+        self.wakeup.set()
+        return True
+
+    def play(self, name):
+        with self.lock:
+            if name not in self.playlists:
+                return False
+            self.active, self.restart = name, True
+            self.save()
+        self.resume()
+        return True
+
+    def stop(self):
+        # 停止轮播，当前画面保持不变
+        with self.lock:
+            self.active = None
+            self.save()
+        self.wakeup.set()
+
+    def next(self):
+        with self.lock:
+            self.skip = True
+        self.wakeup.set()
+
+    def resume(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._loop, name='playlist', daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+
+    def _pick(self, playlist, after, when):
+        # 按模式选出 after 之后第一个在 when 时刻可播放的条目，没有则返回 None
+        items = playlist['items']
+        if playlist['mode'] == 'shuffle':
+            choices = [i for i, item in enumerate(items) if item_active(item, when)]
+            if len(choices) > 1 and after in choices:
+                choices.remove(after)
+            return random.choice(choices) if choices else None
+        if playlist['mode'] == 'once':
+            candidates = range(after + 1, len(items))
+        else:
+            candidates = [(after + 1 + i) % len(items) for i in range(len(items))]
+        return next((i for i in candidates if item_active(items[i], when)), None)
+
+    def _prepare(self, playlist, after, delay):
+        # 解码、缩放下一条内容；进程内内容源直接构造好，帧生产线程先开始解码但不接入引擎
+        index = self._pick(playlist, after, datetime.datetime.now() + datetime.timedelta(seconds=delay))
+        if index is None:
+            return playlist, None, None
+        command = playlist_item_command(playlist['items'][index])
+        transition = playlist['items'][index].get('transition')
+        try:
+            if command[0] == 'source' and not engine.missing():
+                cls, params, fallback = command[1]
+                command = ('ready', cls(**params))
+                command[1].transition = transition
+            elif command[0] == 'thread':
+                producer = command[1]()
+                producer.output.transition = transition
+                producer.preload()
+                command = ('ready', producer)
+        except (OSError, ValueError) as e:
+            print(f"Playlist preload failed, starting cold: {e}")
+        return playlist, index, command
+
+    def _loop(self):
+        prepared = None  # (列表, 条目序号, 控制器命令)
+        deadline = 0
+        while True:
+            with self.lock:
+                playlist = self.playlists.get(self.active)
+                restart = self.restart
+                if restart:
+                    self.position = -1
+                if restart or self.skip:
+                    deadline = 0
+                self.restart = self.skip = False
+            if prepared is not None and (prepared[0] is not playlist or restart):
+                if prepared[2] and prepared[2][0] == 'ready':
+                    discard_prepared(prepared[2][1])
+                prepared = None
+            if playlist is None:
+                self.started_at = None
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            now = time.monotonic()
+            if prepared is None:
+                try:
+                    prepared = self._prepare(playlist, self.position, max(0, deadline - now))
+                except Exception as e:
+                    report_error(f"Playlist item failed: {e}")
+                    prepared = (playlist, None, None)
+            if now < deadline:
+                if self.wakeup.wait(deadline - now):
+                    self.wakeup.clear()
+                continue
+            _, index, command = prepared
+            prepared = None
+            if index is None:
+                if playlist['mode'] == 'once' and self.position >= 0:
+                    self.stop()  # 单次播放结束
+                else:
+                    deadline = now + PLAYLIST_IDLE_RETRY
+                continue
+            controller.submit(*command)
+            self.position, self.started_at = index, time.time()
+            deadline = now + playlist['items'][index]['duration']
+
+    def stats(self):
+        with self.lock:
+            playlist = self.playlists.get(self.active)
+            item = playlist['items'][self.position] if playlist and 0 <= self.position < len(playlist['items']) else None
+            return {'active': self.active, 'position': self.position, 'item': item, 'started_at': self.started_at}
+
+scheduler = PlaylistScheduler()
+
+@app.route('/playlists')
+def list_playlists():
+    return jsonify(success=True, playlists=scheduler.playlists, **scheduler.stats())
+
+@app.route('/playlists/<name>', methods=['GET', 'PUT', 'DELETE'])
+def manage_playlist(name):
+    if request.method == 'PUT':
+        try:
+            playlist = validate_playlist(request.json or {})
+        except ValueError as e:
+            return jsonify(success=False, error=str(e)), 400
+        scheduler.put(name, playlist)
+        return jsonify(success=True, playlist=playlist)
+    if request.method == 'DELETE':
+        if not scheduler.delete(name):
+            return jsonify(success=False, error='No such playlist'), 404
+        return jsonify(success=True)
+    if name not in scheduler.playlists:
+        return jsonify(success=False, error='No such playlist'), 404
+    return jsonify(success=True, playlist=scheduler.playlists[name])
+
+@app.route('/playlists/<name>/play', methods=['POST'])
+def play_playlist(name):
+    if not scheduler.play(name):
+        return jsonify(success=False, error='No such playlist'), 404
+    return jsonify(success=True)
+
+@app.route('/playlist/stop', methods=['POST'])
+def stop_playlist():
+    scheduler.stop()
+    return jsonify(success=True)
+
+@app.route('/playlist/next', methods=['POST'])
+def next_playlist_item():
+    scheduler.next()
+    return jsonify(success=True)
+
 @app.route('/image/<path:image_source>')
 def show_image(image_source):
-    global current_thread
-    stop_current()
-    
     session['uploaded_image'] = image_source
     image_path = os.path.join(UPLOAD_FOLDER, image_source)
-    current_thread = ImageDisplay(image_path, session.get('rgb_order', DEFAULT_RGB_ORDER))
-    current_thread.start()
+    controller.submit('thread', lambda: ImageDisplay(image_path))
     return "Showing image"
 
+@app.route('/shared', methods=['GET', 'POST'])
+def show_shared():
+    # 切换到共享内存帧输入；等内容源建好缓冲区后返回文件路径与帧尺寸，外部程序据此映射写入
+    controller.submit('source', (SharedFrameSource, {}, None), wait=True)
+    source = engine.content()
+    if not isinstance(source, SharedFrameSource):
+        return jsonify(success=False, error=recent_errors[-1]['message'] if recent_errors else
+                       'Shared frame input unavailable'), 500
+    return jsonify(success=True, path=source.buffer.path, height=source.height, width=source.width,
+                   slots=source.buffer.slots)
+
 @app.route('/videourl/<path:video_url>')
 def play_video_from_url(video_url):
-    global current_thread
-    stop_current()
-    
     session['video_source'] = video_url
-    current_thread = VideoDisplay(video_url, session.get('rgb_order', DEFAULT_RGB_ORDER))
-    current_thread.start()
+    controller.submit(*video_command(video_url, lambda: VideoDisplay(video_url)))
     return "Playing video from URL"
 
 @app.before_request
@@ -836,7 +3967,9 @@ def initialize_session():
 # 硬件映射路由
 @app.route('/hardware_mapping/<string:mapping>')
 def set_hardware_mapping(mapping):
-    HARDWARE_CONFIG['gpio_mapping'] = mapping
+    if mapping not in GPIO_MAPPINGS:
+        return jsonify(success=False, error=f"Unknown gpio_mapping: {mapping}")
+    controller.submit('batch', {'hardware': {'gpio_mapping': mapping}})
     session['hardware_mapping'] = mapping
     return jsonify(success=True)
 @app.route('/dark_mode/<boolean:mode>', methods=['POST'])
@@ -852,9 +3985,538 @@ def secure_filename(filename):
     filename = re.sub(r'[^\w\s.-]', '', filename)
     return filename.replace(' ', '_')
 
+class FrameReceiver:
+    """接收节点：解码控制端发来的增量帧并回复确认，收到同一帧计数的 PRESENT 时才交给本机渲染引擎"""
+    def __init__(self, port, present=None):
+        self.port = port
+        self.present = present or self.show
+        self.output = None
+        self.presented = 0
+        self.geometry_warned = False
+
+    def serve_forever(self):
+        server = socket.create_server(('', self.port))
+        print(f"Receiving frames on port {self.port}")
+        while True:
+            conn, address = server.accept()
+            print(f"Controller connected from {address[0]}")
+            try:
+                self.handle(conn)  # 同一时间只服务一个控制端
+            except Exception as e:
+                # 对端发来的任何错误数据只断开这一个连接，接收节点继续等待下一个控制端
+                report_error(f"Receiver connection failed: {e}")
+            finally:
+                conn.close()
+
+    def handle(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        delta, ready = None, None  # 每个连接从关键帧开始
+        while True:
+            header = recv_exact(conn, NODE_HEADER.size)
+            if header is None:
+                return
+            magic, kind, counter, height, width, tile, length = NODE_HEADER.unpack(header)
+            if magic != NODE_MAGIC:
+                raise ValueError('Bad frame header')
+            # 头部字段来自对端，分配缓冲区之前先按本机面板尺寸检查
+            panel_height, panel_width = panel_geometry()
+            if not (0 < height <= panel_height and 0 < width <= panel_width and 0 < tile <= max(height, width)):
+                raise ValueError(f"Bad frame geometry {width}x{height} tile {tile}")
+            if length > NODE_HEADER.size + 2 * (height + tile) * (width + tile) * 3:
+                raise ValueError(f"Frame payload too large: {length} bytes")
+            payload = recv_exact(conn, length) if length else b''
+            if payload is None:
+                return
+            if kind == NODE_DATA:
+                if delta is None or (delta.height, delta.width, delta.tile) != (height, width, tile):
+                    delta = TileDelta(height, width, tile)
+                ready = (counter, delta.decode(payload))
+                conn.sendall(NODE_HEADER.pack(NODE_MAGIC, NODE_ACK, counter, 0, 0, 0, 0))
+            elif kind == NODE_PRESENT and ready is not None and ready[0] == counter:
+                self.present(counter, ready[1].copy())
+
+    def show(self, counter, frame):
+        if frame.shape[:2] != panel_geometry() and not self.geometry_warned:
+            self.geometry_warned = True
+            report_error(f"Node region {frame.shape[1]}x{frame.shape[0]} does not match the local panel "
+                         f"{panel_geometry()[1]}x{panel_geometry()[0]}")
+        if self.output is None or engine.content() is not self.output:
+            self.output = FrameSlotSource()
+            engine.set_source(self.output)
+        self.output.push(frame)
+        self.presented = counter
+
+# 生产模式 HTTP 服务：分发线程负责 accept、空闲的长连接和接收请求头，请求头收齐后按路由交给各自有界的线程池，
+# 上传、文件下载和长时间推送的流不占用控制接口的线程；LED_HTTP_SERVER=werkzeug 时仍用 Flask 开发服务器
+HTTP_SERVER = os.environ.get('LED_HTTP_SERVER', 'pooled')
+HTTP_POOLS = {
+    # 线程池: (线程数, 线程都忙时允许排队的连接数，超出直接回 503)
+    'control': (int(os.environ.get('LED_HTTP_CONTROL_WORKERS', 8)), int(os.environ.get('LED_HTTP_CONTROL_QUEUE', 64))),
+    'upload': (int(os.environ.get('LED_HTTP_UPLOAD_WORKERS', 2)), int(os.environ.get('LED_HTTP_UPLOAD_QUEUE', 2))),
+    'media': (int(os.environ.get('LED_HTTP_MEDIA_WORKERS', 16)), int(os.environ.get('LED_HTTP_MEDIA_QUEUE', 0))),
+    # /events、/preview 是不会结束的推送流，每个连接一直占用一个线程，单独成池，打开的仪表盘再多也不影响文件下载
+    'stream': (int(os.environ.get('LED_HTTP_STREAM_WORKERS', 8)), int(os.environ.get('LED_HTTP_STREAM_QUEUE', 0))),
+}
+HTTP_ROUTE_POOLS = (('/upload_', 'upload'), ('/uploads/', 'media'), ('/preview', 'stream'), ('/events', 'stream'))
+HTTP_MAX_CONNECTIONS = int(os.environ.get('LED_HTTP_MAX_CONNECTIONS', 256))  # 超出后暂停 accept，新连接留在内核队列
+HTTP_KEEPALIVE = float(os.environ.get('LED_HTTP_KEEPALIVE', 15))             # 空闲长连接保留秒数，0 表示不保持连接
+HTTP_KEEPALIVE_REQUESTS = int(os.environ.get('LED_HTTP_KEEPALIVE_REQUESTS', 1000))
+HTTP_TIMEOUT = float(os.environ.get('LED_HTTP_TIMEOUT', 30))                 # 单个请求内的读写超时
+HTTP_HEADER_TIMEOUT = float(os.environ.get('LED_HTTP_HEADER_TIMEOUT', 10))   # 从收到第一个字节起，请求头必须在此时间内收齐
+HTTP_UPLOAD_NICE = int(os.environ.get('LED_HTTP_UPLOAD_NICE', 10))           # 上传线程降低调度优先级
+HTTP_MAX_LINE = 65536
+HTTP_MAX_HEAD = 2 * HTTP_MAX_LINE  # 请求行加全部请求头的上限
+HTTP_HEAD_END = re.compile(rb'\r?\n\r?\n')
+HTTP_DRAIN_BYTES = 64 * 1024  # 应用没读完的请求体不超过此大小时读掉以复用连接，否则关闭连接
+
+class HTTPConnection:
+    """客户端连接：请求头在分发线程里收齐，之后才占用工作线程；工作线程把它当作请求体的输入流读取"""
+    def __init__(self, sock, address):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.address = address
+        self.buffer = bytearray()  # 已收到还没用掉的数据：请求头之后的请求体，或流水线上的下一个请求
+        self.head_since = None     # 开始接收当前请求头的时间
+        self.request = None        # 分发线程解析好的 (方法, 目标, 版本, 请求头, 长度)
+        self.requests = 0
+        self.idle_since = time.monotonic()
+
+    def _fill(self, size=65536):
+        data = self.sock.recv(size)
+        self.buffer += data
+        return bool(data)
+
+    def read(self, size=-1):
+        # 读满 size 字节，连接关闭时返回已有的部分
+        while (size is None or size < 0 or len(self.buffer) < size) and self._fill(max(65536, (size or 0) - len(self.buffer))):
+            pass
+        size = len(self.buffer) if size is None or size < 0 else size
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readinto(self, b):
+        if not self.buffer:
+            self._fill(len(b))
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        del self.buffer[:n]
+        return n
+
+    def readline(self, limit=-1):
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', start)
+            if end >= 0:
+                end += 1
+                break
+            start = len(self.buffer)
+            if 0 <= limit <= start or not self._fill():
+                end = len(self.buffer)
+                break
+        if 0 <= limit < end:
+            end = limit
+        return self.read(end)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class HTTPResponseWriter:
+    """WSGI start_response / write：第一次写入时才发送响应头，没有 Content-Length 时用分块编码"""
+    def __init__(self, sock, version, method, keep_alive):
+        self.sock = sock
+        self.version = version
+        self.method = method
+        self.keep_alive = keep_alive
+        self.status = self.headers = None
+        self.sent = self.chunked = self.bodyless = False
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info and self.sent:
+            raise exc_info[1].with_traceback(exc_info[2])
+        self.status, self.headers = status, headers
+        return self.write
+
+    def write(self, data):
+        if not self.sent:
+            self._send_headers(data)
+        elif data and not self.bodyless:
+            self.sock.sendall(b'%x\r\n%s\r\n' % (len(data), data) if self.chunked else data)
+
+    def _send_headers(self, data):
+        code = int(self.status.split(None, 1)[0])
+        names = {name.lower() for name, _ in self.headers}
+        self.bodyless = self.method == 'HEAD' or code < 200 or code in (204, 304)
+        lines = [f'HTTP/1.1 {self.status}'] + [f'{name}: {value}' for name, value in self.headers]
+        if 'date' not in names:
+            lines.append('Date: ' + formatdate(usegmt=True))
+        if 'content-length' not in names and not self.bodyless:
+            if self.version == 'HTTP/1.1':
+                self.chunked = True
+                lines.append('Transfer-Encoding: chunked')
+            else:
+                self.keep_alive = False  # HTTP/1.0 只能靠关闭连接结束响应体
+        if self.keep_alive:
+            lines.append(f'Keep-Alive: timeout={int(HTTP_KEEPALIVE)}')
+        else:
+            lines.append('Connection: close')
+        self.sent = True
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        if not data or self.bodyless:
+            self.sock.sendall(head)
+        elif self.chunked:
+            self.sock.sendall(head + b'%x\r\n%s\r\n' % (len(data), data))
+        else:
+            self.sock.sendall(head + data)
+
+    def finish(self):
+        if not self.sent:
+            self._send_headers(b'')
+        if self.chunked:
+            self.sock.sendall(b'0\r\n\r\n')
+
+class HTTPPool:
+    """有界工作线程池：线程都忙且排队已满时拒绝，由分发线程回 503"""
+    def __init__(self, name, workers, queue_limit, handler, nice=0):
+        self.name = name
+        self.workers = max(1, workers)
+        self.limit = self.workers + max(0, queue_limit)
+        self.handler = handler
+        self.nice = nice
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.active = 0  # 排队中 + 处理中的连接
+        self.handled = self.rejected = 0
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f'http-{name}-{i}', daemon=True).start()
+
+    def submit(self, conn):
+        with self.lock:
+            if self.active >= self.limit:
+                self.rejected += 1
+                return False
+            self.active += 1
+        self.queue.put(conn)
+        return True
+
+    def _worker(self):
+        if self.nice and hasattr(os, 'setpriority'):
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice)  # Linux 上只作用于本线程
+            except OSError:
+                pass
+        while True:
+            conn = self.queue.get()
+            try:
+                self.handler(conn)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.handled += 1
+
+    def stats(self):
+        return {'workers': self.workers, 'limit': self.limit, 'active': self.active,
+                'handled': self.handled, 'rejected': self.rejected}
+
+class PooledHTTPServer:
+    """生产模式 WSGI 服务器：HTTP/1.1 长连接，按路由分池处理，连接数、排队与空闲时间都有上限"""
+    def __init__(self, app, host, port, pools=HTTP_POOLS):
+        self.app = app
+        self.host, self.port = host, port
+        if ':' in host:
+            self.listener = socket.create_server((host, port), family=socket.AF_INET6, backlog=128,
+                                                 dualstack_ipv6=socket.has_dualstack_ipv6())
+        else:
+            self.listener = socket.create_server((host, port), backlog=128)
+        self.listener.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.lock = threading.Lock()
+        self.parked = deque()  # 工作线程处理完、交还给分发线程等待下一个请求的连接
+        self.idle = set()      # 在 selector 里等待数据的连接
+        self.connections = 0
+        self.accepting = False
+        self.running = False
+        self.pools = {name: HTTPPool(name, workers, queue_limit, self.handle_connection,
+                                     HTTP_UPLOAD_NICE if name == 'upload' else 0)
+                      for name, (workers, queue_limit) in pools.items()}
+
+    def serve_forever(self):
+        self.running = True
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self._resume_accept()
+        try:
+            while self.running:
+                for key, _ in self.selector.select(timeout=1):
+                    if key.fileobj is self.listener:
+                        self._accept()
+                    elif key.fileobj is self.wakeup:
+                        self._unpark()
+                    else:
+                        self.selector.unregister(key.fileobj)
+                        self.idle.discard(key.data)
+                        self._receive(key.data)
+                self._expire()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.running = False
+            self.listener.close()
+
+    def _resume_accept(self):
+        if not self.accepting and self.connections < HTTP_MAX_CONNECTIONS:
+            self.selector.register(self.listener, selectors.EVENT_READ)
+            self.accepting = True
+
+    def _accept(self):
+        while self.connections < HTTP_MAX_CONNECTIONS:
+            try:
+                sock, address = self.listener.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                report_error(f"HTTP accept failed: {e}")
+                return
+            with self.lock:
+                self.connections += 1
+            self._receive(HTTPConnection(sock, address))
+        # 连接数已满：暂停 accept 形成背压，有连接关闭后再恢复
+        self.selector.unregister(self.listener)
+        self.accepting = False
+
+    def _receive(self, conn):
+        # 分发线程里非阻塞地接收请求头，收齐之前不占用任何工作线程
+        try:
+            conn.sock.settimeout(0)
+            data = conn.sock.recv(65536)
+            if not data:
+                return self.close(conn)
+            conn.buffer += data
+        except BlockingIOError:
+            pass
+        except OSError:
+            return self.close(conn)
+        self._dispatch(conn)
+
+    def _dispatch(self, conn):
+        # 请求头收齐后在这里解析，按路径选择线程池；没收齐的连接回到 selector 继续等待，总时长受 HTTP_HEADER_TIMEOUT 限制
+        while conn.buffer[:1] in (b'\r', b'\n'):
+            del conn.buffer[:1]  # 请求之间多余的空行
+        match = HTTP_HEAD_END.search(conn.buffer)
+        if not match:
+            if not conn.buffer:
+                conn.head_since = None
+            elif b'\n' not in conn.buffer[:HTTP_MAX_LINE + 1]:
+                return self._reject(conn, '414 URI Too Long') if len(conn.buffer) > HTTP_MAX_LINE else self._wait(conn)
+            elif len(conn.buffer) > HTTP_MAX_HEAD:
+                return self._reject(conn, '431 Request Header Fields Too Large')
+            elif conn.head_since is None:
+                conn.head_since = time.monotonic()
+            return self._wait(conn)
+        head = bytes(conn.buffer[:match.end()])
+        del conn.buffer[:match.end()]
+        conn.head_since = None
+        try:
+            conn.request = self.parse_head(head)
+        except ValueError as e:
+            return self._reject(conn, str(e) if str(e)[:3].isdigit() else '400 Bad Request')
+        path = conn.request[1]
+        name = next((pool for prefix, pool in HTTP_ROUTE_POOLS if path.startswith(prefix)), 'control')
+        if not self.pools[name].submit(conn):
+            self._reject(conn, '503 Service Unavailable', 'Retry-After: 1\r\n')
+
+    def parse_head(self, head):
+        line, _, rest = head.partition(b'\n')
+        if len(line) > HTTP_MAX_LINE:
+            raise ValueError('414 URI Too Long')
+        method, target, version = line.decode('latin-1').split()
+        if version not in ('HTTP/1.0', 'HTTP/1.1'):
+            raise ValueError('505 HTTP Version Not Supported')
+        try:
+            headers = http.client.parse_headers(io.BytesIO(rest))
+        except http.client.HTTPException:
+            raise ValueError('431 Request Header Fields Too Large')
+        length = int(headers.get('Content-Length') or 0)
+        if length < 0:
+            raise ValueError('400 Bad Request')
+        return method, target, version, headers, length
+
+    def _reject(self, conn, status, extra=''):
+        # 分发线程里直接回一个很短的错误响应并关闭连接，发不出去就算了
+        try:
+            conn.sock.send(f'HTTP/1.1 {status}\r\n{extra}Content-Length: 0\r\nConnection: close\r\n\r\n'.encode())
+        except OSError:
+            pass
+        self.close(conn)
+
+    def _wait(self, conn):
+        conn.idle_since = time.monotonic()
+        self.idle.add(conn)
+        self.selector.register(conn.sock, selectors.EVENT_READ, conn)
+
+    def _unpark(self):
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.parked:
+            self._dispatch(self.parked.popleft())  # 流水线上的下一个请求可能已经在缓冲里
+        self._resume_accept()
+
+    def _expire(self):
+        # 空闲超时的长连接由服务端关闭，请求头迟迟收不齐的连接回 408
+        now = time.monotonic()
+        for conn in list(self.idle):
+            if conn.head_since is not None and now - conn.head_since > HTTP_HEADER_TIMEOUT:
+                status = '408 Request Timeout'
+            elif conn.head_since is None and now - conn.idle_since > HTTP_KEEPALIVE:
+                status = None
+            else:
+                continue
+            self.selector.unregister(conn.sock)
+            self.idle.discard(conn)
+            if status:
+                self._reject(conn, status)
+            else:
+                self.close(conn)
+
+    def close(self, conn):
+        conn.close()
+        with self.lock:
+            self.connections -= 1
+        if not self.accepting:
+            self.waker.send(b'\0')
+
+    def handle_connection(self, conn):
+        # 工作线程：处理分发线程交来的一个请求，之后把连接交还给分发线程接收下一个请求头
+        try:
+            conn.sock.settimeout(HTTP_TIMEOUT)
+            if self.handle_request(conn):
+                self.parked.append(conn)
+                self.waker.send(b'\0')
+                return
+        except OSError:
+            pass  # 客户端断开或超时
+        except Exception as e:
+            report_error(f"HTTP request failed: {e}")
+        self.close(conn)
+
+    def handle_request(self, conn):
+        # 处理一个请求，返回连接是否可以继续使用；请求体从连接的缓冲和套接字里读取
+        method, target, version, headers, length = conn.request
+        conn.requests += 1
+        tokens = headers.get('Connection', '').lower()
+        keep_alive = ('close' not in tokens if version == 'HTTP/1.1' else 'keep-alive' in tokens) and \
+            HTTP_KEEPALIVE > 0 and conn.requests < HTTP_KEEPALIVE_REQUESTS and self.running
+        chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        if chunked:
+            body = DechunkedInput(conn)
+            keep_alive = False  # 无法确认分块请求体是否读完
+        else:
+            body = LimitedStream(conn, length)
+        if headers.get('Expect', '').lower() == '100-continue':
+            conn.sock.sendall(b'HTTP/1.1 100 Continue\r\n\r\n')
+        environ = self.make_environ(conn, method, target, version, headers, body)
+        if chunked:
+            environ['wsgi.input_terminated'] = True
+        writer = HTTPResponseWriter(conn.sock, version, method, keep_alive)
+        result = self.app(environ, writer.start_response)
+        try:
+            for data in result:
+                writer.write(data)
+            writer.finish()
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        if not writer.keep_alive:
+            return False
+        # 应用没有读完请求体时读掉剩余部分，太大则直接关闭连接
+        remaining = length - body.tell()
+        if remaining > HTTP_DRAIN_BYTES:
+            return False
+        while remaining > 0:
+            data = body.read(remaining)
+            if not data:
+                return False
+            remaining -= len(data)
+        return True
+
+    def make_environ(self, conn, method, target, version, headers, body):
+        path, _, query = target.partition('?')
+        environ = {
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'SERVER_SOFTWARE': 'led_web_test',
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            # 与 Werkzeug 一致：百分号按 UTF-8 解码，再以 latin-1 形式放进 environ
+            'PATH_INFO': unquote(path).encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': query,
+            'REQUEST_URI': target,
+            'RAW_URI': target,
+            'REMOTE_ADDR': conn.address[0],
+            'REMOTE_PORT': conn.address[1],
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+        }
+        for name, value in headers.items():
+            if '_' in name:
+                continue
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+                if key in environ:
+                    value = f'{environ[key]},{value}'
+            environ[key] = value
+        return environ
+
+    def stats(self):
+        return {'connections': self.connections, 'idle': len(self.idle), 'accepting': self.accepting,
+                'pools': {name: pool.stats() for name, pool in self.pools.items()}}
+
+http_server = None
+metrics.collect('led_http_connections', 'Open HTTP connections', lambda: http_server.connections if http_server else 0)
+metrics.collect('led_http_rejected_total', 'HTTP connections refused with 503 because a worker pool was full',
+                lambda: sum(p.rejected for p in http_server.pools.values()) if http_server else 0, 'counter')
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Web controller for Raspberry Pi RGB LED matrices')
+    parser.add_argument('--port', type=int, default=8080, help='web server port')
+    parser.add_argument('--server', choices=('pooled', 'werkzeug'), default=HTTP_SERVER,
+                        help='pooled: production server with separate upload/media/control pools; '
+                             'werkzeug: Flask development server')
+    parser.add_argument('--receiver', type=int, metavar='PORT',
+                        help='run as a display node that shows frames streamed by a controller')
+    parser.add_argument('--node', action='append', default=[], metavar='HOST:PORT@Y,X,H,W',
+                        help='controller mode: stream this region of the canvas to a receiver node (repeatable)')
+    args = parser.parse_args()
+    if args.node:
+        NETWORK_NODES[:] = parse_nodes(';'.join(args.node))
+    if NETWORK_NODES and not args.receiver:
+        engine.backend_name = 'network'
     check_root_permission()
+    engine.missing()  # 启动时就报告缺失的矩阵绑定，而不是等到第一次显示
     try:
-        app.run(host='::', port=8080, debug=False)
+        if args.receiver:
+            FrameReceiver(args.receiver).serve_forever()
+        else:
+            if scheduler.active:
+                scheduler.resume()  # 继续上次退出时正在播放的列表
+            if args.server == 'pooled':
+                http_server = PooledHTTPServer(app, '::', args.port)
+                http_server.serve_forever()
+            else:
+                app.run(host='::', port=args.port, debug=False)
     finally:
-        stop_current()
+        stop_current(wait=True)